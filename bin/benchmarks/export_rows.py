@@ -0,0 +1,78 @@
+#!/bin/env python3
+"""
+Compares the time and peak memory of exporting a stored query result to CSV by decoding it whole
+(`decode_result`) and by iterating over its rows as they're decoded (`decode_result_rows`), for
+each storage codec.
+
+Usage: python bin/benchmarks/export_rows.py [rows] [columns]
+"""
+
+import csv
+import sys
+import time
+import tracemalloc
+
+from mock import patch
+
+from redash.models.result_codecs import (
+    decode_result,
+    decode_result_rows,
+    encode_result,
+    ijson_enabled,
+)
+
+
+class NullWriter:
+    def write(self, value):
+        pass
+
+
+def make_result(rows, columns):
+    names = ["column_{}".format(i) for i in range(columns)]
+    return {
+        "columns": [{"name": name, "friendly_name": name, "type": "string"} for name in names],
+        "rows": [{name: "value {} {}".format(r, name) for name in names} for r in range(rows)],
+    }
+
+
+def export(columns, rows):
+    writer = csv.DictWriter(NullWriter(), fieldnames=[column["name"] for column in columns])
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+
+
+def export_decoded(encoded):
+    data = decode_result(encoded)
+    export(data["columns"], data["rows"])
+
+
+def export_iterated(encoded):
+    export(*decode_result_rows(encoded))
+
+
+def measure(fn, encoded):
+    tracemalloc.start()
+    started = time.perf_counter()
+    fn(encoded)
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main(rows=100000, columns=10):
+    data = make_result(rows, columns)
+    print("{} rows x {} columns (ijson installed: {})".format(rows, columns, ijson_enabled))
+
+    for codec in ("json", "columnar"):
+        with patch("redash.settings.QUERY_RESULTS_STORAGE_CODEC", codec):
+            encoded = encode_result(data)
+
+        for name, fn in (("decode_result", export_decoded), ("decode_result_rows", export_iterated)):
+            elapsed, peak = measure(fn, encoded)
+            print("{:<10} {:<20} {:>8.2f}s {:>10.1f} MB peak".format(codec, name, elapsed, peak / 1024 / 1024))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,70 @@
+#!/bin/env python3
+"""
+Compares json_dumps and json_loads with the "orjson" and "json" (stdlib) serializers
+(REDASH_JSON_SERIALIZER) on a query result with dates, decimals and UUIDs.
+
+Usage: python bin/benchmarks/json_serialization.py [rows] [repeat]
+"""
+
+import datetime
+import decimal
+import sys
+import time
+import uuid
+
+from mock import patch
+
+from redash.utils import json_dumps, json_loads, orjson_enabled
+
+
+def make_result(rows):
+    now = datetime.datetime(2024, 1, 1, 12, 30)
+    return {
+        "columns": [
+            {"name": name, "friendly_name": name, "type": type}
+            for name, type in (
+                ("id", "integer"),
+                ("name", "string"),
+                ("price", "float"),
+                ("created_at", "datetime"),
+                ("day", "date"),
+                ("uuid", "string"),
+            )
+        ],
+        "rows": [
+            {
+                "id": i,
+                "name": "name {}".format(i),
+                "price": decimal.Decimal("{}.25".format(i)),
+                "created_at": now + datetime.timedelta(seconds=i),
+                "day": (now + datetime.timedelta(days=i % 365)).date(),
+                "uuid": uuid.UUID(int=i),
+            }
+            for i in range(rows)
+        ],
+    }
+
+
+def best_of(repeat, fn, *args):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(*args)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main(rows=100000, repeat=5):
+    data = make_result(rows)
+    print("{} rows, best of {} (orjson installed: {})".format(rows, repeat, orjson_enabled))
+
+    for serializer in ("json", "orjson"):
+        with patch("redash.settings.JSON_SERIALIZER", serializer):
+            encoded = json_dumps(data)
+            dumps = best_of(repeat, json_dumps, data)
+            loads = best_of(repeat, json_loads, encoded)
+        print("{:<8} json_dumps {:>7.3f}s  json_loads {:>7.3f}s".format(serializer, dumps, loads))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
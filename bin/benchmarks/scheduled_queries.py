@@ -0,0 +1,91 @@
+#!/bin/env python3
+"""
+Compares how long Query.outdated_queries() takes when it has to scan every scheduled query
+(rebuilding the scheduled queries index) and when it only checks the queries the index says are due.
+
+The queries are created in a transaction that's rolled back at the end, and the index is kept in the
+Redis database the tests use, so this can run against the tests' database and Redis.
+
+Usage: python bin/benchmarks/scheduled_queries.py [queries]
+"""
+
+import sys
+import time
+
+import tests  # noqa: F401, use the tests' Redis databases
+from redash import models, redis_connection
+from redash.app import create_app
+from redash.models import db
+from redash.utils import gen_query_hash, utcnow
+from redash.utils.configuration import ConfigurationContainer
+
+
+def create_scheduled_queries(count):
+    org = models.Organization(name="Benchmark", slug="benchmark-{}".format(time.time()), settings={})
+    data_source = models.DataSource(
+        org=org, name="Benchmark", type="pg", options=ConfigurationContainer.from_json('{"dbname": "benchmark"}')
+    )
+    user = models.User(org=org, name="Benchmark", email="benchmark@example.com", group_ids=[])
+    result = models.QueryResult(
+        org=org,
+        data_source=data_source,
+        query_hash=gen_query_hash("SELECT 1"),
+        query_text="SELECT 1",
+        data={"columns": [], "rows": []},
+        runtime=1,
+        retrieved_at=utcnow(),
+    )
+    db.session.add_all([org, data_source, user, result])
+    db.session.flush()
+
+    schedule = {"interval": "3600", "time": None, "until": None, "day_of_week": None}
+    db.session.bulk_insert_mappings(
+        models.Query,
+        [
+            {
+                "org_id": org.id,
+                "data_source_id": data_source.id,
+                "user_id": user.id,
+                "latest_query_data_id": result.id,
+                "name": "Query {}".format(i),
+                "query_text": "SELECT {}".format(i),
+                "query_hash": gen_query_hash("SELECT {}".format(i)),
+                "api_key": "benchmark{}".format(i),
+                "schedule": schedule,
+                "options": {},
+                "is_archived": False,
+                "is_draft": False,
+                "tags": [],
+                "version": 1,
+            }
+            for i in range(count)
+        ],
+    )
+
+
+def timed(fn):
+    started = time.perf_counter()
+    fn()
+    return time.perf_counter() - started
+
+
+def main(count=10000):
+    app = create_app()
+    with app.app_context():
+        index = models.ScheduledQueriesIndex
+        index_keys = [index.KEY_NAME, index.BUILT_KEY_NAME, index.CHANGES_KEY_NAME, index.VERSION_KEY_NAME]
+        try:
+            create_scheduled_queries(count)
+            redis_connection.delete(*index_keys)
+
+            full_scan = timed(models.Query.outdated_queries)
+            indexed = timed(models.Query.outdated_queries)
+        finally:
+            db.session.rollback()
+            redis_connection.delete(*index_keys)
+
+    print("{} scheduled queries: full scan {:.3f}s, indexed refresh {:.3f}s".format(count, full_scan, indexed))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
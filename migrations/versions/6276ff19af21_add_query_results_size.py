@@ -0,0 +1,26 @@
+"""add data_size and row_count to query_results
+
+Revision ID: 6276ff19af21
+Revises: db0aca1ebd32
+Create Date: 2026-10-17 12:04:31.418506
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = "6276ff19af21"
+down_revision = "db0aca1ebd32"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("query_results", sa.Column("data_size", sa.BigInteger(), nullable=True))
+    op.add_column("query_results", sa.Column("row_count", sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column("query_results", "row_count")
+    op.drop_column("query_results", "data_size")
@@ -10,13 +10,13 @@ from sqlalchemy.orm import configure_mappers
 from supervisor_checks import check_runner
 from supervisor_checks.check_modules import base
 
-from redash import rq_redis_connection
+from redash import rq_redis_connection, settings
 from redash.tasks import (
     periodic_job_definitions,
     rq_scheduler,
     schedule_periodic_jobs,
 )
-from redash.tasks.worker import Worker
+from redash.tasks.worker import WarmWorker, Worker
 from redash.worker import default_queues
 
 manager = AppGroup(help="RQ management commands.")
@@ -42,8 +42,10 @@ def worker(queues):
     else:
         queues = chain(*[queue.split(",") for queue in queues])
 
+    worker_class = WarmWorker if settings.WORKER_WARM_HORSES else Worker
+
     with Connection(rq_redis_connection):
-        w = Worker(queues, log_job_description=False, job_monitoring_interval=5)
+        w = worker_class(queues, log_job_description=False, job_monitoring_interval=5)
         w.work()
 
 
@@ -70,8 +70,10 @@ from redash.handlers.queries import (
     QueryTagsResource,
 )
 from redash.handlers.query_results import (
+    JobEventsResource,
     JobResource,
     QueryDropdownsResource,
+    QueryResultAggregateResource,
     QueryResultDropdownResource,
     QueryResultListResource,
     QueryResultResource,
@@ -245,6 +247,12 @@ api.add_org_resource(
     "/api/queries/<query_id>/results/<query_result_id>.<filetype>",
     endpoint="query_result",
 )
+api.add_org_resource(
+    QueryResultAggregateResource,
+    "/api/query_results/<query_result_id>/aggregate",
+    endpoint="query_result_aggregate",
+)
+api.add_org_resource(JobEventsResource, "/api/jobs/events", endpoint="job_events")
 api.add_org_resource(
     JobResource,
     "/api/jobs/<job_id>",
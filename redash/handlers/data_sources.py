@@ -169,20 +169,63 @@ class DataSourceListResource(BaseResource):
 
 class DataSourceSchemaResource(BaseResource):
     def get(self, data_source_id):
+        """
+        Return the schema of a data source, or the job fetching it when it isn't cached (or `refresh` is set).
+
+        :qparam table: only return these tables (can be repeated)
+        :qparam search: only list the tables whose name contains this, without their columns
+        :qparam prefix: only list the tables whose name starts with this, without their columns
+        :qparam offset: skip this many tables of the list
+        :qparam limit: list at most this many tables
+        """
         data_source = get_object_or_404(models.DataSource.get_by_id_and_org, data_source_id, self.current_org)
         require_access(data_source, self.current_user, view_only)
         refresh = request.args.get("refresh") is not None
 
         if not refresh:
-            cached_schema = data_source.get_cached_schema()
-
-            if cached_schema is not None:
-                return {"schema": cached_schema}
+            if "table" in request.args:
+                tables = data_source.get_cached_schema_tables(request.args.getlist("table"))
+                if tables is not None:
+                    return {"schema": tables}
+            elif any(arg in request.args for arg in ("search", "prefix", "offset", "limit")):
+                page = self.get_schema_page(data_source)
+                if page is not None:
+                    return page
+            else:
+                cached_schema = data_source.get_cached_schema()
+
+                if cached_schema is not None:
+                    return {"schema": cached_schema}
 
         job = get_schema.delay(data_source.id, refresh)
 
         return serialize_job(job)
 
+    @staticmethod
+    def get_schema_page(data_source):
+        try:
+            offset = int(request.args.get("offset", 0))
+            limit = request.args.get("limit")
+            limit = int(limit) if limit is not None else None
+        except ValueError:
+            abort(400, message="offset and limit must be integers.")
+
+        if offset < 0 or (limit is not None and limit < 0):
+            abort(400, message="offset and limit can't be negative.")
+
+        prefix = request.args.get("prefix")
+        term = request.args.get("search", "") if prefix is None else prefix
+        result = data_source.search_cached_schema(term, prefix=prefix is not None, offset=offset, limit=limit)
+        if result is None:
+            return None
+
+        names, total = result
+        tables = [
+            {key: value for key, value in table.items() if key != "columns"}
+            for table in data_source.get_cached_schema_tables(names) or []
+        ]
+        return {"schema": tables, "offset": offset, "limit": limit, "total": total}
+
 
 class DataSourcePauseResource(BaseResource):
     @require_admin
@@ -1,12 +1,14 @@
+import hashlib
+import time
 import unicodedata
 from urllib.parse import quote
 
 import regex
-from flask import make_response, request
+from flask import Response, make_response, request, stream_with_context
 from flask_login import current_user
 from flask_restful import abort
 
-from redash import models, settings
+from redash import models, redis_connection, rq_redis_connection, settings
 from redash.handlers.base import BaseResource, get_object_or_404, record_event
 from redash.models.parameterized_query import (
     InvalidParameterError,
@@ -26,15 +28,31 @@ from redash.serializers import (
     serialize_job,
     serialize_query_result,
     serialize_query_result_to_dsv,
+    serialize_query_result_to_dsv_stream,
     serialize_query_result_to_xlsx,
 )
 from redash.tasks import Job
-from redash.tasks.queries import enqueue_query
+from redash.tasks.queries import (
+    enqueue_query,
+    job_status_channel,
+    publish_job_status,
+    wait_for_query_result,
+)
 from redash.utils import (
     collect_parameters_from_request,
+    gen_query_hash,
     json_dumps,
+    json_loads,
     to_filename,
 )
+from redash.utils.pandas import (
+    InvalidAggregationError,
+    pandas_installed,
+    parse_aggregation_spec,
+)
+
+if pandas_installed:
+    from redash.utils.pandas import aggregate_result
 
 
 def error_response(message, http_status=400):
@@ -56,7 +74,14 @@ error_messages = {
 }
 
 
-def run_query(query, parameters, data_source, query_id, should_apply_auto_limit, max_age=0):
+def get_wait_arg(params):
+    try:
+        return float(params.get("wait") or 0)
+    except (TypeError, ValueError):
+        abort(400, message="wait must be a number.")
+
+
+def run_query(query, parameters, data_source, query_id, should_apply_auto_limit, max_age=0, wait=0):
     if not data_source:
         return error_messages["no_data_source"]
 
@@ -110,6 +135,14 @@ def run_query(query, parameters, data_source, query_id, should_apply_auto_limit,
                 "query_id": query_id,
             },
         )
+
+        if job and wait > 0:
+            timeout = min(wait, settings.QUERY_RESULTS_MAX_WAIT)
+            query_result_id = wait_for_query_result(job, gen_query_hash(query_text), data_source.id, timeout)
+            query_result = query_result_id and models.QueryResult.query.get(query_result_id)
+            if query_result:
+                return {"query_result": serialize_query_result(query_result, current_user.is_api_user())}
+
         return serialize_job(job)
 
 
@@ -152,6 +185,8 @@ class QueryResultListResource(BaseResource):
                                 return them, otherwise execute the query; if omitted or -1, returns
                                 any cached result, or executes if not available. Set to zero to
                                 always execute.
+        :qparam number wait: If the query is executed, wait up to this many seconds for its result and
+                             return it instead of the job (optional)
         :qparam number data_source_id: ID of data source to query
         :qparam object parameters: A set of parameter values to apply to the query.
         """
@@ -163,6 +198,7 @@ class QueryResultListResource(BaseResource):
         if max_age is None:
             max_age = -1
         max_age = int(max_age)
+        wait = get_wait_arg(params)
         query_id = params.get("query_id", "adhoc")
         parameters = params.get("parameters", collect_parameters_from_request(request.args))
 
@@ -185,6 +221,7 @@ class QueryResultListResource(BaseResource):
             query_id,
             should_apply_auto_limit,
             max_age,
+            wait,
         )
 
 
@@ -248,6 +285,8 @@ class QueryResultResource(BaseResource):
                                 return them, otherwise execute the query; if omitted or -1, returns
                                 any cached result, or executes if not available. Set to zero to
                                 always execute.
+        :qparam number wait: If the query is executed, wait up to this many seconds for its result and
+                             return it instead of the job (optional)
         """
         params = request.get_json(force=True, silent=True) or {}
         parameter_values = params.get("parameters", {})
@@ -257,6 +296,7 @@ class QueryResultResource(BaseResource):
         if max_age is None:
             max_age = -1
         max_age = int(max_age)
+        wait = get_wait_arg(params)
 
         query = get_object_or_404(models.Query.get_by_id_and_org, query_id, self.current_org)
 
@@ -274,6 +314,7 @@ class QueryResultResource(BaseResource):
                 query_id,
                 should_apply_auto_limit,
                 max_age,
+                wait,
             )
         else:
             if not query.parameterized.is_safe:
@@ -292,6 +333,9 @@ class QueryResultResource(BaseResource):
         :param number query_id: The ID of the query whose results should be fetched
         :param number query_result_id: the ID of the query result to fetch
         :param string filetype: Format to return. One of 'json', 'xlsx', or 'csv'. Defaults to 'json'.
+        :qparam number offset: (json only) Return rows starting at this offset.
+        :qparam number limit: (json only) Return at most this many rows.
+        :qparam string columns: (json only) Comma separated names of the columns to return.
 
         :<json number id: Query result ID
         :<json string query: Query that produced this result
@@ -374,21 +418,54 @@ class QueryResultResource(BaseResource):
         else:
             abort(404, message="No cached result found for this query.")
 
+    @staticmethod
+    def get_window_args():
+        try:
+            offset = int(request.args.get("offset", 0))
+            limit = request.args.get("limit")
+            limit = int(limit) if limit is not None else None
+        except ValueError:
+            abort(400, message="offset and limit must be integers.")
+
+        if offset < 0 or (limit is not None and limit < 0):
+            abort(400, message="offset and limit can't be negative.")
+
+        columns = request.args.get("columns")
+        columns = columns.split(",") if columns else None
+
+        return offset, limit, columns
+
     @staticmethod
     def make_json_response(query_result):
-        data = json_dumps({"query_result": query_result.to_dict()})
+        if any(arg in request.args for arg in ("offset", "limit", "columns")):
+            offset, limit, columns = QueryResultResource.get_window_args()
+            rows, row_count = query_result.get_data_window(offset, limit, columns)
+            result = query_result.to_dict(with_data=False)
+            result["data"] = rows
+            data = json_dumps({"query_result": result, "offset": offset, "limit": limit, "row_count": row_count})
+        else:
+            data = json_dumps({"query_result": query_result.to_dict()})
+
         headers = {"Content-Type": "application/json"}
         return make_response(data, 200, headers)
 
+    @staticmethod
+    def make_dsv_response(query_result, delimiter, headers):
+        if settings.DSV_EXPORT_STREAMING_ENABLED:
+            rows = stream_with_context(serialize_query_result_to_dsv_stream(query_result, delimiter))
+            return Response(rows, 200, headers)
+
+        return make_response(serialize_query_result_to_dsv(query_result, delimiter), 200, headers)
+
     @staticmethod
     def make_csv_response(query_result):
         headers = {"Content-Type": "text/csv; charset=UTF-8"}
-        return make_response(serialize_query_result_to_dsv(query_result, ","), 200, headers)
+        return QueryResultResource.make_dsv_response(query_result, ",", headers)
 
     @staticmethod
     def make_tsv_response(query_result):
         headers = {"Content-Type": "text/tab-separated-values; charset=UTF-8"}
-        return make_response(serialize_query_result_to_dsv(query_result, "\t"), 200, headers)
+        return QueryResultResource.make_dsv_response(query_result, "\t", headers)
 
     @staticmethod
     def make_excel_response(query_result):
@@ -396,6 +473,69 @@ class QueryResultResource(BaseResource):
         return make_response(serialize_query_result_to_xlsx(query_result), 200, headers)
 
 
+def _aggregation_key(query_result_id, spec):
+    spec_hash = hashlib.sha1(json_dumps(spec, sort_keys=True).encode("utf-8")).hexdigest()
+    return "query_result_aggregation:{}:{}".format(query_result_id, spec_hash)
+
+
+def _aggregated_columns(spec):
+    return set(spec["group_by"]) | {a["column"] for a in spec["aggregations"] if a["column"]}
+
+
+class QueryResultAggregateResource(BaseResource):
+    @require_any_of_permission(("view_query", "execute_query"))
+    def post(self, query_result_id):
+        """
+        Group, aggregate, sort and limit the rows of a query result on the server, returning only the
+        reduced result. Query results don't change, so aggregations are cached per result and spec.
+
+        :param number query_result_id: The ID of the query result to aggregate
+        :<json list group_by: Names of the columns to group by
+        :<json list aggregations: Objects with the ``function`` (one of count, count_distinct, sum, avg,
+                                  min or max), ``column`` and optional ``name`` of each aggregation
+        :<json list sort: Objects with the ``column`` and ``direction`` (asc or desc) to sort by
+        :<json number limit: Return at most this many rows
+
+        :>json object query_result: The query result's metadata, with the reduced rows in ``data``
+        """
+        if not pandas_installed:
+            abort(400, message="Aggregating query results requires pandas.")
+
+        query_result = get_object_or_404(models.QueryResult.get_by_id_and_org, query_result_id, self.current_org)
+        require_access(query_result.data_source, self.current_user, view_only)
+
+        spec = request.get_json(force=True, silent=True)
+        key = _aggregation_key(query_result.id, spec)
+        data = redis_connection.get(key)
+
+        if data is not None:
+            data = json_loads(data)
+        else:
+            try:
+                if query_result.decodes_windows():
+                    # Validate the spec against the result's columns before decoding any of its rows, and only
+                    # decode the columns it uses.
+                    header, _ = query_result.get_data_window(limit=0)
+                    spec = parse_aggregation_spec(spec, header["columns"])
+                    result_data, _ = query_result.get_data_window(columns=_aggregated_columns(spec))
+                else:
+                    # Results stored as plain JSON are decoded whole either way, so they're decoded once.
+                    result_data, _ = query_result.get_data_window()
+                    spec = parse_aggregation_spec(spec, result_data["columns"])
+                    columns = _aggregated_columns(spec)
+                    result_data["columns"] = [c for c in result_data["columns"] if c["name"] in columns]
+
+                data = aggregate_result(result_data, spec)
+            except InvalidAggregationError as e:
+                abort(400, message=str(e))
+
+            redis_connection.set(key, json_dumps(data), ex=settings.QUERY_RESULTS_AGGREGATION_CACHE_TTL)
+
+        result = query_result.to_dict(with_data=False)
+        result["data"] = data
+        return {"query_result": result}
+
+
 class JobResource(BaseResource):
     def get(self, job_id, query_id=None):
         """
@@ -410,3 +550,92 @@ class JobResource(BaseResource):
         """
         job = Job.fetch(job_id)
         job.cancel()
+        publish_job_status(job.id, error="Query cancelled by user.")
+
+
+JOB_DONE_STATUSES = (3, 4, 5)
+JOB_EVENTS_HEARTBEAT = 15
+
+
+def job_status_event(job_id, message):
+    """The `serialize_job` output for a message published on a job's status channel."""
+    if "state" in message:
+        job = Job.fetch(job_id)
+        return serialize_job(job)
+
+    error = message.get("error") or ""
+    query_result_id = None if error else message.get("query_result_id")
+    return {
+        "job": {
+            "id": job_id,
+            "updated_at": time.time(),
+            "status": 4 if error else 3,
+            "error": error,
+            "result": query_result_id,
+            "query_result_id": query_result_id,
+        }
+    }
+
+
+def server_sent_event(data):
+    return "data: {}\n\n".format(json_dumps(data))
+
+
+def job_events(job_ids, timeout):
+    pubsub = redis_connection.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(*[job_status_channel(job_id) for job_id in job_ids])
+    try:
+        pending = set()
+        # Send the current status once subscribed, so no update is missed in between.
+        for job_id, job in zip(job_ids, Job.fetch_many(job_ids, connection=rq_redis_connection)):
+            if job is None:
+                event = {"job": {"id": job_id, "status": 4, "error": "Job not found.", "updated_at": 0}}
+            else:
+                event = serialize_job(job)
+            yield server_sent_event(event)
+            if event["job"]["status"] not in JOB_DONE_STATUSES:
+                pending.add(job_id)
+
+        deadline = time.time() + timeout
+        last_event = time.time()
+        while pending and time.time() < deadline:
+            message = pubsub.get_message(timeout=min(deadline - time.time(), JOB_EVENTS_HEARTBEAT))
+            if message is None:
+                if time.time() - last_event >= JOB_EVENTS_HEARTBEAT:
+                    last_event = time.time()
+                    yield ": heartbeat\n\n"
+                continue
+
+            job_id = message["channel"].split(":", 1)[1]
+            if job_id not in pending:
+                continue
+
+            event = job_status_event(job_id, json_loads(message["data"]))
+            last_event = time.time()
+            yield server_sent_event(event)
+            if event["job"]["status"] in JOB_DONE_STATUSES:
+                pending.discard(job_id)
+                pubsub.unsubscribe(message["channel"])
+    finally:
+        pubsub.close()
+
+
+class JobEventsResource(BaseResource):
+    def get(self):
+        """
+        Stream the status of query jobs as Server-Sent Events, instead of polling each job.
+
+        Sends the status of every job first, and then every time one of them progresses, until all
+        of them are done or `REDASH_JOB_EVENTS_TIMEOUT` seconds passed. Each event has the same format
+        as the response of the job resource.
+
+        :qparam job_id: A job ID (can be repeated)
+        """
+        job_ids = list(dict.fromkeys(request.args.getlist("job_id")))
+        if not job_ids:
+            abort(400, message="job_id is required.")
+        if len(job_ids) > settings.JOB_EVENTS_MAX_JOBS:
+            abort(400, message="At most {} jobs can be followed at once.".format(settings.JOB_EVENTS_MAX_JOBS))
+
+        headers = {"Content-Type": "text/event-stream", "Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        return Response(stream_with_context(job_events(job_ids, settings.JOB_EVENTS_TIMEOUT)), 200, headers)
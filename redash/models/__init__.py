@@ -1,22 +1,26 @@
 import calendar
 import datetime
+import hashlib
 import logging
 import numbers
 import re
 import time
 
 import pytz
-from sqlalchemy import UniqueConstraint, and_, cast, distinct, func, or_
+from sqlalchemy import UniqueConstraint, and_, cast, distinct, func, or_, type_coerce
 from sqlalchemy.dialects.postgresql import ARRAY, DOUBLE_PRECISION, JSONB
 from sqlalchemy.event import listens_for
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import (
     backref,
     contains_eager,
+    deferred,
     joinedload,
     load_only,
+    object_session,
     subqueryload,
 )
+from sqlalchemy.orm.attributes import get_history
 from sqlalchemy.orm.exc import NoResultFound  # noqa: F401
 from sqlalchemy_utils import generic_relationship
 from sqlalchemy_utils.models import generic_repr
@@ -46,12 +50,21 @@ from redash.models.parameterized_query import (
     ParameterizedQuery,
     QueryDetachedFromDataSourceError,
 )
+from redash.models.result_codecs import (
+    BLOB_REFERENCE_PREFIX,
+    EncodedResult,
+    blob_reference,
+    decode_result_rows,
+    decode_result_window,
+    decodes_windows,
+)
+from redash.models.result_stores import delete_blobs
 from redash.models.types import (
     Configuration,
     EncryptedConfiguration,
-    JSONText,
     MutableDict,
     MutableList,
+    QueryResultData,
     json_cast_property,
 )
 from redash.models.users import (  # noqa
@@ -91,8 +104,14 @@ class ScheduledQueriesExecutions:
     def __init__(self):
         self.executions = {}
 
-    def refresh(self):
-        self.executions = redis_connection.hgetall(self.KEY_NAME)
+    def refresh(self, query_ids=None):
+        if query_ids is None:
+            self.executions = redis_connection.hgetall(self.KEY_NAME)
+        elif query_ids:
+            timestamps = redis_connection.hmget(self.KEY_NAME, [str(query_id) for query_id in query_ids])
+            self.executions = {str(query_id): t for query_id, t in zip(query_ids, timestamps) if t is not None}
+        else:
+            self.executions = {}
 
     def update(self, query_id):
         redis_connection.hset(self.KEY_NAME, mapping={query_id: time.time()})
@@ -108,6 +127,137 @@ class ScheduledQueriesExecutions:
 scheduled_queries_executions = ScheduledQueriesExecutions()
 
 
+# Marks a query as changed: it's scored 0 in the index, and the version it changed at is recorded, so refreshes that
+# read the database before it changed don't overwrite that with a next run computed from its old state.
+#
+# KEYS[1]: the index, KEYS[2]: the versions queries last changed at, KEYS[3]: the current version
+# ARGV[1]: query id
+INVALIDATE_SCHEDULED_QUERY_SCRIPT = """
+local version = redis.call('INCR', KEYS[3])
+redis.call('HSET', KEYS[2], ARGV[1], version)
+redis.call('ZADD', KEYS[1], 0, ARGV[1])
+"""
+
+# Stores the next runs of queries checked by a refresh that read the database at version ARGV[1] (or regardless of
+# when they changed, if it's empty), skipping queries that changed since. An empty next run removes the query.
+#
+# KEYS[1]: the index, KEYS[2]: the versions queries last changed at
+# ARGV[1]: version, ARGV[2...]: query id and next run pairs
+UPDATE_SCHEDULED_QUERIES_SCRIPT = """
+local version = tonumber(ARGV[1])
+for i = 2, #ARGV, 2 do
+    local query_id, next_run = ARGV[i], ARGV[i + 1]
+    local changed = tonumber(redis.call('HGET', KEYS[2], query_id) or '0')
+    if version == nil or changed <= version then
+        if version ~= nil and changed > 0 then
+            redis.call('HDEL', KEYS[2], query_id)
+        end
+        if next_run == '' then
+            redis.call('ZREM', KEYS[1], query_id)
+        else
+            redis.call('ZADD', KEYS[1], next_run, query_id)
+        end
+    end
+end
+"""
+
+# Replaces the index with one rebuilt (in KEYS[3]) from a full scan of the database at version ARGV[1], keeping the
+# queries that changed since scored 0.
+#
+# KEYS[1]: the index, KEYS[2]: the versions queries last changed at, KEYS[3]: the rebuilt index, KEYS[4]: when the
+# index was built
+# ARGV[1]: version, ARGV[2]: current time, ARGV[3]: seconds until the index is rebuilt again
+REPLACE_SCHEDULED_QUERIES_INDEX_SCRIPT = """
+local version = tonumber(ARGV[1])
+local changes = redis.call('HGETALL', KEYS[2])
+for i = 1, #changes, 2 do
+    if tonumber(changes[i + 1]) > version then
+        redis.call('ZADD', KEYS[3], 0, changes[i])
+    else
+        redis.call('HDEL', KEYS[2], changes[i])
+    end
+end
+
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    redis.call('PERSIST', KEYS[3])
+    redis.call('RENAME', KEYS[3], KEYS[1])
+else
+    redis.call('DEL', KEYS[1])
+end
+redis.call('SET', KEYS[4], ARGV[2], 'EX', ARGV[3])
+"""
+
+
+class ScheduledQueriesIndex:
+    """When each scheduled query is due next, as a sorted set of query ids scored by timestamp.
+
+    Queries that change (or get a new result) are scored 0 so they are checked on the next refresh, which
+    stores the time they are actually due. The index is rebuilt from a full scan when it's missing or every
+    SCHEDULED_QUERIES_INDEX_REBUILD_INTERVAL seconds.
+
+    Refreshes read the database while queries may be changing, so every change bumps a version, and a refresh
+    only stores the next runs of queries that haven't changed since the version it started at (see
+    INVALIDATE_SCHEDULED_QUERY_SCRIPT).
+    """
+
+    KEY_NAME = "sq:next_run_at"
+    BUILT_KEY_NAME = "sq:next_run_at:built"
+    CHANGES_KEY_NAME = "sq:next_run_at:changes"
+    VERSION_KEY_NAME = "sq:next_run_at:version"
+    REBUILD_KEY_PREFIX = "sq:next_run_at:rebuild:"
+    rebuild_batch_size = 10000
+
+    def version(self):
+        """Return the current version, to pass to `update` or `rebuild` along with what's read from the database
+        after it."""
+        return int(redis_connection.get(self.VERSION_KEY_NAME) or 0)
+
+    def due(self, now):
+        """Return the ids of the queries due at `now`, or None if the index needs to be rebuilt."""
+        if not redis_connection.exists(self.BUILT_KEY_NAME):
+            return None
+
+        return [int(query_id) for query_id in redis_connection.zrangebyscore(self.KEY_NAME, "-inf", now.timestamp())]
+
+    def invalidate(self, query_id):
+        invalidate = redis_connection.register_script(INVALIDATE_SCHEDULED_QUERY_SCRIPT)
+        invalidate(keys=[self.KEY_NAME, self.CHANGES_KEY_NAME, self.VERSION_KEY_NAME], args=[query_id])
+
+    def update(self, next_runs, checked_ids, version=None):
+        """Store the next run of the checked queries, dropping the ones that are no longer scheduled. Unless
+        `version` is None, queries that changed after it are left to be checked again."""
+        args = ["" if version is None else version]
+        for query_id in set(checked_ids) - set(next_runs):
+            args.extend([query_id, ""])
+        for query_id, next_run in next_runs.items():
+            args.extend([query_id, next_run])
+
+        if len(args) > 1:
+            update = redis_connection.register_script(UPDATE_SCHEDULED_QUERIES_SCRIPT)
+            update(keys=[self.KEY_NAME, self.CHANGES_KEY_NAME], args=args)
+
+    def rebuild(self, next_runs, version):
+        """Replace the index with the next runs of all scheduled queries, as read from the database after
+        `version`."""
+        rebuild_key = self.REBUILD_KEY_PREFIX + generate_token(10)
+        items = list(next_runs.items())
+        pipe = redis_connection.pipeline()
+        for start in range(0, len(items), self.rebuild_batch_size):
+            pipe.zadd(rebuild_key, dict(items[start : start + self.rebuild_batch_size]))
+            # In case the rebuild never finishes.
+            pipe.expire(rebuild_key, settings.SCHEDULED_QUERIES_INDEX_REBUILD_INTERVAL)
+        pipe.execute()
+
+        replace = redis_connection.register_script(REPLACE_SCHEDULED_QUERIES_INDEX_SCRIPT)
+        replace(
+            keys=[self.KEY_NAME, self.CHANGES_KEY_NAME, rebuild_key, self.BUILT_KEY_NAME],
+            args=[version, time.time(), settings.SCHEDULED_QUERIES_INDEX_REBUILD_INTERVAL],
+        )
+
+
+scheduled_queries_index = ScheduledQueriesIndex()
+
+
 @generic_repr("id", "name", "type", "org_id", "created_at")
 class DataSource(BelongsToOrgMixin, db.Model):
     id = primary_key("DataSource")
@@ -195,17 +345,66 @@ class DataSource(BelongsToOrgMixin, db.Model):
 
     def delete(self):
         Query.query.filter(Query.data_source == self).update(dict(data_source_id=None, latest_query_data_id=None))
-        QueryResult.query.filter(QueryResult.data_source == self).delete()
+        query_results = QueryResult.query.filter(QueryResult.data_source == self)
+        blobs = QueryResult.blob_references(query_results)
+        query_results.delete()
         res = db.session.delete(self)
         db.session.commit()
 
-        redis_connection.delete(self._schema_key)
+        redis_connection.delete(self._schema_key, *self._schema_keys.values())
+        delete_blobs(blobs)
 
         return res
 
-    def get_cached_schema(self):
-        cache = redis_connection.get(self._schema_key)
-        return json_loads(cache) if cache else None
+    def get_cached_schema(self, prefix=None):
+        """Return the cached schema, or only its tables whose name starts with `prefix`. Returns None if the
+        schema isn't cached."""
+        if prefix:
+            result = self.search_cached_schema(prefix, prefix=True)
+            return None if result is None else self.get_cached_schema_tables(result[0])
+
+        if not redis_connection.exists(self._schema_keys["digest"]):
+            return None
+
+        tables = redis_connection.hgetall(self._schema_keys["tables"])
+        return [json_loads(table) for _, table in sorted(tables.items())]
+
+    def get_cached_schema_tables(self, names):
+        """Return the cached tables with the given names, or None if the schema isn't cached."""
+        if not redis_connection.exists(self._schema_keys["digest"]):
+            return None
+
+        tables = redis_connection.hmget(self._schema_keys["tables"], names) if names else []
+        return [json_loads(table) for table in tables if table is not None]
+
+    def search_cached_schema(self, term="", prefix=False, offset=0, limit=None):
+        """Return the names of the cached tables whose name contains `term` (or starts with it, when `prefix`
+        is true), ignoring case, and how many there are. Names are sorted by their lower case form and only
+        `[offset, offset + limit)` of them are returned. Returns None if the schema isn't cached.
+
+        Both searches run in Redis, on the set of lower case names stored along with the schema.
+        """
+        keys = self._schema_keys
+        if not redis_connection.exists(keys["digest"]):
+            return None
+
+        if prefix or not term:
+            # No UTF-8 encoded name has a 0xff byte, so this is the range of all names starting with term.
+            start = b"[" + term.lower().encode("utf-8")
+            end = start + b"\xff"
+            total = redis_connection.zlexcount(keys["names"], start, end)
+            members = redis_connection.zrangebylex(
+                keys["names"], start, end, start=offset, num=-1 if limit is None else limit
+            )
+        else:
+            pattern = "*{}*\t*".format(re.sub(r"([\\*?\[\]])", r"\\\1", term.lower()))
+            members = sorted(
+                member for member, _ in redis_connection.zscan_iter(keys["names"], match=pattern, count=1000)
+            )
+            total = len(members)
+            members = members[offset : None if limit is None else offset + limit]
+
+        return [member.split("\t", 1)[1] for member in members], total
 
     def get_schema(self, refresh=False):
         out_schema = None
@@ -222,11 +421,56 @@ class DataSource(BelongsToOrgMixin, db.Model):
                 logging.exception("Error sorting schema columns for data_source {}".format(self.id))
                 out_schema = schema
             finally:
-                ttl = int(datetime.timedelta(minutes=settings.SCHEMAS_REFRESH_SCHEDULE, days=7).total_seconds())
-                redis_connection.set(self._schema_key, json_dumps(out_schema), ex=ttl)
+                self._store_schema(out_schema)
 
         return out_schema
 
+    def _store_schema(self, schema):
+        """Cache the schema, one hash field per table, writing only the tables that changed since the last
+        refresh. Returns whether anything changed."""
+        if not isinstance(schema, list) or not all(isinstance(table, dict) and "name" in table for table in schema):
+            logging.warning("Not caching the schema of data_source %s, as it has tables without a name.", self.id)
+            return False
+
+        keys = self._schema_keys
+        ttl = int(datetime.timedelta(minutes=settings.SCHEMAS_REFRESH_SCHEDULE, days=7).total_seconds())
+        tables = {str(table["name"]): json_dumps(table) for table in schema}
+        digests = {name: hashlib.sha1(table.encode("utf-8")).hexdigest() for name, table in tables.items()}
+        digest = hashlib.sha1(json_dumps(sorted(digests.items())).encode("utf-8")).hexdigest()
+
+        if redis_connection.get(keys["digest"]) == digest:
+            pipe = redis_connection.pipeline()
+            for key in keys.values():
+                pipe.expire(key, ttl)
+            pipe.execute()
+            return False
+
+        stored_digests = redis_connection.hgetall(keys["digests"])
+        changed = [name for name, table_digest in digests.items() if stored_digests.get(name) != table_digest]
+        removed = [name for name in stored_digests if name not in tables]
+
+        pipe = redis_connection.pipeline()
+        # Schemas used to be cached as a single JSON value.
+        pipe.delete(self._schema_key)
+        if removed:
+            pipe.hdel(keys["tables"], *removed)
+            pipe.hdel(keys["digests"], *removed)
+            pipe.zrem(keys["names"], *[self._schema_search_member(name) for name in removed])
+        if changed:
+            pipe.hset(keys["tables"], mapping={name: tables[name] for name in changed})
+            pipe.hset(keys["digests"], mapping={name: digests[name] for name in changed})
+            pipe.zadd(keys["names"], {self._schema_search_member(name): 0 for name in changed})
+        pipe.set(keys["digest"], digest)
+        for key in keys.values():
+            pipe.expire(key, ttl)
+        pipe.execute()
+
+        return True
+
+    @staticmethod
+    def _schema_search_member(name):
+        return "{}\t{}".format(name.lower(), name)
+
     def _sort_schema(self, schema):
         return [
             {**i, "columns": sorted(i["columns"], key=lambda x: x["name"] if isinstance(x, dict) else x)}
@@ -237,6 +481,15 @@ class DataSource(BelongsToOrgMixin, db.Model):
     def _schema_key(self):
         return "data_source:schema:{}".format(self.id)
 
+    @property
+    def _schema_keys(self):
+        return {
+            "digest": "{}:digest".format(self._schema_key),
+            "tables": "{}:tables".format(self._schema_key),
+            "digests": "{}:digests".format(self._schema_key),
+            "names": "{}:names".format(self._schema_key),
+        }
+
     @property
     def _pause_key(self):
         return "ds:{}:pause".format(self.id)
@@ -317,26 +570,66 @@ class QueryResult(db.Model, BelongsToOrgMixin):
     data_source = db.relationship(DataSource, backref=backref("query_results"))
     query_hash = Column(db.String(32), index=True)
     query_text = Column("query", db.Text)
-    data = Column(JSONText, nullable=True)
+    # Deferred, so loading a result's metadata (or joining it from Query) doesn't fetch its payload.
+    data = deferred(Column(QueryResultData, nullable=True))
     runtime = Column(DOUBLE_PRECISION)
     retrieved_at = Column(db.DateTime(True))
+    # The size in bytes of the encoded payload and the row count, as of when the result was stored.
+    data_size = Column(db.BigInteger, nullable=True)
+    row_count = Column(db.Integer, nullable=True)
 
     __tablename__ = "query_results"
 
     def __str__(self):
         return "%d | %s | %s" % (self.id, self.query_hash, self.retrieved_at)
 
-    def to_dict(self):
-        return {
+    def to_dict(self, with_data=True):
+        d = {
             "id": self.id,
             "query_hash": self.query_hash,
             "query": self.query_text,
-            "data": self.data,
             "data_source_id": self.data_source_id,
             "runtime": self.runtime,
             "retrieved_at": self.retrieved_at,
         }
 
+        if with_data:
+            d["data"] = self.data
+
+        return d
+
+    def get_data_window(self, offset=0, limit=None, columns=None):
+        """Return rows `[offset, offset + limit)` of the result, with only the given columns, and its
+        total row count. Reads the stored payload directly, so codecs that support it only decode the
+        requested part of the result."""
+        raw_data = type_coerce(QueryResult.data, db.Text)
+        value = db.session.query(raw_data).filter(QueryResult.id == self.id).scalar()
+        if value is None:
+            return None, 0
+
+        return decode_result_window(value, offset, limit, columns)
+
+    def decodes_windows(self):
+        """Whether `get_data_window` decodes only the requested part of the result, rather than all of it."""
+        # The codec name is at the beginning of the stored payload.
+        raw_data = func.substr(type_coerce(QueryResult.data, db.Text), 1, 64)
+        prefix = db.session.query(raw_data).filter(QueryResult.id == self.id).scalar()
+        return prefix is not None and decodes_windows(prefix)
+
+    def iter_rows(self):
+        """Return the columns of the result and an iterator over its rows, which decodes the stored payload as
+        it goes (where its codec supports it) instead of loading the whole result."""
+        if self.id is None:
+            data = self.data or {}
+            return data.get("columns") or [], iter(data.get("rows") or [])
+
+        raw_data = type_coerce(QueryResult.data, db.Text)
+        value = db.session.query(raw_data).filter(QueryResult.id == self.id).scalar()
+        if value is None:
+            return [], iter(())
+
+        return decode_result_rows(value)
+
     @classmethod
     def unused(cls, days=7):
         age_threshold = datetime.datetime.now() - datetime.timedelta(days=days)
@@ -344,6 +637,14 @@ class QueryResult(db.Model, BelongsToOrgMixin):
             load_only("id")
         )
 
+    @classmethod
+    def blob_references(cls, query):
+        """Return the `(store, key)` of the offloaded payloads of the query results matched by `query`."""
+        raw_data = type_coerce(cls.data, db.Text)
+        values = query.filter(raw_data.startswith(BLOB_REFERENCE_PREFIX)).with_entities(raw_data)
+        references = [blob_reference(value) for (value,) in values]
+        return [(reference["store"], reference["key"]) for reference in references]
+
     @classmethod
     def get_latest(cls, data_source, query, max_age=0):
         query_hash = gen_query_hash(query)
@@ -367,6 +668,12 @@ class QueryResult(db.Model, BelongsToOrgMixin):
 
     @classmethod
     def store_result(cls, org, data_source, query_hash, query, data, run_time, retrieved_at):
+        if isinstance(data, dict):
+            data = EncodedResult(data)
+            if data.blob is not None:
+                # Deleted unless the result is committed (see receive_after_transaction_end).
+                db.session.info.setdefault("offloaded_blobs", []).append(data.blob)
+
         query_result = cls(
             org_id=org,
             query_hash=query_hash,
@@ -375,6 +682,8 @@ class QueryResult(db.Model, BelongsToOrgMixin):
             data_source=data_source,
             retrieved_at=retrieved_at,
             data=data,
+            data_size=getattr(data, "size", None),
+            row_count=getattr(data, "row_count", None),
         )
 
         db.session.add(query_result)
@@ -387,11 +696,11 @@ class QueryResult(db.Model, BelongsToOrgMixin):
         return self.data_source.groups
 
 
-def should_schedule_next(previous_iteration, now, interval, time=None, day_of_week=None, failures=0):
-    # if previous_iteration is None, it means the query has never been run before
-    # so we should schedule it immediately
-    if previous_iteration is None:
-        return True
+def next_iteration(previous_iteration, interval, time=None, day_of_week=None, failures=0):
+    """Return when a schedule that last ran at `previous_iteration` is due next.
+
+    Raises OverflowError when the schedule failed so many times that it's never due again.
+    """
     # if time exists then interval > 23 hours (82800s)
     # if day_of_week exists then interval > 6 days (518400s)
     if time is None:
@@ -420,11 +729,19 @@ def should_schedule_next(previous_iteration, now, interval, time=None, day_of_we
             previous_iteration + datetime.timedelta(days=days_delay) + datetime.timedelta(days=days_to_add)
         ).replace(hour=hour, minute=minute)
     if failures:
-        try:
-            next_iteration += datetime.timedelta(minutes=2**failures)
-        except OverflowError:
-            return False
-    return now > next_iteration
+        next_iteration += datetime.timedelta(minutes=2**failures)
+    return next_iteration
+
+
+def should_schedule_next(previous_iteration, now, interval, time=None, day_of_week=None, failures=0):
+    # if previous_iteration is None, it means the query has never been run before
+    # so we should schedule it immediately
+    if previous_iteration is None:
+        return True
+    try:
+        return now > next_iteration(previous_iteration, interval, time, day_of_week, failures)
+    except OverflowError:
+        return False
 
 
 @gfk_type
@@ -591,16 +908,22 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
 
     @classmethod
     def outdated_queries(cls):
-        queries = (
-            Query.query.options(joinedload(Query.latest_query_data).load_only("retrieved_at"))
-            .filter(func.jsonb_typeof(Query.schedule) != "null")
-            .order_by(Query.id)
-            .all()
+        now = utils.utcnow()
+        version = scheduled_queries_index.version()
+        due_ids = scheduled_queries_index.due(now)
+        if due_ids == []:
+            return []
+
+        queries = Query.query.options(joinedload(Query.latest_query_data).load_only("retrieved_at", "runtime")).filter(
+            func.jsonb_typeof(Query.schedule) != "null"
         )
+        if due_ids is not None:
+            queries = queries.filter(Query.id.in_(due_ids))
+        queries = queries.order_by(Query.id).all()
 
-        now = utils.utcnow()
         outdated_queries = {}
-        scheduled_queries_executions.refresh()
+        next_runs = {}
+        scheduled_queries_executions.refresh(due_ids)
 
         for query in queries:
             try:
@@ -632,6 +955,18 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
                 ):
                     key = "{}:{}".format(query.query_hash, query.data_source_id)
                     outdated_queries[key] = query
+                    next_runs[query.id] = 0
+                else:
+                    try:
+                        next_runs[query.id] = next_iteration(
+                            retrieved_at,
+                            query.schedule["interval"],
+                            query.schedule["time"],
+                            query.schedule["day_of_week"],
+                            query.schedule_failures,
+                        ).timestamp()
+                    except OverflowError:
+                        next_runs[query.id] = float("inf")
             except Exception as e:
                 query.schedule["disabled"] = True
                 db.session.commit()
@@ -643,6 +978,11 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
                 logging.info(message)
                 sentry.capture_exception(type(e)(message).with_traceback(e.__traceback__))
 
+        if due_ids is None:
+            scheduled_queries_index.rebuild(next_runs, version)
+        else:
+            scheduled_queries_index.update(next_runs, due_ids, version)
+
         return list(outdated_queries.values())
 
     @classmethod
@@ -891,6 +1231,36 @@ def receive_before_insert_update(mapper, connection, target):
     target.update_query_hash()
 
 
+@listens_for(Query, "after_insert")
+@listens_for(Query, "after_update")
+def receive_after_insert_update(mapper, connection, target):
+    # Have the scheduler check the query again, as its schedule or latest result may have changed. It's checked
+    # again once the change is committed, in case a refresh read the query in the meantime.
+    if target.schedule is not None or get_history(target, "schedule").deleted:
+        scheduled_queries_index.invalidate(target.id)
+        object_session(target).info.setdefault("changed_scheduled_queries", set()).add(target.id)
+
+
+@listens_for(db.session, "after_commit")
+def receive_after_commit(session):
+    for query_id in session.info.pop("changed_scheduled_queries", ()):
+        scheduled_queries_index.invalidate(query_id)
+    # The results the blobs were offloaded for are stored now.
+    session.info.pop("offloaded_blobs", None)
+
+
+@listens_for(db.session, "after_rollback")
+def receive_after_rollback(session):
+    session.info.pop("changed_scheduled_queries", None)
+
+
+@listens_for(db.session, "after_transaction_end")
+def receive_after_transaction_end(session, transaction):
+    # Delete the blobs of results that were never committed, as cleanup_query_results would never find them.
+    if transaction.parent is None:
+        delete_blobs(session.info.pop("offloaded_blobs", ()))
+
+
 @listens_for(Query.user_id, "set")
 def query_last_modified_by(target, val, oldval, initiator):
     target.last_modified_by_id = val
@@ -0,0 +1,437 @@
+"""
+Storage codecs for `QueryResult.data`.
+
+Results used to be stored only as row-oriented JSON, where every row repeats every
+column name. A codec can store them in a different layout; encoded values are
+prefixed with `CODEC_PREFIX` and the codec name, so rows written before the codec
+was configured (plain JSON) keep loading as before.
+"""
+
+import base64
+import functools
+import io
+import logging
+import zlib
+
+from redash import settings
+from redash.models.result_stores import (
+    default_result_store,
+    generate_blob_key,
+    get_result_store,
+)
+from redash.utils import json_dumps, json_loads
+
+try:
+    import zstandard
+
+    zstd_enabled = True
+except ImportError:
+    zstd_enabled = False
+
+try:
+    import lz4.frame
+
+    lz4_enabled = True
+except ImportError:
+    lz4_enabled = False
+
+try:
+    import ijson
+
+    ijson_enabled = True
+except ImportError:
+    ijson_enabled = False
+
+logger = logging.getLogger(__name__)
+
+CODEC_PREFIX = "redash-codec:"
+
+
+class ResultCodecError(Exception):
+    pass
+
+
+class JSONCodec:
+    """The legacy format: the result dict serialized as is."""
+
+    name = "json"
+    # Whether a window of the result (e.g. its columns) is decoded without decoding all of it.
+    decodes_windows = False
+
+    @classmethod
+    def enabled(cls):
+        return True
+
+    def encode(self, data):
+        return json_dumps(data)
+
+    def decode(self, value):
+        return json_loads(value)
+
+    def decode_window(self, value, offset=0, limit=None, columns=None):
+        data = self.decode(value)
+        row_count = len(data.get("rows") or []) if isinstance(data, dict) else 0
+        return window(data, offset, limit, columns), row_count
+
+    def iter_rows(self, value):
+        if not ijson_enabled:
+            data = self.decode(value)
+            if not isinstance(data, dict):
+                return [], iter(())
+            return data.get("columns") or [], iter(data.get("rows") or [])
+
+        # Parse the rows one at a time with ijson, instead of building the whole result.
+        payload = value.encode("utf-8")
+        columns = next(ijson.items(io.BytesIO(payload), "columns", use_float=True), None)
+        return columns or [], ijson.items(io.BytesIO(payload), "rows.item", use_float=True)
+
+
+def to_columnar(data):
+    """Convert a `{"columns": [...], "rows": [...]}` result into a column-oriented layout.
+
+    Returns None when the result can't be represented without loss, e.g. rows with keys that
+    aren't listed in `columns` or with missing values.
+    """
+    if not isinstance(data, dict):
+        return None
+    if not isinstance(data.get("columns"), list) or not isinstance(data.get("rows"), list):
+        return None
+
+    names = [column.get("name") for column in data["columns"]]
+    if len(set(names)) != len(names):
+        return None
+
+    values = [[] for _ in names]
+    for row in data["rows"]:
+        if not isinstance(row, dict) or len(row) != len(names):
+            return None
+        try:
+            for column_values, name in zip(values, names):
+                column_values.append(row[name])
+        except KeyError:
+            return None
+
+    return {
+        "columns": data["columns"],
+        "row_count": len(data["rows"]),
+        "values": values,
+        "extra": {k: v for k, v in data.items() if k not in ("columns", "rows")},
+    }
+
+
+def window(data, offset=0, limit=None, columns=None):
+    """Return rows `[offset, offset + limit)` of a decoded result, keeping only the given columns."""
+    if not isinstance(data, dict):
+        return data
+
+    rows = (data.get("rows") or [])[offset : None if limit is None else offset + limit]
+    result_columns = data.get("columns") or []
+
+    if columns is not None:
+        result_columns = [column for column in result_columns if column["name"] in columns]
+        names = [column["name"] for column in result_columns]
+        rows = [{name: row[name] for name in names if name in row} for row in rows]
+
+    return {**data, "columns": result_columns, "rows": rows}
+
+
+class ColumnarCodec:
+    """Stores the values of each column together, so column names (and their types) are
+    stored once per result instead of once per row, and compresses the payload.
+
+    The values of each column are split in blocks of `QUERY_RESULTS_COLUMNAR_BLOCK_SIZE` rows,
+    compressed separately, so a window of rows or a subset of the columns can be read without
+    decoding the rest of the result. The encoded value is a header (columns, row count and the
+    length of every block) followed by the blocks, ordered by column and then by row.
+    """
+
+    name = "columnar"
+    decodes_windows = True
+
+    @classmethod
+    def enabled(cls):
+        return True
+
+    def compress(self, payload):
+        return zlib.compress(payload)
+
+    def decompress(self, payload):
+        return zlib.decompress(payload)
+
+    def _encode_segment(self, value):
+        return base64.b64encode(self.compress(json_dumps(value).encode("utf-8"))).decode("ascii")
+
+    def _decode_segment(self, segment):
+        return json_loads(self.decompress(base64.b64decode(segment)))
+
+    def encode(self, data):
+        layout = to_columnar(data)
+        if layout is None:
+            return None
+
+        block_size = settings.QUERY_RESULTS_COLUMNAR_BLOCK_SIZE
+        blocks = [
+            self._encode_segment(column_values[start : start + block_size])
+            for column_values in layout["values"]
+            for start in range(0, layout["row_count"], block_size)
+        ]
+        header = {
+            "columns": layout["columns"],
+            "row_count": layout["row_count"],
+            "extra": layout["extra"],
+            "block_size": block_size,
+            "blocks": [len(block) for block in blocks],
+        }
+
+        return "{}.{}".format(self._encode_segment(header), "".join(blocks))
+
+    def _decode_header(self, value):
+        """Return the header of an encoded value, and where each of its blocks starts (and the last one ends)."""
+        header_end = value.index(".")
+        header = self._decode_segment(value[:header_end])
+
+        block_offsets = [header_end + 1]
+        for length in header["blocks"]:
+            block_offsets.append(block_offsets[-1] + length)
+
+        return header, block_offsets
+
+    def decode_window(self, value, offset=0, limit=None, columns=None):
+        header, block_offsets = self._decode_header(value)
+
+        row_count = header["row_count"]
+        block_size = header["block_size"]
+        blocks_per_column = -(-row_count // block_size)
+        start = min(offset, row_count)
+        end = row_count if limit is None else min(offset + limit, row_count)
+
+        selected = [
+            (i, column) for i, column in enumerate(header["columns"]) if columns is None or column["name"] in columns
+        ]
+        values = []
+        for i, _ in selected:
+            column_values = []
+            for block in range(start // block_size, -(-end // block_size)):
+                n = i * blocks_per_column + block
+                column_values.extend(self._decode_segment(value[block_offsets[n] : block_offsets[n + 1]]))
+
+            first = start - (start // block_size) * block_size
+            values.append(column_values[first : first + end - start])
+
+        names = [column["name"] for _, column in selected]
+        rows = [dict(zip(names, row)) for row in zip(*values)] if selected else [{} for _ in range(start, end)]
+        data = {"columns": [column for _, column in selected], "rows": rows, **header["extra"]}
+
+        return data, row_count
+
+    def decode(self, value):
+        return self.decode_window(value)[0]
+
+    def iter_rows(self, value):
+        header, block_offsets = self._decode_header(value)
+        return header["columns"], self._iter_rows(value, header, block_offsets)
+
+    def _iter_rows(self, value, header, block_offsets):
+        names = [column["name"] for column in header["columns"]]
+        if not names:
+            yield from ({} for _ in range(header["row_count"]))
+            return
+
+        # Only one block of rows is decoded at a time.
+        blocks_per_column = -(-header["row_count"] // header["block_size"])
+        for block in range(blocks_per_column):
+            values = [
+                self._decode_segment(value[block_offsets[n] : block_offsets[n + 1]])
+                for n in range(block, len(names) * blocks_per_column, blocks_per_column)
+            ]
+            for row in zip(*values):
+                yield dict(zip(names, row))
+
+
+class ZstdColumnarCodec(ColumnarCodec):
+    name = "columnar+zstd"
+
+    @classmethod
+    def enabled(cls):
+        return zstd_enabled
+
+    def compress(self, payload):
+        return zstandard.ZstdCompressor().compress(payload)
+
+    def decompress(self, payload):
+        return zstandard.ZstdDecompressor().decompress(payload)
+
+
+class LZ4ColumnarCodec(ColumnarCodec):
+    name = "columnar+lz4"
+
+    @classmethod
+    def enabled(cls):
+        return lz4_enabled
+
+    def compress(self, payload):
+        return lz4.frame.compress(payload)
+
+    def decompress(self, payload):
+        return lz4.frame.decompress(payload)
+
+
+class BlobReferenceCodec:
+    """A reference to an encoded result kept in a blob store. Besides the location of the blob,
+    the reference keeps the row count and columns of the result."""
+
+    name = "blob"
+    decodes_windows = True
+
+    @classmethod
+    def enabled(cls):
+        return True
+
+    def decode_reference(self, value):
+        return json_loads(value)
+
+    def decode(self, value):
+        reference = self.decode_reference(value)
+        return decode_result(get_result_store(reference["store"]).get(reference["key"]))
+
+    def decode_window(self, value, offset=0, limit=None, columns=None):
+        reference = self.decode_reference(value)
+        if limit == 0 and reference["columns"] is not None:
+            # Only the columns and row count were asked for, which the reference holds.
+            data = window({"columns": reference["columns"], "rows": []}, columns=columns)
+            return data, reference["row_count"]
+
+        blob = get_result_store(reference["store"]).get(reference["key"])
+        return decode_result_window(blob, offset, limit, columns)
+
+    def iter_rows(self, value):
+        reference = self.decode_reference(value)
+        return decode_result_rows(get_result_store(reference["store"]).get(reference["key"]))
+
+
+result_codecs = {
+    codec.name: codec()
+    for codec in (JSONCodec, ColumnarCodec, ZstdColumnarCodec, LZ4ColumnarCodec, BlobReferenceCodec)
+}
+
+
+def get_codec(name):
+    codec = result_codecs.get(name)
+    if codec is None or not codec.enabled():
+        raise ResultCodecError("Query results storage codec {} is not available.".format(name))
+
+    return codec
+
+
+@functools.lru_cache(maxsize=None)
+def _storage_codec(name):
+    try:
+        return get_codec(name)
+    except ResultCodecError:
+        logger.warning("Query results storage codec %s is not available, falling back to json.", name)
+        return result_codecs[JSONCodec.name]
+
+
+def default_codec():
+    return _storage_codec(settings.QUERY_RESULTS_STORAGE_CODEC)
+
+
+# Resolve the configured codec on startup, so an unavailable one is reported once instead of on every write.
+default_codec()
+
+
+def split_encoded(value):
+    """Return the codec name and payload of a stored value."""
+    if value.startswith(CODEC_PREFIX):
+        name, _, payload = value[len(CODEC_PREFIX) :].partition(":")
+        return name, payload
+
+    return JSONCodec.name, value
+
+
+def decodes_windows(value):
+    """Whether a stored value, or just its beginning, is decoded a window at a time (see `decode_result_window`)."""
+    codec = result_codecs.get(split_encoded(value)[0])
+    return codec is not None and codec.decodes_windows
+
+
+BLOB_REFERENCE_PREFIX = "{}{}:".format(CODEC_PREFIX, BlobReferenceCodec.name)
+
+
+def blob_reference(value):
+    """Return the blob reference of a stored value, or None if the result is stored inline."""
+    name, payload = split_encoded(value)
+    if name != BlobReferenceCodec.name:
+        return None
+
+    return result_codecs[name].decode_reference(payload)
+
+
+def _offload(store, data, encoded):
+    key = generate_blob_key()
+    store.put(key, encoded)
+
+    reference = {
+        "store": store.name,
+        "key": key,
+        "row_count": len(data.get("rows") or []) if isinstance(data, dict) else None,
+        "columns": data.get("columns") if isinstance(data, dict) else None,
+    }
+    return BLOB_REFERENCE_PREFIX + json_dumps(reference), (store.name, key)
+
+
+class EncodedResult(dict):
+    """A result along with its encoded value, so it's encoded once when it's stored, with the size in bytes of
+    the encoded payload (before it's offloaded to a blob store), the row count of the result and the `(store
+    name, key)` of the blob it was offloaded to, if it was."""
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.encoded, self.size, self.blob = _encode(data, offload=True)
+        self.row_count = len(data["rows"]) if isinstance(data.get("rows"), list) else None
+
+
+def _encode(data, offload):
+    codec = default_codec()
+    encoded = codec.encode(data)
+
+    if encoded is None:
+        encoded = result_codecs[JSONCodec.name].encode(data)
+    elif codec.name != JSONCodec.name:
+        encoded = "{}{}:{}".format(CODEC_PREFIX, codec.name, encoded)
+
+    size = len(encoded) if encoded.isascii() else len(encoded.encode("utf-8"))
+    blob = None
+    store = default_result_store() if offload else None
+    if store is not None and size > settings.QUERY_RESULTS_BLOB_STORE_THRESHOLD:
+        encoded, blob = _offload(store, data, encoded)
+
+    return encoded, size, blob
+
+
+def encode_result(data):
+    """Encode a result to store it. Only `EncodedResult`s (see `QueryResult.store_result`, which keeps track
+    of their blobs) are offloaded to a blob store; other results are stored inline."""
+    if isinstance(data, EncodedResult):
+        return data.encoded
+
+    return _encode(data, offload=False)[0]
+
+
+def decode_result(value):
+    name, payload = split_encoded(value)
+    return get_codec(name).decode(payload)
+
+
+def decode_result_window(value, offset=0, limit=None, columns=None):
+    """Decode rows `[offset, offset + limit)` of a stored result, keeping only the given columns.
+    Returns the decoded window and the total row count of the result."""
+    name, payload = split_encoded(value)
+    return get_codec(name).decode_window(payload, offset, limit, columns)
+
+
+def decode_result_rows(value):
+    """Return the columns of a stored result and an iterator over its rows, which decodes them as it
+    goes where the codec supports it."""
+    name, payload = split_encoded(value)
+    return get_codec(name).iter_rows(payload)
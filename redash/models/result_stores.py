@@ -0,0 +1,118 @@
+"""
+Blob stores for large query results.
+
+Encoded results bigger than `QUERY_RESULTS_BLOB_STORE_THRESHOLD` bytes are written to
+the configured store and `query_results.data` only keeps a small reference to them (see
+`redash.models.result_codecs.BlobReferenceCodec`).
+"""
+
+import logging
+import os
+import uuid
+
+from redash import settings
+
+try:
+    import boto3
+
+    s3_enabled = True
+except ImportError:
+    s3_enabled = False
+
+logger = logging.getLogger(__name__)
+
+
+class ResultStoreError(Exception):
+    pass
+
+
+class FileSystemResultStore:
+    name = "filesystem"
+
+    @classmethod
+    def enabled(cls):
+        return True
+
+    def __init__(self):
+        self.path = settings.QUERY_RESULTS_BLOB_STORE_PATH
+
+    def _path(self, key):
+        path = os.path.abspath(os.path.join(self.path, key))
+        if not path.startswith(os.path.abspath(self.path) + os.sep):
+            raise ResultStoreError("Invalid query result blob key: {}".format(key))
+
+        return path
+
+    def put(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(value)
+
+    def get(self, key):
+        with open(self._path(key), encoding="utf-8") as f:
+            return f.read()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+
+class S3ResultStore:
+    """Any S3 compatible store; set `QUERY_RESULTS_BLOB_STORE_S3_ENDPOINT_URL` to use e.g. MinIO.
+    Credentials are resolved by boto3 as usual (environment, instance profile, etc.)."""
+
+    name = "s3"
+
+    @classmethod
+    def enabled(cls):
+        return s3_enabled
+
+    def __init__(self):
+        self.bucket = settings.QUERY_RESULTS_BLOB_STORE_S3_BUCKET
+        self.client = boto3.client("s3", endpoint_url=settings.QUERY_RESULTS_BLOB_STORE_S3_ENDPOINT_URL or None)
+
+    def put(self, key, value):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=value.encode("utf-8"))
+
+    def get(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"].read().decode("utf-8")
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+
+result_stores = {store.name: store for store in (FileSystemResultStore, S3ResultStore)}
+_instances = {}
+
+
+def get_result_store(name):
+    if name not in _instances:
+        store = result_stores.get(name)
+        if store is None or not store.enabled():
+            raise ResultStoreError("Query results blob store {} is not available.".format(name))
+        _instances[name] = store()
+
+    return _instances[name]
+
+
+def default_result_store():
+    if not settings.QUERY_RESULTS_BLOB_STORE:
+        return None
+
+    return get_result_store(settings.QUERY_RESULTS_BLOB_STORE)
+
+
+def generate_blob_key():
+    return "{}{}".format(settings.QUERY_RESULTS_BLOB_STORE_PREFIX, uuid.uuid4().hex)
+
+
+def delete_blobs(references):
+    """Delete the blobs of the given `(store name, key)` pairs, logging (and skipping) failures."""
+    for store_name, key in references:
+        try:
+            get_result_store(store_name).delete(key)
+        except Exception:
+            logger.warning("Failed deleting query result blob %s from %s.", key, store_name, exc_info=1)
@@ -7,6 +7,7 @@ from redash.utils import json_dumps, json_loads
 from redash.utils.configuration import ConfigurationContainer
 
 from .base import db
+from .result_codecs import decode_result, encode_result
 
 
 class Configuration(TypeDecorator):
@@ -45,6 +46,21 @@ class JSONText(TypeDecorator):
         return json_loads(value)
 
 
+class QueryResultData(JSONText):
+    """JSONText that encodes values with the configured query results storage codec."""
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return value
+
+        return encode_result(value)
+
+    def process_result_value(self, value, dialect):
+        if not value:
+            return value
+        return decode_result(value)
+
+
 class MutableDict(Mutable, dict):
     @classmethod
     def coerce(cls, key, value):
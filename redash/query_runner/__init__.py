@@ -1,6 +1,14 @@
+import datetime
+import decimal
+import hashlib
+import itertools
 import logging
-from collections import defaultdict
-from contextlib import ExitStack
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import ExitStack, contextmanager
 from functools import wraps
 
 import sqlparse
@@ -23,6 +31,7 @@ __all__ = [
     "InterruptException",
     "JobTimeoutException",
     "BaseSQLQueryRunner",
+    "ResultBuilder",
     "TYPE_DATETIME",
     "TYPE_BOOLEAN",
     "TYPE_INTEGER",
@@ -34,6 +43,7 @@ __all__ = [
     "get_query_runner",
     "import_query_runners",
     "guess_type",
+    "guess_column_type",
 ]
 
 # Valid types of columns returned in results:
@@ -113,6 +123,274 @@ class NotSupported(Exception):
     pass
 
 
+_UNRESOLVED = object()
+
+
+def _value_size(value):
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return 8
+
+
+class ResultBuilder:
+    """
+    Collects the result of a query as the query runner fetches it, in batches of rows (tuples in the order of
+    the columns), and builds the `{"columns": [...], "rows": [...]}` result once it's done.
+
+    It keeps the approximate size of the values it got (estimated from a sample of the rows of each batch), and
+    stops taking rows once the result has `max_rows` rows or `max_bytes` bytes (QUERY_RESULTS_MAX_ROWS and
+    QUERY_RESULTS_MAX_BYTES by default, 0 means no limit), marking the result as truncated, so a runaway query
+    can't take all of the work horse's memory. Values of
+    types that get converted when the result is serialized (like decimals) are converted once, with a converter
+    picked per column.
+
+    Query runners that fetch their results in batches implement `run_query_into` to add them to the builder;
+    the results of the others are added at once with `add_result`.
+    """
+
+    converters = {decimal.Decimal: float, uuid.UUID: str, datetime.timedelta: str}
+    # How many rows of a batch its size is estimated from.
+    size_sample_rows = 100
+
+    def __init__(self, max_rows=None, max_bytes=None):
+        max_rows = settings.QUERY_RESULTS_MAX_ROWS if max_rows is None else max_rows
+        max_bytes = settings.QUERY_RESULTS_MAX_BYTES if max_bytes is None else max_bytes
+        self.max_rows = max_rows or float("inf")
+        self.max_bytes = max_bytes or float("inf")
+        self.columns = None
+        self.rows = []
+        self.row_count = 0
+        self.size = 0
+        self.truncated = False
+        self.extra = {}
+        self._data = None
+        self._names = None
+        self._converters = None
+
+    def set_columns(self, columns):
+        self.columns = columns
+        self._names = [column["name"] for column in columns]
+
+    def _convert(self, rows):
+        if self._converters is None:
+            self._converters = [_UNRESOLVED] * len(self._names)
+
+        # A column's converter is picked by the type of its first value.
+        for i, converter in enumerate(self._converters):
+            if converter is _UNRESOLVED:
+                value = next((row[i] for row in rows if row[i] is not None), None)
+                if value is not None:
+                    self._converters[i] = (
+                        (type(value), self.converters[type(value)]) if type(value) in self.converters else None
+                    )
+
+        converters = [(i, c) for i, c in enumerate(self._converters) if c is not None and c is not _UNRESOLVED]
+        if not converters:
+            return rows
+
+        converted = []
+        for row in rows:
+            row = list(row)
+            for i, (value_type, converter) in converters:
+                if type(row[i]) is value_type:
+                    row[i] = converter(row[i])
+            converted.append(row)
+        return converted
+
+    def _take(self, rows, values_of):
+        if self.row_count + len(rows) > self.max_rows:
+            rows = rows[: int(self.max_rows - self.row_count)]
+            self.truncated = True
+
+        if rows and self.max_bytes != float("inf"):
+            # The size of a batch is estimated from a sample of its rows, rather than adding up every value.
+            sample = rows[:: max(len(rows) // self.size_sample_rows, 1)]
+            row_size = sum(_value_size(value) for row in sample for value in values_of(row)) / len(sample)
+            if self.size + row_size * len(rows) > self.max_bytes:
+                rows = rows[: int((self.max_bytes - self.size) // row_size)]
+                self.truncated = True
+            self.size += row_size * len(rows)
+
+        self.row_count += len(rows)
+        return rows
+
+    def add_rows(self, rows):
+        """Adds a batch of rows. Returns False once the result is full, after which rows are dropped."""
+        if self.truncated:
+            return False
+
+        rows = self._take(rows, lambda row: row)
+        self.rows.extend(self._convert(rows))
+        return not self.truncated
+
+    def add_records(self, rows):
+        """Adds a batch of rows that are dicts already, for query runners that only know the columns once they got
+        all of the rows (and set `columns` then). Returns False once the result is full."""
+        if self.truncated:
+            return False
+
+        self.rows.extend(self._take(rows, dict.values))
+        return not self.truncated
+
+    def add_result(self, data):
+        """Adds the whole result of a query runner that doesn't fetch it in batches."""
+        if not isinstance(data, dict) or not isinstance(data.get("rows"), list):
+            self._data = data
+            return
+
+        self.columns = data.get("columns")
+        self.extra = {key: value for key, value in data.items() if key not in ("columns", "rows")}
+        self.rows = self._take(data["rows"], lambda row: row.values() if isinstance(row, dict) else ())
+        self.truncated = self.truncated or bool(self.extra.get("truncated"))
+
+    def discard(self):
+        """Drops what was added so far, for query runners that fail after adding some of the rows."""
+        self.columns = None
+        self.rows = []
+        self.extra = {}
+        self._data = None
+
+    def build(self):
+        """Returns the result, or None when the query didn't return any."""
+        if self._data is not None:
+            return self._data
+        if self.columns is None:
+            return None
+
+        rows = self.rows
+        if self._names is not None:
+            names = self._names
+            rows = [dict(zip(names, row)) for row in rows]
+            self.rows = []
+
+        data = {"columns": self.columns, "rows": rows, **self.extra}
+        if self.truncated:
+            logger.warning("Query results truncated at %d rows (%d bytes).", self.row_count, self.size)
+            data["truncated"] = True
+        return data
+
+
+class ConnectionPool:
+    """
+    Keeps idle connections to a data source, so queries don't pay for connecting to it (and for the TLS
+    handshake) every time. Connections are health checked by the query runner before they're reused and
+    closed once they've been idle for longer than `max_idle` seconds. At most `max_size` idle connections
+    are kept.
+    """
+
+    def __init__(self, name, max_size, max_idle):
+        self.name = name
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self._idle = deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._idle)
+
+    def _incr(self, event):
+        # redash imports this module before it creates the statsd client.
+        from redash import statsd_client
+
+        statsd_client.incr("query_runner.connection_pool.{}.{}".format(self.name, event))
+
+    def _pop(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()[0]
+
+    def acquire(self, query_runner):
+        connection = self._pop()
+        while connection is not None:
+            if query_runner._is_connection_healthy(connection):
+                self._incr("hits")
+                return connection
+
+            self._incr("unhealthy")
+            query_runner._close_connection(connection)
+            connection = self._pop()
+
+        self._incr("misses")
+        return query_runner._connect()
+
+    def release(self, query_runner, connection):
+        try:
+            query_runner._reset_connection(connection)
+        except Exception:
+            logger.warning("Failed resetting connection, closing it.", exc_info=True)
+            query_runner._close_connection(connection)
+            return
+
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append((connection, time.time(), query_runner._close_connection))
+                return
+
+        query_runner._close_connection(connection)
+
+    def evict(self, now=None):
+        """Closes the connections that have been idle for longer than `max_idle` seconds."""
+        expired = []
+        deadline = (now or time.time()) - self.max_idle
+        with self._lock:
+            while self._idle and self._idle[0][1] < deadline:
+                expired.append(self._idle.popleft())
+
+        for connection, _, close in expired:
+            self._incr("evictions")
+            close(connection)
+
+
+# Connection pools of this process by (query runner type, hash of the data source's configuration), so changing the
+# options of a data source makes its queries use a new pool.
+connection_pools = {}
+_connection_pools_pid = None
+_connection_pools_lock = threading.Lock()
+
+
+def _configuration_hash(configuration):
+    if hasattr(configuration, "to_json"):
+        configuration_json = configuration.to_json()
+    else:
+        configuration_json = utils.json_dumps(configuration, sort_keys=True)
+
+    return hashlib.sha1(configuration_json.encode("utf-8")).hexdigest()
+
+
+def get_connection_pool(query_runner):
+    global _connection_pools_pid
+
+    key = (query_runner.type(), _configuration_hash(query_runner.configuration))
+
+    with _connection_pools_lock:
+        if _connection_pools_pid != os.getpid():
+            # Connections can't be shared with the process we were forked from.
+            connection_pools.clear()
+            _connection_pools_pid = os.getpid()
+
+        pool = connection_pools.get(key)
+        if pool is None:
+            pool = connection_pools[key] = ConnectionPool(
+                query_runner.type(),
+                settings.QUERY_RUNNER_CONNECTION_POOL_SIZE,
+                settings.QUERY_RUNNER_CONNECTION_POOL_MAX_IDLE,
+            )
+
+        pools = list(connection_pools.items())
+
+    now = time.time()
+    for pool_key, other_pool in pools:
+        other_pool.evict(now)
+
+        # Pools left behind when their data source's options changed end up empty and get dropped.
+        if pool_key != key and not other_pool:
+            with _connection_pools_lock:
+                if not other_pool:
+                    connection_pools.pop(pool_key, None)
+
+    return pool
+
+
 class BaseQueryRunner:
     deprecated = False
     should_annotate_query = True
@@ -120,6 +398,9 @@ class BaseQueryRunner:
     limit_query = " LIMIT 1000"
     limit_keywords = ["LIMIT", "OFFSET"]
     limit_after_select = False
+    # Query runners that implement `_connect` (and the other connection hooks, when the defaults don't fit) can set
+    # this to get their connections from a per data source pool with `pooled_connection()`.
+    pool_connections = False
 
     def __init__(self, configuration):
         self.syntax = "sql"
@@ -212,6 +493,69 @@ class BaseQueryRunner:
     def run_query(self, query, user):
         raise NotImplementedError()
 
+    def result_builder(self):
+        return ResultBuilder()
+
+    def run_query_into(self, query, user, builder):
+        """Runs the query and adds its result to `builder` (see `ResultBuilder`), returning the error if it failed.
+
+        Query runners that fetch results in batches override this to add each batch as they get it (and implement
+        `run_query` with `run_query_buffered`); by default, the result of `run_query` is added at once.
+        """
+        data, error = self.run_query(query, user)
+        if data is not None:
+            builder.add_result(data)
+        return error
+
+    def run_query_buffered(self, query, user):
+        """`run_query` for query runners that implement `run_query_into`."""
+        builder = self.result_builder()
+        error = self.run_query_into(query, user, builder)
+        if error is not None:
+            return None, error
+
+        return builder.build(), None
+
+    def _connect(self):
+        raise NotImplementedError()
+
+    def _is_connection_healthy(self, connection):
+        return True
+
+    def _reset_connection(self, connection):
+        pass
+
+    def _close_connection(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            logger.debug("Failed closing connection.", exc_info=True)
+
+    @contextmanager
+    def pooled_connection(self):
+        """
+        Yields a connection to the data source, taken from its connection pool when pooling is enabled for this
+        query runner. The connection goes back to the pool afterwards, unless an exception was raised while it
+        was used (in which case it's closed, as it may be in the middle of something).
+        """
+        if not self.pool_connections or settings.QUERY_RUNNER_CONNECTION_POOL_SIZE <= 0:
+            connection = self._connect()
+            try:
+                yield connection
+            finally:
+                self._close_connection(connection)
+            return
+
+        pool = get_connection_pool(self)
+        connection = pool.acquire(self)
+        try:
+            yield connection
+        except BaseException:
+            self._close_connection(connection)
+            raise
+
+        pool.release(self, connection)
+
     def fetch_columns(self, columns):
         column_names = set()
         duplicates_counters = defaultdict(int)
@@ -488,10 +832,60 @@ def guess_type_from_string(string_value):
     return TYPE_STRING
 
 
+_native_value_types = {bool: TYPE_BOOLEAN, int: TYPE_INTEGER, float: TYPE_FLOAT}
+
+# How many (non-missing) values of a column guess_column_type looks at.
+GUESS_COLUMN_TYPE_SAMPLE_SIZE = 1000
+
+
+def guess_column_type(values):
+    """Guess the type of a column from its values: the type `guess_type` returns for each of them
+    when they agree, TYPE_STRING otherwise. Missing values (None or "") are ignored.
+
+    Columns of native Python numbers/booleans are typed without looking at each value; otherwise
+    the distinct values among the first GUESS_COLUMN_TYPE_SAMPLE_SIZE are guessed once, stopping
+    at the first one that guesses string or disagrees.
+    """
+    value_types = set(map(type, values))
+    value_types.discard(type(None))
+    if len(value_types) == 1:
+        (value_type,) = value_types
+        if value_type in _native_value_types:
+            return _native_value_types[value_type]
+
+    column_type = None
+    seen = set()
+    sample = itertools.islice(
+        (value for value in values if value is not None and value != ""), GUESS_COLUMN_TYPE_SAMPLE_SIZE
+    )
+    for value in sample:
+        try:
+            # Keyed by type too, as e.g. 1 == True == 1.0 but they're guessed differently.
+            key = (type(value), value)
+            if key in seen:
+                continue
+            seen.add(key)
+        except TypeError:
+            pass
+
+        guess = guess_type(value)
+        if guess == TYPE_STRING or (column_type is not None and guess != column_type):
+            return TYPE_STRING
+        column_type = guess
+
+    return column_type or TYPE_STRING
+
+
 def with_ssh_tunnel(query_runner, details):
+    # run_query and run_query_into both go through the tunnel, and may call each other.
+    tunnel_open = []
+
     def tunnel(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
+            if tunnel_open:
+                return f(*args, **kwargs)
+
             try:
                 remote_host, remote_port = query_runner.host, query_runner.port
             except NotImplementedError:
@@ -512,8 +906,10 @@ def with_ssh_tunnel(query_runner, details):
             with stack:
                 try:
                     query_runner.host, query_runner.port = server.local_bind_address
+                    tunnel_open.append(server)
                     result = f(*args, **kwargs)
                 finally:
+                    tunnel_open.clear()
                     query_runner.host, query_runner.port = remote_host, remote_port
 
                 return result
@@ -521,5 +917,8 @@ def with_ssh_tunnel(query_runner, details):
         return wrapper
 
     query_runner.run_query = tunnel(query_runner.run_query)
+    query_runner.run_query_into = tunnel(query_runner.run_query_into)
+    # Every tunnel listens on a different local port, so its connections can't be reused.
+    query_runner.pool_connections = False
 
     return query_runner
@@ -1,8 +1,10 @@
 import datetime
 import logging
 import socket
+import threading
 import time
 from base64 import b64decode
+from concurrent.futures import ThreadPoolExecutor
 
 from redash import settings
 from redash.query_runner import (
@@ -57,19 +59,39 @@ def transform_cell(field_type, cell_value):
     return cell_value
 
 
-def transform_row(row, fields):
-    row_data = {}
+_cell_converters = {
+    "INTEGER": int,
+    "FLOAT": float,
+    "BOOLEAN": lambda value: value.lower() == "true",
+    "TIMESTAMP": lambda value: datetime.datetime.fromtimestamp(float(value)),
+}
 
-    for column_index, cell in enumerate(row["f"]):
-        field = fields[column_index]
-        if field.get("mode") == "REPEATED":
-            cell_value = [transform_cell(field["type"], item["v"]) for item in cell["v"]]
-        else:
-            cell_value = transform_cell(field["type"], cell["v"])
 
-        row_data[field["name"]] = cell_value
+def _field_transformer(field):
+    """The `transform_cell` of a field, with the conversion for its type picked once."""
+    convert = _cell_converters.get(field["type"])
+
+    def transform(value):
+        if value is None or convert is None:
+            return value
+        return convert(value)
+
+    if field.get("mode") == "REPEATED":
+        return lambda value: [transform(item["v"]) for item in value]
+    return transform
+
 
-    return row_data
+def transform_rows(rows, fields):
+    names = [field["name"] for field in fields]
+    transformers = [_field_transformer(field) for field in fields]
+
+    return [
+        {name: transform(cell["v"]) for name, transform, cell in zip(names, transformers, row["f"])} for row in rows
+    ]
+
+
+def transform_row(row, fields):
+    return transform_rows([row], fields)[0]
 
 
 def _load_key(filename):
@@ -92,6 +114,25 @@ def _get_query_results(jobs, project_id, location, job_id, start_index):
     return query_reply
 
 
+def _get_query_results_page(jobs, project_id, location, job_id, start_index, end_index):
+    """Rows `[start_index, end_index)` of the results of a finished job. BigQuery may return fewer rows than asked
+    for (to keep replies small), in which case the rest of them are asked for again."""
+    rows = []
+    while start_index + len(rows) < end_index:
+        query_reply = jobs.getQueryResults(
+            projectId=project_id,
+            location=location,
+            jobId=job_id,
+            startIndex=start_index + len(rows),
+            maxResults=end_index - start_index - len(rows),
+        ).execute()
+        if not query_reply.get("rows"):
+            break
+        rows.extend(query_reply["rows"])
+
+    return rows
+
+
 def _get_total_bytes_processed_for_resp(bq_response):
     # BigQuery hides the total bytes processed for queries to tables with row-level access controls.
     # For these queries the "totalBytesProcessed" field may not be defined in the response.
@@ -215,39 +256,29 @@ class BigQuery(BaseSQLQueryRunner):
 
         return job_data
 
-    def _get_query_result(self, jobs, query):
+    def _get_query_result(self, jobs, query, jobs_factory=None):
         project_id = self._get_project_id()
         job_data = self._get_job_data(query)
         insert_response = jobs.insert(projectId=project_id, body=job_data).execute()
         self.current_job_id = insert_response["jobReference"]["jobId"]
         self.current_job_location = insert_response["jobReference"]["location"]
-        current_row = 0
         query_reply = _get_query_results(
             jobs,
             project_id=project_id,
             location=self.current_job_location,
             job_id=self.current_job_id,
-            start_index=current_row,
+            start_index=0,
         )
 
         logger.debug("bigquery replied: %s", query_reply)
 
-        rows = []
-
-        while ("rows" in query_reply) and current_row < int(query_reply["totalRows"]):
-            for row in query_reply["rows"]:
-                rows.append(transform_row(row, query_reply["schema"]["fields"]))
-
-            current_row += len(query_reply["rows"])
-
-            query_result_request = {
-                "projectId": project_id,
-                "jobId": self.current_job_id,
-                "startIndex": current_row,
-                "location": self.current_job_location,
-            }
-
-            query_reply = jobs.getQueryResults(**query_result_request).execute()
+        fields = query_reply["schema"]["fields"]
+        first_page = query_reply.get("rows", [])
+        rows = transform_rows(first_page, fields)
+        total_rows = int(query_reply["totalRows"])
+        if first_page and len(first_page) < total_rows:
+            for page in self._get_pages(jobs, jobs_factory, fields, len(first_page), total_rows):
+                rows.extend(page)
 
         columns = [
             {
@@ -255,7 +286,7 @@ class BigQuery(BaseSQLQueryRunner):
                 "friendly_name": f["name"],
                 "type": "string" if f.get("mode") == "REPEATED" else types_map.get(f["type"], "string"),
             }
-            for f in query_reply["schema"]["fields"]
+            for f in fields
         ]
 
         data = {
@@ -266,6 +297,41 @@ class BigQuery(BaseSQLQueryRunner):
 
         return data
 
+    def _get_pages(self, jobs, jobs_factory, fields, page_size, total_rows):
+        """Fetches the results of the current job after its first page, in pages of `page_size` rows, on up to
+        `BIGQUERY_PAGE_FETCH_WORKERS` threads, and yields them (transformed) in order.
+
+        The API client's HTTP connections can't be shared between threads, so each thread gets its own `jobs`
+        from `jobs_factory`; without one, pages are fetched one after another with `jobs`.
+        """
+        workers = settings.BIGQUERY_PAGE_FETCH_WORKERS if jobs_factory is not None else 1
+        thread_jobs = threading.local()
+
+        def get_page(start_index):
+            if workers > 1 and not hasattr(thread_jobs, "jobs"):
+                thread_jobs.jobs = jobs_factory()
+
+            page = _get_query_results_page(
+                thread_jobs.jobs if workers > 1 else jobs,
+                self._get_project_id(),
+                self.current_job_location,
+                self.current_job_id,
+                start_index,
+                min(start_index + page_size, total_rows),
+            )
+            return transform_rows(page, fields)
+
+        start_indexes = range(page_size, total_rows, page_size)
+        if workers <= 1:
+            yield from map(get_page, start_indexes)
+            return
+
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            yield from executor.map(get_page, start_indexes)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
     def _get_columns_schema(self, table_data):
         columns = []
         for column in table_data.get("schema", {}).get("fields", []):
@@ -391,7 +457,7 @@ class BigQuery(BaseSQLQueryRunner):
                         "Larger than %d MBytes will be processed (%f MBytes)" % (limitMB, processedMB),
                     )
 
-            data = self._get_query_result(jobs, query)
+            data = self._get_query_result(jobs, query, jobs_factory=lambda: self._get_bigquery_service().jobs())
             error = None
 
         except apiclient.errors.HttpError as e:
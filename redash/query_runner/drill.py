@@ -10,7 +10,7 @@ from redash.query_runner import (
     TYPE_FLOAT,
     TYPE_INTEGER,
     BaseHTTPQueryRunner,
-    guess_type,
+    guess_column_type,
     register,
 )
 
@@ -45,12 +45,11 @@ def parse_response(data):
     if len(cols) == 0:
         return {"columns": [], "rows": []}
 
-    first_row = rows[0]
     columns = []
     types = {}
 
     for c in cols:
-        columns.append({"name": c, "type": guess_type(first_row[c]), "friendly_name": c})
+        columns.append({"name": c, "type": guess_column_type([row.get(c) for row in rows]), "friendly_name": c})
 
     for col in columns:
         types[col["name"]] = col["type"]
@@ -13,7 +13,7 @@ from redash.query_runner import (
     TYPE_INTEGER,
     TYPE_STRING,
     BaseQueryRunner,
-    guess_type,
+    guess_column_type,
     register,
 )
 from redash.utils import json_loads
@@ -121,9 +121,8 @@ def parse_worksheet(worksheet):
 
     columns, column_names = _get_columns_and_column_names(worksheet[HEADER_INDEX])
 
-    if len(worksheet) > 1:
-        for j, value in enumerate(worksheet[HEADER_INDEX + 1]):
-            columns[j]["type"] = guess_type(value)
+    for j, column in enumerate(columns):
+        column["type"] = guess_column_type([row[j] for row in worksheet[HEADER_INDEX + 1 :] if j < len(row)])
 
     column_types = [c["type"] for c in columns]
     rows = [dict(zip(column_names, _value_eval_list(row, column_types))) for row in worksheet[HEADER_INDEX + 1 :]]
@@ -1,9 +1,11 @@
 import datetime
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin
 
 import yaml
-from funcy import compact, project
+from funcy import chunks, compact, project
 
 from redash.query_runner import (
     TYPE_BOOLEAN,
@@ -14,6 +16,14 @@ from redash.query_runner import (
     BaseHTTPQueryRunner,
     register,
 )
+from redash.utils import json_loads
+
+try:
+    import ijson
+
+    ijson_enabled = True
+except ImportError:
+    ijson_enabled = False
 
 
 class QueryParseError(Exception):
@@ -97,12 +107,21 @@ def _sort_columns_with_fields(columns, fields):
     return columns
 
 
-# TODO: merge the logic here with the one in MongoDB's queyr runner
-def parse_json(data, fields):
-    rows = []
-    columns = []
+class JSONRowParser:
+    """Flattens JSON objects into rows (see `parse_json`), collecting the columns of the rows as it goes."""
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.columns = []
+        self._column_names = set()
+
+    def _add_column(self, column_name, value):
+        if column_name not in self._column_names:
+            self._column_names.add(column_name)
+            self.columns.append({"name": column_name, "friendly_name": column_name, "type": _get_type(value)})
 
-    for row in data:
+    def parse_row(self, row):
+        fields = self.fields
         parsed_row = {}
 
         for key in row:
@@ -113,21 +132,67 @@ def parse_json(data, fields):
                         continue
 
                     value = row[key][inner_key]
-                    add_column(columns, column_name, _get_type(value))
+                    self._add_column(column_name, value)
                     parsed_row[column_name] = value
             else:
                 if fields and key not in fields:
                     continue
 
                 value = row[key]
-                add_column(columns, key, _get_type(value))
+                self._add_column(key, value)
                 parsed_row[key] = row[key]
 
-        rows.append(parsed_row)
+        return parsed_row
 
-    columns = _sort_columns_with_fields(columns, fields)
+    def sorted_columns(self):
+        return _sort_columns_with_fields(self.columns, self.fields)
 
-    return {"rows": rows, "columns": columns}
+
+# TODO: merge the logic here with the one in MongoDB's queyr runner
+def parse_json(data, fields):
+    parser = JSONRowParser(fields)
+    rows = [parser.parse_row(row) for row in data]
+
+    return {"rows": rows, "columns": parser.sorted_columns()}
+
+
+def _iter_json_items(stream, path):
+    """Parses the JSON document read from `stream` incrementally, yielding the items of the array at `path` (or
+    the object there, like `_normalize_json`) as they're read."""
+    prefix = path or ""
+    item_prefix = "{}.item".format(prefix) if prefix else "item"
+
+    events = ijson.parse(stream, use_float=True)
+    found, empty = False, True
+    for current_prefix, event, value in events:
+        if current_prefix or event == "map_key":
+            empty = False
+        if current_prefix == prefix:
+            found = True
+        if current_prefix == prefix and event == "start_map":
+            yield _build_json_value(events, prefix, event, value)
+            return
+        if current_prefix == item_prefix:
+            if event in ("start_map", "start_array"):
+                yield _build_json_value(events, item_prefix, event, value)
+            elif event not in ("end_map", "end_array", "map_key"):
+                yield value
+
+    # Like `_normalize_json`, a missing path is an error unless the response is empty.
+    if not found and not empty:
+        raise Exception("Couldn't find path {} in response.".format(path))
+
+
+def _build_json_value(events, prefix, event, value):
+    builder = ijson.ObjectBuilder()
+    builder.event(event, value)
+    end = "end_map" if event == "start_map" else "end_array"
+    for current_prefix, event, value in events:
+        builder.event(event, value)
+        if current_prefix == prefix and event == end:
+            break
+
+    return builder.value
 
 
 class JSON(BaseHTTPQueryRunner):
@@ -147,6 +212,9 @@ class JSON(BaseHTTPQueryRunner):
             "order": ["base_url", "username", "password"],
         }
 
+    parse_batch_size = 1000
+    read_chunk_size = 64 * 1024
+
     def __init__(self, configuration):
         super(JSON, self).__init__(configuration)
         self.syntax = "yaml"
@@ -154,18 +222,26 @@ class JSON(BaseHTTPQueryRunner):
     def test_connection(self):
         pass
 
-    def run_query(self, query, user):
+    def run_query_into(self, query, user, builder):
         query = parse_query(query)
 
-        data, error = self._run_json_query(query)
+        error = self._run_json_query_into(query, builder)
         if error is not None:
-            return None, error
+            return error
 
-        if data:
-            return data, None
-        return None, "Got empty response from '{}'.".format(query["url"])
+        if builder.columns is None:
+            return "Got empty response from '{}'.".format(query["url"])
+        return None
+
+    def run_query(self, query, user):
+        return self.run_query_buffered(query, user)
 
     def _run_json_query(self, query):
+        builder = self.result_builder()
+        error = self._run_json_query_into(query, builder)
+        return builder.build(), error
+
+    def _run_json_query_into(self, query, builder):
         if not isinstance(query, dict):
             raise QueryParseError("Query should be a YAML object describing the URL to query.")
 
@@ -194,32 +270,89 @@ class JSON(BaseHTTPQueryRunner):
         if fields and not isinstance(fields, list):
             raise QueryParseError("'fields' needs to be a list.")
 
-        results, error = self._get_all_results(query["url"], method, path, pagination, **request_options)
-        return parse_json(results, fields), error
+        parser = JSONRowParser(fields)
+        url = urljoin(self.configuration.get("base_url"), query["url"])
+        if pagination is None and ijson_enabled:
+            error = self._add_streamed_results(url, method, path, parser, builder, **request_options)
+        else:
+            error = self._add_all_results(url, method, path, pagination, parser, builder, **request_options)
+
+        if error is not None:
+            builder.discard()
+            return error
 
-    def _get_all_results(self, url, method, result_path, pagination, **request_options):
-        """Get all results from a paginated endpoint."""
-        base_url = self.configuration.get("base_url")
-        url = urljoin(base_url, url)
+        builder.columns = parser.sorted_columns()
+        return None
 
-        results = []
-        has_more = True
-        while has_more:
-            response, error = self._get_json_response(url, method, **request_options)
-            has_more = False
+    def _add_all_results(self, url, method, result_path, pagination, parser, builder, **request_options):
+        """Adds the results of all of the pages of a paginated endpoint to `builder`, until it's full. The next
+        page is fetched while the rows of the current one are parsed, and stops being read if it isn't needed."""
+        executor = ThreadPoolExecutor(max_workers=1)
+        cancelled = threading.Event()
+        try:
+            next_page = executor.submit(self._get_json_response, url, method, cancelled=cancelled, **request_options)
+            while next_page is not None:
+                response, error = next_page.result()
+                next_page = None
+
+                result = _normalize_json(response, result_path)
+                if not result:
+                    break
 
-            result = _normalize_json(response, result_path)
-            if result:
-                results.extend(result)
                 if pagination:
                     has_more, url, request_options = pagination.next(url, request_options, response)
+                    if has_more:
+                        next_page = executor.submit(
+                            self._get_json_response, url, method, cancelled=cancelled, **request_options
+                        )
+
+                if not builder.add_records([parser.parse_row(row) for row in result]):
+                    break
+        finally:
+            cancelled.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        return error
+
+    def _add_streamed_results(self, url, method, result_path, parser, builder, **request_options):
+        """Adds the results of a single page endpoint to `builder` as the response is read and parsed, so big
+        responses don't have to be loaded at once, and stops reading once it's full."""
+        response, error = self.get_response(url, http_method=method, stream=True, **request_options)
+        if error is not None:
+            if response is not None:
+                response.close()
+            return error
+
+        try:
+            response.raw.decode_content = True
+            for rows in chunks(self.parse_batch_size, _iter_json_items(response.raw, result_path)):
+                if not builder.add_records([parser.parse_row(row) for row in rows]):
+                    break
+        except ijson.JSONError as e:
+            return "Failed parsing the response from '{}': {}".format(url, e)
+        finally:
+            response.close()
 
-        return results, error
+        return None
 
-    def _get_json_response(self, url, method, **request_options):
-        response, error = self.get_response(url, http_method=method, **request_options)
-        result = response.json() if error is None else {}
-        return result, error
+    def _get_json_response(self, url, method, cancelled=None, **request_options):
+        """Returns the parsed response and the error of a request. Reading the response stops (and its connection
+        is closed) once `cancelled` is set."""
+        response, error = self.get_response(url, http_method=method, stream=True, **request_options)
+        try:
+            if error is not None:
+                return {}, error
+
+            content = []
+            for chunk in response.iter_content(chunk_size=self.read_chunk_size):
+                if cancelled is not None and cancelled.is_set():
+                    return {}, None
+                content.append(chunk)
+
+            return json_loads(b"".join(content)), None
+        finally:
+            if response is not None:
+                response.close()
 
 
 class RequestPagination:
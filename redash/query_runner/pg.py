@@ -6,7 +6,10 @@ from tempfile import NamedTemporaryFile
 from uuid import uuid4
 
 import psycopg2
+import sqlparse
+from psycopg2 import errors as pg_errors
 from psycopg2.extras import Range
+from sqlparse.tokens import Keyword
 
 from redash.query_runner import (
     TYPE_BOOLEAN,
@@ -19,6 +22,7 @@ from redash.query_runner import (
     InterruptException,
     JobTimeoutException,
     register,
+    split_sql_statements,
 )
 
 logger = logging.getLogger(__name__)
@@ -147,8 +151,30 @@ def _parse_dsn(configuration):
     return params
 
 
+def _is_select(statement):
+    """Whether `statement` only reads rows, so it can run through a cursor: SELECT ... INTO and data-modifying
+    statements in WITH (which sqlparse reports as SELECTs too) can't."""
+    parsed = sqlparse.parse(statement)[0]
+    if parsed.get_type() != "SELECT":
+        return False
+
+    for token in parsed.flatten():
+        if token.ttype is Keyword.DML and token.normalized != "SELECT":
+            return False
+        if token.ttype is Keyword and token.normalized == "INTO":
+            return False
+
+    return True
+
+
 class PostgreSQL(BaseSQLQueryRunner):
     noop_query = "SELECT 1"
+    reset_query = "DISCARD ALL"
+    pool_connections = True
+    # Whether SELECT queries are read through a server-side cursor by default (the "server_side_cursor" option
+    # overrides it per data source), fetch_batch_size rows at a time.
+    server_side_cursor = True
+    fetch_batch_size = 10000
 
     @classmethod
     def configuration_schema(cls):
@@ -177,6 +203,11 @@ class PostgreSQL(BaseSQLQueryRunner):
                 "sslrootcertFile": {"type": "string", "title": "SSL Root Certificate"},
                 "sslcertFile": {"type": "string", "title": "SSL Client Certificate"},
                 "sslkeyFile": {"type": "string", "title": "SSL Client Key"},
+                "server_side_cursor": {
+                    "type": "boolean",
+                    "title": "Read Results Through a Server-Side Cursor",
+                    "default": True,
+                },
             },
             "order": ["host", "port", "user", "password"],
             "required": ["dbname"],
@@ -186,6 +217,7 @@ class PostgreSQL(BaseSQLQueryRunner):
                 "sslrootcertFile",
                 "sslcertFile",
                 "sslkeyFile",
+                "server_side_cursor",
             ],
         }
 
@@ -268,42 +300,132 @@ class PostgreSQL(BaseSQLQueryRunner):
 
         return connection
 
-    def run_query(self, query, user):
+    def _connect(self):
         connection = self._get_connection()
-        _wait(connection, timeout=10)
+        try:
+            _wait(connection, timeout=10)
+        except BaseException:
+            connection.close()
+            raise
+        finally:
+            _cleanup_ssl_certs(self.ssl_config)
 
-        cursor = connection.cursor()
+        return connection
+
+    def _is_connection_healthy(self, connection):
+        if connection.closed:
+            return False
 
         try:
-            cursor.execute(query)
-            _wait(connection)
+            cursor = connection.cursor()
+            cursor.execute(self.noop_query)
+            _wait(connection, timeout=10)
+        except (psycopg2.Error, select.error, OSError):
+            return False
 
-            if cursor.description is not None:
-                columns = self.fetch_columns([(i[0], types_map.get(i[1], None)) for i in cursor.description])
-                rows = [dict(zip((column["name"] for column in columns), row)) for row in cursor]
+        return True
 
-                data = {"columns": columns, "rows": rows}
-                error = None
-            else:
-                error = "Query completed but it returned no data."
-                data = None
-        except (select.error, OSError):
-            error = "Query interrupted. Please retry."
-            data = None
-        except psycopg2.DatabaseError as e:
-            error = str(e)
-            data = None
-        except (KeyboardInterrupt, InterruptException, JobTimeoutException):
-            connection.cancel()
+    def _reset_connection(self, connection):
+        # Don't let the next query see whatever this one changed in the session.
+        cursor = connection.cursor()
+        cursor.execute(self.reset_query)
+        _wait(connection, timeout=10)
+
+    def _use_server_side_cursor(self):
+        return self.configuration.get("server_side_cursor", self.server_side_cursor)
+
+    def _execute(self, connection, cursor, query):
+        cursor.execute(query)
+        _wait(connection)
+
+    def _set_columns(self, builder, description):
+        builder.set_columns(self.fetch_columns([(i[0], types_map.get(i[1], None)) for i in description]))
+
+    def _fetch_all(self, connection, cursor, query, builder):
+        self._execute(connection, cursor, query)
+        if cursor.description is None:
+            return
+
+        # The whole result is already on the client, but only the rows within budget become part of the result.
+        self._set_columns(builder, cursor.description)
+        while True:
+            batch = cursor.fetchmany(self.fetch_batch_size)
+            if not batch or not builder.add_rows(batch):
+                break
+
+    def _fetch_streaming(self, connection, cursor, statement, builder):
+        """Runs the statement through a server-side cursor, so only a batch of its rows is held by libpq at a time,
+        and stops fetching once the builder is full. Cursors only live within a transaction (the connection is in
+        autocommit mode otherwise).
+
+        Returns False, without running the statement, when PostgreSQL can't run it through a cursor."""
+        self._execute(connection, cursor, "BEGIN")
+        try:
+            try:
+                self._execute(connection, cursor, "DECLARE redash_results NO SCROLL CURSOR FOR {}".format(statement))
+            except (pg_errors.FeatureNotSupported, pg_errors.SyntaxError):
+                self._execute(connection, cursor, "ROLLBACK")
+                return False
+
+            while True:
+                self._execute(connection, cursor, "FETCH FORWARD {} FROM redash_results".format(self.fetch_batch_size))
+                if builder.columns is None:
+                    self._set_columns(builder, cursor.description)
+                batch = cursor.fetchall()
+                if not builder.add_rows(batch) or len(batch) < self.fetch_batch_size:
+                    break
+
+            self._execute(connection, cursor, "COMMIT")
+        except psycopg2.DatabaseError:
+            try:
+                self._execute(connection, cursor, "ROLLBACK")
+            except psycopg2.Error:
+                # The connection is gone, it won't be reused.
+                pass
             raise
-        finally:
-            connection.close()
-            _cleanup_ssl_certs(self.ssl_config)
 
-        return data, error
+        return True
+
+    def run_query_into(self, query, user, builder):
+        with self.pooled_connection() as connection:
+            cursor = connection.cursor()
+
+            try:
+                # Queries of more than one statement run as they are, as some statements (like VACUUM) can't
+                # run in the transaction a cursor needs.
+                statements = split_sql_statements(query) if self._use_server_side_cursor() else []
+                streamed = (
+                    len(statements) == 1
+                    and _is_select(statements[0])
+                    and self._fetch_streaming(connection, cursor, statements[0], builder)
+                )
+                if not streamed:
+                    self._fetch_all(connection, cursor, query, builder)
+
+                error = None if builder.columns is not None else "Query completed but it returned no data."
+            except (select.error, OSError):
+                error = "Query interrupted. Please retry."
+            except psycopg2.DatabaseError as e:
+                error = str(e)
+            except (KeyboardInterrupt, InterruptException, JobTimeoutException):
+                connection.cancel()
+                raise
+
+        if error is not None:
+            builder.discard()
+        return error
+
+    def run_query(self, query, user):
+        return self.run_query_buffered(query, user)
 
 
 class Redshift(PostgreSQL):
+    # Redshift doesn't support DISCARD ALL, and RESET ALL would leave temporary tables and other session state
+    # for the next query on the connection, so connections aren't pooled.
+    pool_connections = False
+    # Redshift materializes cursors on the leader node, so they're opt-in.
+    server_side_cursor = False
+
     @classmethod
     def type(cls):
         return "redshift"
@@ -341,6 +463,11 @@ class Redshift(PostgreSQL):
                 "port": {"type": "number"},
                 "dbname": {"type": "string", "title": "Database Name"},
                 "sslmode": {"type": "string", "title": "SSL Mode", "default": "prefer"},
+                "server_side_cursor": {
+                    "type": "boolean",
+                    "title": "Read Results Through a Server-Side Cursor",
+                    "default": False,
+                },
                 "adhoc_query_group": {
                     "type": "string",
                     "title": "Query Group for Adhoc Queries",
@@ -457,6 +584,11 @@ class RedshiftIAM(Redshift):
                 "port": {"type": "number"},
                 "dbname": {"type": "string", "title": "Database Name"},
                 "sslmode": {"type": "string", "title": "SSL Mode", "default": "prefer"},
+                "server_side_cursor": {
+                    "type": "boolean",
+                    "title": "Read Results Through a Server-Side Cursor",
+                    "default": False,
+                },
                 "adhoc_query_group": {
                     "type": "string",
                     "title": "Query Group for Adhoc Queries",
@@ -545,6 +677,8 @@ class RedshiftIAM(Redshift):
 
 
 class CockroachDB(PostgreSQL):
+    server_side_cursor = False
+
     @classmethod
     def type(cls):
         return "cockroach"
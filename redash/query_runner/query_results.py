@@ -2,23 +2,53 @@ import datetime
 import decimal
 import hashlib
 import logging
+import os
 import re
 import sqlite3
-from urllib.parse import parse_qs
-
-from redash import models
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from urllib.parse import parse_qs, quote
+
+from flask import current_app
+from rq import get_current_job
+from rq.exceptions import NoSuchJobError
+from rq.job import JobStatus
+
+from redash import models, redis_connection, settings
 from redash.permissions import has_access, view_only
 from redash.query_runner import (
+    TYPE_BOOLEAN,
+    TYPE_DATE,
+    TYPE_DATETIME,
+    TYPE_FLOAT,
+    TYPE_INTEGER,
     TYPE_STRING,
     BaseQueryRunner,
     JobTimeoutException,
-    guess_type,
+    guess_column_type,
     register,
 )
-from redash.utils import json_dumps
+from redash.query_runner.duckdb import TYPES_MAP as DUCKDB_TYPES_MAP
+from redash.tasks.queries.execution import job_lock_id
+from redash.tasks.worker import Job
+from redash.utils import gen_query_hash, json_dumps
+from redash.utils.pandas import pandas_installed
 
 logger = logging.getLogger(__name__)
 
+try:
+    import duckdb
+
+    duckdb_enabled = True
+except ImportError:
+    duckdb_enabled = False
+
+if pandas_installed:
+    import pandas as pd
+
 
 class PermissionError(Exception):
     pass
@@ -42,6 +72,23 @@ def extract_cached_query_ids(query):
     return [int(q) for q in queries]
 
 
+def extract_join_columns(query):
+    """Return the (lower cased) identifiers used in the `ON` and `USING` clauses of a query's joins."""
+    conditions = re.findall(
+        r"\bon\b(.+?)(?=\b(?:join|left|right|inner|outer|cross|natural|where|group|order|limit|union|having)\b|$)",
+        query,
+        re.IGNORECASE | re.DOTALL,
+    )
+    conditions += re.findall(r"\busing\s*\(([^)]*)\)", query, re.IGNORECASE)
+
+    columns = set()
+    for condition in conditions:
+        for quoted, name in re.findall(r'"([^"]+)"|([^\W\d]\w*)', condition):
+            columns.add((quoted or name).lower())
+
+    return columns
+
+
 def _load_query(user, query_id):
     query = models.Query.get_by_id(query_id)
 
@@ -63,14 +110,19 @@ def replace_query_parameters(query_text, params):
     return query_text
 
 
-def get_query_results(user, query_id, bring_from_cache, params=None):
+def _get_cached_query_result(user, query_id):
     query = _load_query(user, query_id)
+    if query.latest_query_data_id is None:
+        raise Exception("No cached result available for query {}.".format(query.id))
+
+    return query.latest_query_data
+
+
+def get_query_results(user, query_id, bring_from_cache, params=None):
     if bring_from_cache:
-        if query.latest_query_data_id is not None:
-            results = query.latest_query_data.data
-        else:
-            raise Exception("No cached result available for query {}.".format(query.id))
+        results = _get_cached_query_result(user, query_id).data
     else:
+        query = _load_query(user, query_id)
         query_text = query.query_text
         if params is not None:
             query_text = replace_query_parameters(query_text, params)
@@ -82,24 +134,239 @@ def get_query_results(user, query_id, bring_from_cache, params=None):
     return results
 
 
-def create_tables_from_query_ids(user, connection, query_ids, query_params, cached_query_ids=[]):
+# How often to check on an execution of a referenced query that another job started.
+JOB_POLL_INTERVAL = 0.5
+
+
+def _wait_for_job(job_id, deadline=None):
+    """Wait for a running `execute_query` job to finish and return the id of its query result, or None if the
+    job isn't running, failed, was cancelled or expired, or didn't finish by the deadline.
+
+    Jobs that are still queued aren't waited for, as the worker they need may be the one waiting for them."""
+    try:
+        job = Job.fetch(job_id)
+    except NoSuchJobError:
+        return None
+
+    while deadline is None or time.time() < deadline:
+        status = job.get_status()
+        if status == JobStatus.FINISHED:
+            query_result_id = job.return_value()
+            return query_result_id if isinstance(query_result_id, int) else None
+        if status != JobStatus.STARTED or job.is_cancelled:
+            return None
+
+        time.sleep(JOB_POLL_INTERVAL)
+
+    return None
+
+
+def _run_referenced_query(app, query_runner, data_source_id, query_text, user, semaphore, deadline):
+    """Return the query result id of an execution of the same query already in progress (found by its
+    `query_hash_job` lock), or otherwise run it, returning `(query_result_id, data, error)`."""
+    # Runs on pool threads, and runners (like Python's) may use the database.
+    with app.app_context():
+        return _run_or_wait_for_query(query_runner, data_source_id, query_text, user, semaphore, deadline)
+
+
+def _run_or_wait_for_query(query_runner, data_source_id, query_text, user, semaphore, deadline):
+    job_id = redis_connection.get(job_lock_id(gen_query_hash(query_text), data_source_id))
+    if job_id:
+        query_result_id = _wait_for_job(job_id, deadline)
+        if query_result_id is not None:
+            return query_result_id, None, None
+
+    with semaphore:
+        data, error = query_runner.run_query(query_text, user)
+
+    return None, data, error
+
+
+def fetch_query_results(user, references):
+    """Run the queries of `(table name, query id, parameters)` references concurrently, returning the
+    name and results of each table.
+
+    Queries run on up to `QUERY_RESULTS_FETCH_WORKERS` threads, `QUERY_RESULTS_FETCH_WORKERS_PER_DATA_SOURCE`
+    at a time per data source, and don't run again if another job is already executing them. Waiting for
+    them stops at the current job's timeout.
+    """
+    job = get_current_job()
+    deadline = time.time() + job.timeout if job is not None and job.timeout else None
+    semaphores = defaultdict(lambda: threading.BoundedSemaphore(settings.QUERY_RESULTS_FETCH_WORKERS_PER_DATA_SOURCE))
+    executor = ThreadPoolExecutor(max_workers=settings.QUERY_RESULTS_FETCH_WORKERS)
+    app = current_app._get_current_object()
+    pending = []
+
+    try:
+        for table_name, query_id, params in references:
+            query = _load_query(user, query_id)
+            query_text = query.query_text
+            if params is not None:
+                query_text = replace_query_parameters(query_text, params)
+
+            data_source = query.data_source
+            args = (data_source.query_runner, data_source.id, query_text, user, semaphores[data_source.id], deadline)
+            if data_source.type == Results.type():
+                # Loads the queries it references itself, which needs this thread's database session.
+                future = Future()
+                future.set_result(_run_or_wait_for_query(*args))
+            else:
+                future = executor.submit(_run_referenced_query, app, *args)
+
+            pending.append((table_name, query, future))
+
+        tables = []
+        for table_name, query, future in pending:
+            try:
+                timeout = None if deadline is None else max(deadline - time.time(), 0)
+                query_result_id, results, error = future.result(timeout)
+            except FutureTimeoutError:
+                raise JobTimeoutException()
+
+            if query_result_id is not None:
+                results = models.QueryResult.query.get(query_result_id).data
+            elif error:
+                raise Exception("Failed loading results for query id {}.".format(query.id))
+
+            tables.append((table_name, results))
+
+        return tables
+    finally:
+        # Queries still running (e.g. after a timeout) can't be stopped, so they're left to finish (or end with
+        # the work horse, which doesn't perform other jobs while they run).
+        executor.shutdown(wait=all(future.done() for _, _, future in pending), cancel_futures=True)
+
+
+class CachedTables:
+    """A cache of the tables loaded for `cached_query_<id>`, with one SQLite database file per query result under
+    `path`, reused while the query's latest result doesn't change. Up to `size` files are kept, dropping the least
+    recently used ones.
+
+    Queries get a copy of the tables of the results they reference (which they were allowed to load), so they can
+    neither read the other results in the cache nor change the cached ones.
+    """
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def _file(self, result_id):
+        return os.path.join(self.path, "result_{}.sqlite".format(result_id))
+
+    def load(self, connection, table_name, query_result, index_columns=()):
+        """Create `table_name` in `connection` with the rows of `query_result`, storing them if they aren't cached."""
+        path = self._file(query_result.id)
+        try:
+            self._copy(connection, path, table_name)
+            os.utime(path)
+        except (OSError, sqlite3.OperationalError):
+            # Not cached yet (or evicted meanwhile).
+            try:
+                self._store(path, query_result)
+                self._copy(connection, path, table_name)
+                self.evict()
+            except (OSError, sqlite3.Error):
+                logger.warning("Failed caching the table of query result %s.", query_result.id, exc_info=1)
+                connection.execute("DROP TABLE IF EXISTS {}".format(table_name))
+                create_table(connection, table_name, query_result.data)
+
+        create_indexes(connection, table_name, index_columns)
+
+    def _copy(self, connection, path, table_name):
+        uri = "file:{}?mode=ro".format(quote(os.path.abspath(path)))
+        connection.execute("ATTACH DATABASE ? AS cached_result", (uri,))
+        try:
+            connection.execute("CREATE TABLE {} AS SELECT * FROM cached_result.result".format(table_name))
+        finally:
+            connection.execute("DETACH DATABASE cached_result")
+
+    def _store(self, path, query_result):
+        # Written to a file of its own first, so other workers never attach a table that's only partly written.
+        temp_path = "{}.{}-{}.tmp".format(path, os.getpid(), threading.get_ident())
+        connection = sqlite3.connect(temp_path)
+        try:
+            create_table(connection, "result", query_result.data)
+            connection.commit()
+        finally:
+            connection.close()
+        os.replace(temp_path, path)
+
+    def evict(self):
+        files = []
+        for name in os.listdir(self.path):
+            file_path = os.path.join(self.path, name)
+            try:
+                if name.startswith("result_") and name.endswith(".sqlite"):
+                    files.append((os.path.getmtime(file_path), file_path))
+                elif name.endswith(".tmp") and os.path.getmtime(file_path) < time.time() - 60 * 60:
+                    # Left behind by a work horse that died while storing a table.
+                    os.unlink(file_path)
+                elif name.startswith("worker-") and name.endswith(".sqlite"):
+                    # The per-worker databases the cache used to keep.
+                    os.unlink(file_path)
+            except FileNotFoundError:
+                pass
+
+        for _, file_path in sorted(files, reverse=True)[self.size :]:
+            try:
+                os.unlink(file_path)
+            except FileNotFoundError:
+                pass
+
+
+def get_cached_tables():
+    if settings.QUERY_RESULTS_CACHED_TABLES <= 0:
+        return None
+
+    try:
+        os.makedirs(settings.QUERY_RESULTS_CACHED_TABLES_PATH, exist_ok=True)
+    except OSError:
+        logger.warning("Failed creating cached tables directory.", exc_info=1)
+        return None
+
+    return CachedTables(settings.QUERY_RESULTS_CACHED_TABLES_PATH, settings.QUERY_RESULTS_CACHED_TABLES)
+
+
+def get_tables_results(user, query_ids, query_params, cached_query_ids=[]):
+    """Yield the name and results of each table referenced by a query."""
     for query_id in set(cached_query_ids):
         results = get_query_results(user, query_id, True)
-        table_name = "cached_query_{query_id}".format(query_id=query_id)
-        create_table(connection, table_name, results)
+        yield "cached_query_{query_id}".format(query_id=query_id), results
 
+    references = []
     for query in set(query_params):
-        results = get_query_results(user, query[0], False, query[1])
         table_hash = hashlib.md5(
             "query_{query}_{hash}".format(query=query[0], hash=query[1]).encode(), usedforsecurity=False
         ).hexdigest()
         table_name = "query_{query_id}_{param_hash}".format(query_id=query[0], param_hash=table_hash)
-        create_table(connection, table_name, results)
+        references.append((table_name, query[0], query[1]))
 
     for query_id in set(query_ids):
-        results = get_query_results(user, query_id, False)
-        table_name = "query_{query_id}".format(query_id=query_id)
-        create_table(connection, table_name, results)
+        references.append(("query_{query_id}".format(query_id=query_id), query_id, None))
+
+    if references:
+        yield from fetch_query_results(user, references)
+
+
+def create_tables_from_query_ids(user, connection, query_ids, query_params, cached_query_ids=[], index_columns=()):
+    cached_tables = get_cached_tables() if cached_query_ids else None
+
+    if cached_tables is not None:
+        for query_id in set(cached_query_ids):
+            query_result = _get_cached_query_result(user, query_id)
+            cached_tables.load(connection, "cached_query_{}".format(query_id), query_result, index_columns)
+
+        cached_query_ids = []
+
+    for table_name, results in get_tables_results(user, query_ids, query_params, cached_query_ids):
+        create_table(connection, table_name, results, index_columns)
+
+
+def _deny_attach(action, *args):
+    # Queries can't attach other databases, like the files of the cached tables.
+    if action in (sqlite3.SQLITE_ATTACH, sqlite3.SQLITE_DETACH):
+        return sqlite3.SQLITE_DENY
+    return sqlite3.SQLITE_OK
 
 
 def fix_column_name(name):
@@ -117,14 +384,23 @@ def flatten(value):
         return value
 
 
-def create_table(connection, table_name, query_results):
+# SQLite column affinities for the upstream column types, so e.g. numbers compare (and join) as numbers.
+# Other columns are left without an affinity, keeping their values as they are.
+COLUMN_AFFINITIES = {TYPE_INTEGER: "INTEGER", TYPE_FLOAT: "REAL", TYPE_BOOLEAN: "INTEGER"}
+
+
+def create_table(connection, table_name, query_results, index_columns=()):
     try:
         columns = [column["name"] for column in query_results["columns"]]
         safe_columns = [fix_column_name(column) for column in columns]
 
         column_list = ", ".join(safe_columns)
-        create_table = "CREATE TABLE {table_name} ({column_list})".format(
-            table_name=table_name, column_list=column_list
+        column_definitions = ", ".join(
+            " ".join([safe_column, COLUMN_AFFINITIES.get(column.get("type"), "")]).strip()
+            for column, safe_column in zip(query_results["columns"], safe_columns)
+        )
+        create_table = "CREATE TABLE {table_name} ({column_definitions})".format(
+            table_name=table_name, column_definitions=column_definitions
         )
         logger.debug("CREATE TABLE query: %s", create_table)
         connection.execute(create_table)
@@ -137,9 +413,56 @@ def create_table(connection, table_name, query_results):
         place_holders=",".join(["?"] * len(columns)),
     )
 
-    for row in query_results["rows"]:
-        values = [flatten(row.get(column)) for column in columns]
-        connection.execute(insert_template, values)
+    connection.executemany(
+        insert_template, ([flatten(row.get(column)) for column in columns] for row in query_results["rows"])
+    )
+    create_indexes(connection, table_name, index_columns)
+
+
+def create_indexes(connection, table_name, index_columns):
+    """Index the columns of a table whose names are in `index_columns` (e.g. the query's join keys)."""
+    if not index_columns:
+        return
+
+    columns = [row[1] for row in connection.execute("PRAGMA table_info({})".format(table_name))]
+
+    for i, column in enumerate(columns):
+        if column.lower() in index_columns:
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS {table_name}_{i} ON {table_name} ("{column}")'.format(
+                    table_name=table_name, i=i, column=column
+                )
+            )
+
+
+def _to_array(values, column_type):
+    try:
+        if column_type == TYPE_INTEGER:
+            return pd.array(values, dtype="Int64")
+        elif column_type == TYPE_FLOAT:
+            return pd.array(values, dtype="Float64")
+        elif column_type == TYPE_BOOLEAN:
+            return pd.array(values, dtype="boolean")
+        elif column_type == TYPE_DATETIME:
+            return pd.to_datetime(values, format="ISO8601", utc=True).array
+        elif column_type == TYPE_DATE:
+            return pd.to_datetime(values, format="ISO8601").date
+    except (TypeError, ValueError, OverflowError):
+        pass
+
+    return pd.array([None if value is None else str(value) for value in values], dtype="string")
+
+
+def create_dataframe(query_results):
+    """Convert query results into a DataFrame with a typed array per column (by the results' column
+    types), which DuckDB scans in place. Column names are sanitized like `create_table` does."""
+    arrays = {}
+    for column in query_results["columns"]:
+        values = [flatten(row.get(column["name"])) for row in query_results["rows"]]
+        column_type = column.get("type") or guess_column_type(values)
+        arrays[fix_column_name(column["name"])[1:-1]] = _to_array(values, column_type)
+
+    return pd.DataFrame(arrays)
 
 
 def prepare_parameterized_query(query, query_params):
@@ -159,21 +482,42 @@ class Results(BaseQueryRunner):
 
     @classmethod
     def configuration_schema(cls):
-        return {"type": "object", "properties": {}}
+        return {
+            "type": "object",
+            "properties": {
+                "engine": {
+                    "type": "string",
+                    "extendedEnum": [
+                        {"value": "sqlite", "name": "SQLite"},
+                        {"value": "duckdb", "name": "DuckDB"},
+                    ],
+                    "default": "sqlite",
+                    "title": "Engine",
+                },
+            },
+        }
 
     @classmethod
     def name(cls):
         return "Query Results"
 
     def run_query(self, query, user):
-        connection = sqlite3.connect(":memory:")
+        if self.configuration.get("engine") == "duckdb":
+            return self.run_query_with_duckdb(query, user)
+
+        return self.run_query_with_sqlite(query, user)
+
+    def run_query_with_sqlite(self, query, user):
+        connection = sqlite3.connect(":memory:", uri=True)
 
         query_ids = extract_query_ids(query)
 
         query_params = extract_query_params(query)
 
         cached_query_ids = extract_cached_query_ids(query)
-        create_tables_from_query_ids(user, connection, query_ids, query_params, cached_query_ids)
+        index_columns = extract_join_columns(query)
+        create_tables_from_query_ids(user, connection, query_ids, query_params, cached_query_ids, index_columns)
+        connection.set_authorizer(_deny_attach)
 
         cursor = connection.cursor()
 
@@ -186,19 +530,12 @@ class Results(BaseQueryRunner):
             if cursor.description is not None:
                 columns = self.fetch_columns([(i[0], None) for i in cursor.description])
 
-                rows = []
-                column_names = [c["name"] for c in columns]
-
-                for i, row in enumerate(cursor):
-                    for j, col in enumerate(row):
-                        guess = guess_type(col)
+                results = cursor.fetchall()
+                for column, values in zip(columns, zip(*results)):
+                    column["type"] = guess_column_type(values)
 
-                        if columns[j]["type"] is None:
-                            columns[j]["type"] = guess
-                        elif columns[j]["type"] != guess:
-                            columns[j]["type"] = TYPE_STRING
-
-                    rows.append(dict(zip(column_names, row)))
+                column_names = [c["name"] for c in columns]
+                rows = [dict(zip(column_names, row)) for row in results]
 
                 data = {"columns": columns, "rows": rows}
                 error = None
@@ -212,5 +549,44 @@ class Results(BaseQueryRunner):
             connection.close()
         return data, error
 
+    def run_query_with_duckdb(self, query, user):
+        if not (duckdb_enabled and pandas_installed):
+            return None, "The DuckDB engine requires the duckdb and pandas packages."
+
+        # Like the SQLite engine's denied ATTACH, queries can't read or write files or reach the network.
+        connection = duckdb.connect(":memory:", config={"enable_external_access": False})
+
+        query_ids = extract_query_ids(query)
+        query_params = extract_query_params(query)
+        cached_query_ids = extract_cached_query_ids(query)
+
+        try:
+            for table_name, results in get_tables_results(user, query_ids, query_params, cached_query_ids):
+                connection.register(table_name, create_dataframe(results))
+            connection.execute("SET lock_configuration = true")
+
+            if query_params is not None:
+                query = prepare_parameterized_query(query, query_params)
+
+            relation = connection.sql(query)
+            if relation is None:
+                return None, "Query completed but it returned no data."
+
+            columns = self.fetch_columns(
+                [
+                    (name, DUCKDB_TYPES_MAP.get(str(column_type).split("(")[0].upper(), TYPE_STRING))
+                    for name, column_type in zip(relation.columns, relation.types)
+                ]
+            )
+            column_names = [c["name"] for c in columns]
+            rows = [dict(zip(column_names, row)) for row in relation.fetchall()]
+
+            return {"columns": columns, "rows": rows}, None
+        except (KeyboardInterrupt, JobTimeoutException):
+            connection.interrupt()
+            raise
+        finally:
+            connection.close()
+
 
 register(Results)
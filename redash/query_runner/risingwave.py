@@ -3,6 +3,10 @@ from redash.query_runner.pg import PostgreSQL
 
 
 class RisingWave(PostgreSQL):
+    # RisingWave doesn't support resetting sessions with DISCARD ALL, nor cursors within transactions.
+    pool_connections = False
+    server_side_cursor = False
+
     @classmethod
     def type(cls):
         return "risingwave"
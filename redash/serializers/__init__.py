@@ -15,6 +15,7 @@ from redash.permissions import has_access, view_only
 from redash.serializers.query_result import (
     serialize_query_result,
     serialize_query_result_to_dsv,
+    serialize_query_result_to_dsv_stream,
     serialize_query_result_to_xlsx,
 )
 
@@ -5,6 +5,7 @@ import xlsxwriter
 from dateutil.parser import isoparse as parse_date
 from funcy import project, rpartial
 
+from redash import settings
 from redash.authentication.org_resolving import current_org
 from redash.query_runner import TYPE_BOOLEAN, TYPE_DATE, TYPE_DATETIME
 
@@ -81,23 +82,39 @@ def serialize_query_result(query_result, is_api_user):
 
 
 def serialize_query_result_to_dsv(query_result, delimiter):
+    return "".join(serialize_query_result_to_dsv_stream(query_result, delimiter))
+
+
+def serialize_query_result_to_dsv_stream(query_result, delimiter, chunk_size=None):
+    """Yield the delimiter-separated export of a query result in chunks of `chunk_size` rows,
+    so the full file is never built in memory."""
+    if chunk_size is None:
+        chunk_size = settings.DSV_EXPORT_CHUNK_SIZE
+
     s = io.StringIO()
 
-    query_data = query_result.data
+    columns, rows = query_result.iter_rows()
 
-    fieldnames, special_columns = _get_column_lists(query_data["columns"] or [])
+    fieldnames, special_columns = _get_column_lists(columns)
 
     writer = csv.DictWriter(s, extrasaction="ignore", fieldnames=fieldnames, delimiter=delimiter)
     writer.writeheader()
 
-    for row in query_data["rows"]:
+    for i, row in enumerate(rows, start=1):
         for col_name, converter in special_columns.items():
             if col_name in row:
                 row[col_name] = converter(row[col_name])
 
         writer.writerow(row)
 
-    return s.getvalue()
+        if i % chunk_size == 0:
+            yield s.getvalue()
+            s.seek(0)
+            s.truncate(0)
+
+    chunk = s.getvalue()
+    if chunk:
+        yield chunk
 
 
 def serialize_query_result_to_xlsx(query_result):
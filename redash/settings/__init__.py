@@ -49,6 +49,103 @@ QUERY_RESULTS_EXPIRED_TTL_ENABLED = parse_boolean(os.environ.get("REDASH_QUERY_R
 # default set query results expired ttl 86400 seconds
 QUERY_RESULTS_EXPIRED_TTL = int(os.environ.get("REDASH_QUERY_RESULTS_EXPIRED_TTL", "86400"))
 
+# JSON serializer used by redash.utils.json_dumps/json_loads: "orjson" (used when the orjson package is installed)
+# or "json" (the standard library).
+JSON_SERIALIZER = os.environ.get("REDASH_JSON_SERIALIZER", "orjson")
+
+# Codec used to store new query results: "json" (row-oriented, the legacy format), "columnar" (zlib compressed),
+# "columnar+zstd" or "columnar+lz4" (use the zstandard/lz4 packages). An unknown or unavailable codec falls back to
+# "json", with a warning on startup. Results stored with any codec stay readable.
+QUERY_RESULTS_STORAGE_CODEC = os.environ.get("REDASH_QUERY_RESULTS_STORAGE_CODEC", "json")
+# Columnar codecs compress the values of each column in blocks of this many rows, so a page of a result can be read
+# without decoding all of it.
+QUERY_RESULTS_COLUMNAR_BLOCK_SIZE = int(os.environ.get("REDASH_QUERY_RESULTS_COLUMNAR_BLOCK_SIZE", 10000))
+
+# Store encoded query results larger than QUERY_RESULTS_BLOB_STORE_THRESHOLD characters outside of the database,
+# keeping only a reference to them in the query_results table. Supported stores: "filesystem" and "s3" (any S3
+# compatible service, e.g. MinIO, through QUERY_RESULTS_BLOB_STORE_S3_ENDPOINT_URL). Disabled when empty.
+QUERY_RESULTS_BLOB_STORE = os.environ.get("REDASH_QUERY_RESULTS_BLOB_STORE", "")
+QUERY_RESULTS_BLOB_STORE_THRESHOLD = int(os.environ.get("REDASH_QUERY_RESULTS_BLOB_STORE_THRESHOLD", 1024 * 1024))
+QUERY_RESULTS_BLOB_STORE_PREFIX = os.environ.get("REDASH_QUERY_RESULTS_BLOB_STORE_PREFIX", "query_results/")
+QUERY_RESULTS_BLOB_STORE_PATH = os.environ.get("REDASH_QUERY_RESULTS_BLOB_STORE_PATH", "/var/lib/redash/query_results")
+QUERY_RESULTS_BLOB_STORE_S3_BUCKET = os.environ.get("REDASH_QUERY_RESULTS_BLOB_STORE_S3_BUCKET", "")
+QUERY_RESULTS_BLOB_STORE_S3_ENDPOINT_URL = os.environ.get("REDASH_QUERY_RESULTS_BLOB_STORE_S3_ENDPOINT_URL", "")
+
+# How long to cache the results of server-side aggregations of query results (see QueryResultAggregateResource).
+QUERY_RESULTS_AGGREGATION_CACHE_TTL = int(os.environ.get("REDASH_QUERY_RESULTS_AGGREGATION_CACHE_TTL", 60 * 60))
+
+# The Query Results data source runs the queries it references concurrently, on up to QUERY_RESULTS_FETCH_WORKERS
+# threads and at most QUERY_RESULTS_FETCH_WORKERS_PER_DATA_SOURCE at a time on the same data source.
+QUERY_RESULTS_FETCH_WORKERS = int(os.environ.get("REDASH_QUERY_RESULTS_FETCH_WORKERS", 4))
+QUERY_RESULTS_FETCH_WORKERS_PER_DATA_SOURCE = int(
+    os.environ.get("REDASH_QUERY_RESULTS_FETCH_WORKERS_PER_DATA_SOURCE", 2)
+)
+
+# The Query Results data source keeps the tables it loads for `cached_query_<id>` on disk (an SQLite database per
+# query result, under QUERY_RESULTS_CACHED_TABLES_PATH), reusing them while the query's latest result doesn't
+# change. Up to QUERY_RESULTS_CACHED_TABLES tables are kept, dropping the least recently used ones; 0 disables it.
+QUERY_RESULTS_CACHED_TABLES = int(os.environ.get("REDASH_QUERY_RESULTS_CACHED_TABLES", 10))
+QUERY_RESULTS_CACHED_TABLES_PATH = os.environ.get(
+    "REDASH_QUERY_RESULTS_CACHED_TABLES_PATH", "/tmp/redash_cached_tables"
+)
+
+# Stream CSV/TSV exports to the client in chunks of DSV_EXPORT_CHUNK_SIZE rows instead of building
+# the whole file in memory before responding.
+DSV_EXPORT_STREAMING_ENABLED = parse_boolean(os.environ.get("REDASH_DSV_EXPORT_STREAMING_ENABLED", "true"))
+DSV_EXPORT_CHUNK_SIZE = int(os.environ.get("REDASH_DSV_EXPORT_CHUNK_SIZE", "1000"))
+
+# Clients executing a query can ask (with the `wait` parameter) to wait for its result in the same request instead of
+# polling the job; they are notified through Redis pub/sub when any execution of the same query on the data source
+# completes. QUERY_RESULTS_MAX_WAIT caps how many seconds a request may wait, as it holds a web worker meanwhile.
+QUERY_RESULTS_MAX_WAIT = int(os.environ.get("REDASH_QUERY_RESULTS_MAX_WAIT", 10))
+
+# GET /api/jobs/events streams the status of up to JOB_EVENTS_MAX_JOBS jobs as Server-Sent Events, for at most
+# JOB_EVENTS_TIMEOUT seconds per connection (clients reconnect to keep following jobs that are still running).
+JOB_EVENTS_MAX_JOBS = int(os.environ.get("REDASH_JOB_EVENTS_MAX_JOBS", 100))
+JOB_EVENTS_TIMEOUT = int(os.environ.get("REDASH_JOB_EVENTS_TIMEOUT", 30))
+
+# Run query jobs with long lived ("warm") work horses, which perform up to WORKER_WARM_HORSE_MAX_JOBS jobs each,
+# instead of forking a new work horse per job. They reuse the query runners of the data sources they ran queries on.
+WORKER_WARM_HORSES = parse_boolean(os.environ.get("REDASH_WORKER_WARM_HORSES", "false"))
+WORKER_WARM_HORSE_MAX_JOBS = int(os.environ.get("REDASH_WORKER_WARM_HORSE_MAX_JOBS", 1000))
+
+# Query runners that support it keep up to QUERY_RUNNER_CONNECTION_POOL_SIZE idle connections per data source (0
+# disables pooling), and close them after QUERY_RUNNER_CONNECTION_POOL_MAX_IDLE seconds of not being used.
+QUERY_RUNNER_CONNECTION_POOL_SIZE = int(os.environ.get("REDASH_QUERY_RUNNER_CONNECTION_POOL_SIZE", 2))
+QUERY_RUNNER_CONNECTION_POOL_MAX_IDLE = int(os.environ.get("REDASH_QUERY_RUNNER_CONNECTION_POOL_MAX_IDLE", 300))
+
+# Workers take the jobs of these queues from each organization and data source in turns, instead of in the order they
+# were enqueued. DATA_SOURCE_QUEUE_WEIGHTS gives some data sources a bigger share of their organization's turns (e.g.
+# "12:2,15:0.5"), and no more than DATA_SOURCE_MAX_CONCURRENCY queries of a data source run at once across all workers
+# (0 means no limit).
+FAIR_QUEUES = set_from_string(os.environ.get("REDASH_FAIR_QUEUES", "queries,scheduled_queries"))
+DATA_SOURCE_QUEUE_WEIGHTS = {
+    int(data_source_id): float(weight)
+    for data_source_id, weight in (
+        pair.split(":") for pair in array_from_string(os.environ.get("REDASH_DATA_SOURCE_QUEUE_WEIGHTS", ""))
+    )
+}
+DATA_SOURCE_MAX_CONCURRENCY = int(os.environ.get("REDASH_DATA_SOURCE_MAX_CONCURRENCY", 0))
+
+# refresh_queries stops enqueueing scheduled queries into a queue that already holds REFRESH_QUERIES_MAX_QUEUED jobs,
+# or of a data source that has REFRESH_QUERIES_MAX_PENDING_PER_DATA_SOURCE jobs queued or running (0 means no limit),
+# and defers them for at least REFRESH_QUERIES_MIN_DEFER seconds instead.
+REFRESH_QUERIES_MAX_QUEUED = int(os.environ.get("REDASH_REFRESH_QUERIES_MAX_QUEUED", 1000))
+REFRESH_QUERIES_MAX_PENDING_PER_DATA_SOURCE = int(
+    os.environ.get("REDASH_REFRESH_QUERIES_MAX_PENDING_PER_DATA_SOURCE", 100)
+)
+REFRESH_QUERIES_MIN_DEFER = int(os.environ.get("REDASH_REFRESH_QUERIES_MIN_DEFER", 60))
+
+# Query runners that support it stop reading a result once it has QUERY_RESULTS_MAX_ROWS rows or about
+# QUERY_RESULTS_MAX_BYTES bytes of values (0 means no limit), and mark it as truncated.
+QUERY_RESULTS_MAX_ROWS = int(os.environ.get("REDASH_QUERY_RESULTS_MAX_ROWS", 0))
+QUERY_RESULTS_MAX_BYTES = int(os.environ.get("REDASH_QUERY_RESULTS_MAX_BYTES", 1024 * 1024 * 1024))
+
+# The time each scheduled query is due next is kept in a Redis sorted set, so refresh_queries only checks the
+# queries that are due instead of every scheduled query. The index is rebuilt from the database every
+# SCHEDULED_QUERIES_INDEX_REBUILD_INTERVAL seconds (or when it's missing), to pick up changes made outside of Redash.
+SCHEDULED_QUERIES_INDEX_REBUILD_INTERVAL = int(os.environ.get("REDASH_SCHEDULED_QUERIES_INDEX_REBUILD_INTERVAL", 3600))
+
 SCHEMAS_REFRESH_SCHEDULE = int(os.environ.get("REDASH_SCHEMAS_REFRESH_SCHEDULE", 30))
 SCHEMAS_REFRESH_TIMEOUT = int(os.environ.get("REDASH_SCHEMAS_REFRESH_TIMEOUT", 300))
 
@@ -433,6 +530,9 @@ FEATURE_EXTENDED_ALERT_OPTIONS = parse_boolean(os.environ.get("REDASH_FEATURE_EX
 
 # BigQuery
 BIGQUERY_HTTP_TIMEOUT = int(os.environ.get("REDASH_BIGQUERY_HTTP_TIMEOUT", "600"))
+# Once the first page of a query's results arrives (with the total row count), the rest of the pages are fetched on
+# up to this many threads at a time. 1 fetches them one after another.
+BIGQUERY_PAGE_FETCH_WORKERS = int(os.environ.get("REDASH_BIGQUERY_PAGE_FETCH_WORKERS", "4"))
 
 # Allow Parameters in Embeds
 # WARNING: Deprecated!
@@ -12,6 +12,7 @@ from redash.tasks.general import (
 from redash.tasks.queries import (
     cleanup_query_results,
     empty_schedules,
+    enqueue_queries,
     enqueue_query,
     execute_query,
     refresh_queries,
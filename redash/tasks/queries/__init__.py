@@ -1,4 +1,11 @@
-from .execution import enqueue_query, execute_query
+from .execution import (
+    enqueue_queries,
+    enqueue_query,
+    execute_query,
+    job_status_channel,
+    publish_job_status,
+    wait_for_query_result,
+)
 from .maintenance import (
     cleanup_query_results,
     empty_schedules,
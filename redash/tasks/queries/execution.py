@@ -1,7 +1,7 @@
 import signal
-import sys
 import time
-from collections import deque
+import uuid
+from collections import defaultdict
 
 import redis
 from rq import get_current_job
@@ -9,24 +9,115 @@ from rq.exceptions import NoSuchJobError
 from rq.job import JobStatus
 from rq.timeouts import JobTimeoutException
 
-from redash import models, redis_connection, settings
+from redash import (
+    models,
+    redis_connection,
+    rq_redis_connection,
+    settings,
+    statsd_client,
+)
 from redash.query_runner import InterruptException
 from redash.tasks.alerts import check_alerts_for_query
 from redash.tasks.failure_report import track_failure
 from redash.tasks.worker import Job, Queue
-from redash.utils import gen_query_hash, utcnow
+from redash.utils import gen_query_hash, json_dumps, json_loads, utcnow
 from redash.worker import get_job_logger
 
 logger = get_job_logger(__name__)
 TIMEOUT_MESSAGE = "Query exceeded Redash query execution time limit."
 
 
-def _job_lock_id(query_hash, data_source_id):
+def job_lock_id(query_hash, data_source_id):
     return "query_hash_job:%s:%s" % (data_source_id, query_hash)
 
 
 def _unlock(query_hash, data_source_id):
-    redis_connection.delete(_job_lock_id(query_hash, data_source_id))
+    redis_connection.delete(job_lock_id(query_hash, data_source_id))
+
+
+def _result_channel(query_hash, data_source_id):
+    return "query_result:%s:%s" % (data_source_id, query_hash)
+
+
+def job_status_channel(job_id):
+    return "job_status:%s" % job_id
+
+
+def publish_job_status(job_id, **status):
+    redis_connection.publish(job_status_channel(job_id), json_dumps(status))
+
+
+def _publish_result(query_hash, data_source_id, job_id, query_result_id=None, error=None):
+    message = json_dumps({"job_id": job_id, "query_result_id": query_result_id, "error": error})
+    pipe = redis_connection.pipeline(transaction=False)
+    pipe.publish(_result_channel(query_hash, data_source_id), message)
+    pipe.publish(job_status_channel(job_id), message)
+    pipe.execute()
+
+
+def wait_for_query_result(job, query_hash, data_source_id, timeout):
+    """Wait up to `timeout` seconds for the result of `job`, or of any other execution of the same query on the
+    data source, which executions publish when they complete. Returns the query result id, or None if the job
+    failed or didn't complete in time."""
+    pubsub = redis_connection.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(_result_channel(query_hash, data_source_id))
+    try:
+        # Check the job only once subscribed, so its completion can't be missed.
+        status = job.get_status()
+        if status == JobStatus.FINISHED:
+            # Failed executions return the error (and older jobs a dict), which the caller reports from the job.
+            return job.result if isinstance(job.result, int) else None
+        if status in [JobStatus.FAILED, JobStatus.CANCELED, JobStatus.STOPPED] or job.is_cancelled:
+            return None
+
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            message = pubsub.get_message(timeout=deadline - time.time())
+            if message is None:
+                continue
+
+            result = json_loads(message["data"])
+            if result["query_result_id"] is not None:
+                return result["query_result_id"]
+            if result["job_id"] == job.id:
+                return None
+
+        return None
+    finally:
+        pubsub.close()
+
+
+def _enqueue_options(data_source, user_id, is_api_key, scheduled_query, metadata):
+    """Return the queue name and the `Queue.enqueue` keyword arguments of a query execution."""
+    if scheduled_query:
+        queue_name = data_source.scheduled_queue_name
+        scheduled_query_id = scheduled_query.id
+    else:
+        queue_name = data_source.queue_name
+        scheduled_query_id = None
+
+    time_limit = settings.dynamic_settings.query_time_limit(scheduled_query, user_id, data_source.org_id)
+    metadata["Queue"] = queue_name
+
+    enqueue_kwargs = {
+        "user_id": user_id,
+        "scheduled_query_id": scheduled_query_id,
+        "is_api_key": is_api_key,
+        "job_timeout": time_limit,
+        "failure_ttl": settings.JOB_DEFAULT_FAILURE_TTL,
+        "meta": {
+            "data_source_id": data_source.id,
+            "org_id": data_source.org_id,
+            "scheduled": scheduled_query_id is not None,
+            "query_id": metadata.get("query_id"),
+            "user_id": user_id,
+        },
+    }
+
+    if not scheduled_query:
+        enqueue_kwargs["result_ttl"] = settings.JOB_EXPIRY_TIME
+
+    return queue_name, enqueue_kwargs
 
 
 def enqueue_query(query, data_source, user_id, is_api_key=False, scheduled_query=None, metadata={}):
@@ -40,8 +131,8 @@ def enqueue_query(query, data_source, user_id, is_api_key=False, scheduled_query
 
         pipe = redis_connection.pipeline()
         try:
-            pipe.watch(_job_lock_id(query_hash, data_source.id))
-            job_id = pipe.get(_job_lock_id(query_hash, data_source.id))
+            pipe.watch(job_lock_id(query_hash, data_source.id))
+            job_id = pipe.get(job_lock_id(query_hash, data_source.id))
             if job_id:
                 logger.info("[%s] Found existing job: %s", query_hash, job_id)
                 job_complete = None
@@ -66,46 +157,21 @@ def enqueue_query(query, data_source, user_id, is_api_key=False, scheduled_query
 
                 if lock_is_irrelevant:
                     logger.info("[%s] %s, removing lock", query_hash, message)
-                    redis_connection.delete(_job_lock_id(query_hash, data_source.id))
+                    redis_connection.delete(job_lock_id(query_hash, data_source.id))
                     job = None
 
             if not job:
                 pipe.multi()
 
-                if scheduled_query:
-                    queue_name = data_source.scheduled_queue_name
-                    scheduled_query_id = scheduled_query.id
-                else:
-                    queue_name = data_source.queue_name
-                    scheduled_query_id = None
-
-                time_limit = settings.dynamic_settings.query_time_limit(scheduled_query, user_id, data_source.org_id)
-                metadata["Queue"] = queue_name
-
+                queue_name, enqueue_kwargs = _enqueue_options(
+                    data_source, user_id, is_api_key, scheduled_query, metadata
+                )
                 queue = Queue(queue_name)
-                enqueue_kwargs = {
-                    "user_id": user_id,
-                    "scheduled_query_id": scheduled_query_id,
-                    "is_api_key": is_api_key,
-                    "job_timeout": time_limit,
-                    "failure_ttl": settings.JOB_DEFAULT_FAILURE_TTL,
-                    "meta": {
-                        "data_source_id": data_source.id,
-                        "org_id": data_source.org_id,
-                        "scheduled": scheduled_query_id is not None,
-                        "query_id": metadata.get("query_id"),
-                        "user_id": user_id,
-                    },
-                }
-
-                if not scheduled_query:
-                    enqueue_kwargs["result_ttl"] = settings.JOB_EXPIRY_TIME
-
                 job = queue.enqueue(execute_query, query, data_source.id, metadata, **enqueue_kwargs)
 
                 logger.info("[%s] Created new job: %s", query_hash, job.id)
                 pipe.set(
-                    _job_lock_id(query_hash, data_source.id),
+                    job_lock_id(query_hash, data_source.id),
                     job.id,
                     settings.JOB_EXPIRY_TIME,
                 )
@@ -123,6 +189,190 @@ def enqueue_query(query, data_source, user_id, is_api_key=False, scheduled_query
     return job
 
 
+# Sets each lock (KEYS[i]) to the new job id (ARGV[2i + 1]) unless another job took it since it was read (when it
+# held ARGV[2i]), and returns the job id each lock holds.
+LOCK_OR_REUSE_SCRIPT = """
+local job_ids = {}
+for i, key in ipairs(KEYS) do
+    local current = redis.call('GET', key)
+    if not current or current == ARGV[2 * i] then
+        redis.call('SET', key, ARGV[2 * i + 1], 'EX', ARGV[1])
+        current = ARGV[2 * i + 1]
+    end
+    job_ids[i] = current
+end
+return job_ids
+"""
+
+ENQUEUE_BATCH_SIZE = 500
+
+
+def _is_relevant(job):
+    return (
+        job is not None
+        and job.get_status(refresh=False) not in [JobStatus.FINISHED, JobStatus.FAILED]
+        and not job.is_cancelled
+    )
+
+
+def enqueue_queries(executions, is_api_key=False, on_error=None):
+    """Bulk version of `enqueue_query`, for enqueuing many queries at once (e.g. scheduled refreshes).
+
+    `executions` is a list of `(query, data_source, user_id, scheduled_query, metadata)` tuples. Returns the job
+    of each execution, reusing the running jobs of the same query and data source like `enqueue_query` does.
+    Executions are handled in batches of ENQUEUE_BATCH_SIZE, with a few Redis round trips per batch.
+
+    If `on_error` is given, it's called with the execution and the exception of every execution that couldn't be
+    enqueued (whose job is None), and the other executions are enqueued regardless. Otherwise errors are raised.
+    """
+    jobs = []
+    for start in range(0, len(executions), ENQUEUE_BATCH_SIZE):
+        batch = executions[start : start + ENQUEUE_BATCH_SIZE]
+        try:
+            jobs.extend(_enqueue_batch(batch, is_api_key, on_error))
+        except Exception as e:
+            if on_error is None:
+                raise
+            for execution in batch:
+                on_error(execution, e)
+            jobs.extend([None] * len(batch))
+
+    return jobs
+
+
+def _enqueue_batch(executions, is_api_key, on_error):
+    failed = {}
+
+    def fail(key, execution, error):
+        if on_error is None:
+            raise error
+        failed[key] = error
+        on_error(execution, error)
+
+    lock_ids = _lock_ids(executions, fail)
+    first_execution = {}
+    for execution, lock_id in zip(executions, lock_ids):
+        if lock_id is not None:
+            first_execution.setdefault(lock_id, execution)
+
+    locked_job_ids = (
+        dict(zip(first_execution, redis_connection.mget(list(first_execution)))) if first_execution else {}
+    )
+    found = [job_id for job_id in set(locked_job_ids.values()) if job_id]
+    jobs = {job.id: job for job in Job.fetch_many(found, connection=rq_redis_connection) if _is_relevant(job)}
+
+    # The jobs to create are prepared before their locks are taken, so executions that fail here don't hold any.
+    new_job_ids = {}
+    job_datas = {}
+    for lock_id, job_id in locked_job_ids.items():
+        if job_id in jobs:
+            continue
+
+        new_job_id = str(uuid.uuid4())
+        try:
+            job_datas[lock_id] = _prepare_job(first_execution[lock_id], is_api_key, new_job_id)
+            new_job_ids[lock_id] = new_job_id
+        except Exception as e:
+            fail(lock_id, first_execution[lock_id], e)
+
+    jobs.update(_take_locks(locked_job_ids, new_job_ids, jobs))
+
+    datas_per_queue = defaultdict(list)
+    for lock_id, job_id in new_job_ids.items():
+        if locked_job_ids[lock_id] == job_id:
+            queue_name, data = job_datas[lock_id]
+            datas_per_queue[queue_name].append((lock_id, data))
+
+    for queue_name, datas in datas_per_queue.items():
+        created = _create_jobs(Queue(queue_name, connection=rq_redis_connection), datas, fail, first_execution)
+        for job in created:
+            logger.info("Created new job: %s", job.id)
+            jobs[job.id] = job
+
+    result = []
+    for i, (execution, lock_id) in enumerate(zip(executions, lock_ids)):
+        if lock_id in failed and execution is not first_execution[lock_id]:
+            # Duplicates of an execution that failed fail with it.
+            on_error(execution, failed[lock_id])
+        result.append(None if i in failed or lock_id in failed else jobs.get(locked_job_ids[lock_id]))
+
+    return result
+
+
+def _lock_ids(executions, fail):
+    lock_ids = []
+    for i, (query, data_source, *_) in enumerate(executions):
+        try:
+            lock_ids.append(job_lock_id(gen_query_hash(query), data_source.id))
+        except Exception as e:
+            lock_ids.append(None)
+            fail(i, executions[i], e)
+
+    return lock_ids
+
+
+def _take_locks(locked_job_ids, new_job_ids, jobs):
+    """Takes the locks of the new jobs, updating `locked_job_ids`. Returns the jobs others created meanwhile."""
+    if not new_job_ids:
+        return {}
+
+    lock_or_reuse = redis_connection.register_script(LOCK_OR_REUSE_SCRIPT)
+    args = [settings.JOB_EXPIRY_TIME]
+    for lock_id, job_id in new_job_ids.items():
+        args.extend([locked_job_ids[lock_id] or "", job_id])
+    locked_job_ids.update(zip(new_job_ids, lock_or_reuse(keys=list(new_job_ids), args=args)))
+
+    taken = [
+        job_id
+        for lock_id, job_id in locked_job_ids.items()
+        if job_id not in jobs and lock_id in new_job_ids and job_id != new_job_ids[lock_id]
+    ]
+    return {job.id: job for job in Job.fetch_many(taken, connection=rq_redis_connection) if job is not None}
+
+
+def _prepare_job(execution, is_api_key, job_id):
+    query, data_source, user_id, scheduled_query, metadata = execution
+    queue_name, enqueue_kwargs = _enqueue_options(data_source, user_id, is_api_key, scheduled_query, metadata)
+    data = Queue.prepare_data(
+        execute_query,
+        args=(query, data_source.id, metadata),
+        kwargs={key: enqueue_kwargs[key] for key in ("user_id", "scheduled_query_id", "is_api_key")},
+        timeout=enqueue_kwargs["job_timeout"],
+        result_ttl=enqueue_kwargs.get("result_ttl"),
+        failure_ttl=enqueue_kwargs["failure_ttl"],
+        meta=enqueue_kwargs["meta"],
+        job_id=job_id,
+    )
+    return queue_name, data
+
+
+def _create_jobs(queue, datas, fail, first_execution):
+    try:
+        return _enqueue_many(queue, [data for _, data in datas])
+    except redis.RedisError:
+        raise
+    except Exception:
+        pass
+
+    # Enqueue them one by one, to only fail the executions that can't be enqueued.
+    created = []
+    for lock_id, data in datas:
+        try:
+            created.extend(_enqueue_many(queue, [data]))
+        except Exception as e:
+            redis_connection.delete(lock_id)
+            fail(lock_id, first_execution[lock_id], e)
+
+    return created
+
+
+def _enqueue_many(queue, datas):
+    pipe = rq_redis_connection.pipeline()
+    jobs = queue.enqueue_many(datas, pipeline=pipe)
+    pipe.execute()
+    return jobs
+
+
 def signal_handler(*args):
     raise InterruptException
 
@@ -147,28 +397,18 @@ def _resolve_user(user_id, is_api_key, query_id):
         return None
 
 
-def _get_size_iterative(dict_obj):
-    """Iteratively finds size of objects in bytes"""
-    seen = set()
-    size = 0
-    objects = deque([dict_obj])
+# Query runners of the data sources this process ran queries on, so a work horse that performs more than one
+# job (see WarmWorker) reuses them (and whatever connections they keep) as long as the data source doesn't change.
+_query_runners = {}
 
-    while objects:
-        current = objects.popleft()
-        if id(current) in seen:
-            continue
-        seen.add(id(current))
-        size += sys.getsizeof(current)
 
-        if isinstance(current, dict):
-            objects.extend(current.keys())
-            objects.extend(current.values())
-        elif hasattr(current, "__dict__"):
-            objects.append(current.__dict__)
-        elif hasattr(current, "__iter__") and not isinstance(current, (str, bytes, bytearray)):
-            objects.extend(current)
+def _get_query_runner(data_source):
+    version = (data_source.type, data_source.options.to_json())
+    cached = _query_runners.get(data_source.id)
+    if cached is None or cached[0] != version:
+        cached = _query_runners[data_source.id] = (version, data_source.query_runner)
 
-    return size
+    return cached[1]
 
 
 class QueryExecutor:
@@ -201,11 +441,13 @@ class QueryExecutor:
         logger.debug("Executing query:\n%s", self.query)
         self._log_progress("executing_query")
 
-        query_runner = self.data_source.query_runner
+        query_runner = _get_query_runner(self.data_source)
         annotated_query = self._annotate_query(query_runner)
 
+        builder = query_runner.result_builder()
         try:
-            data, error = query_runner.run_query(annotated_query, self.user)
+            error = query_runner.run_query_into(annotated_query, self.user, builder)
+            data = builder.build()
         except Exception as e:
             if isinstance(e, JobTimeoutException):
                 error = TIMEOUT_MESSAGE
@@ -218,10 +460,9 @@ class QueryExecutor:
         run_time = time.time() - started_at
 
         logger.info(
-            "job=execute_query query_hash=%s ds_id=%d data_length=%s error=[%s]",
+            "job=execute_query query_hash=%s ds_id=%d error=[%s]",
             self.query_hash,
             self.data_source_id,
-            data and _get_size_iterative(data),
             error,
         )
 
@@ -229,6 +470,7 @@ class QueryExecutor:
 
         if error is not None and data is None:
             result = QueryExecutionError(error)
+            _publish_result(self.query_hash, self.data_source.id, self.job.id, error=error)
             if self.is_scheduled_query:
                 self.query_model = models.db.session.merge(self.query_model, load=False)
                 track_failure(self.query_model, error)
@@ -249,6 +491,7 @@ class QueryExecutor:
                 run_time,
                 utcnow(),
             )
+            self._record_size(query_result)
 
             updated_query_ids = models.Query.update_latest_result(query_result)
 
@@ -260,8 +503,22 @@ class QueryExecutor:
 
             result = query_result.id
             models.db.session.commit()
+            _publish_result(self.query_hash, self.data_source.id, self.job.id, query_result_id=result)
             return result
 
+    def _record_size(self, query_result):
+        logger.info(
+            "job=execute_query query_hash=%s ds_id=%d data_size=%s row_count=%s",
+            self.query_hash,
+            self.data_source_id,
+            query_result.data_size,
+            query_result.row_count,
+        )
+        if query_result.data_size is not None:
+            statsd_client.timing("query_results.size.{}".format(self.data_source.type), query_result.data_size)
+        if query_result.row_count is not None:
+            statsd_client.timing("query_results.row_count.{}".format(self.data_source.type), query_result.row_count)
+
     def _annotate_query(self, query_runner):
         self.metadata["Job ID"] = self.job.id
         self.metadata["Query Hash"] = self.query_hash
@@ -282,6 +539,7 @@ class QueryExecutor:
             self.metadata.get("query_id", "unknown"),
             self.metadata.get("Username", "unknown"),
         )
+        publish_job_status(self.job.id, state=state)
 
     def _load_data_source(self):
         logger.info("job=execute_query state=load_ds ds_id=%d", self.data_source_id)
@@ -1,20 +1,30 @@
 import logging
+import random
 import time
+from collections import defaultdict
 
 from rq.timeouts import JobTimeoutException
 
-from redash import models, redis_connection, settings, statsd_client
+from redash import (
+    models,
+    redis_connection,
+    rq_redis_connection,
+    settings,
+    statsd_client,
+)
 from redash.models.parameterized_query import (
     InvalidParameterError,
     QueryDetachedFromDataSourceError,
 )
+from redash.models.result_stores import delete_blobs
 from redash.monitor import rq_job_ids
 from redash.query_runner import NotSupported
 from redash.tasks.failure_report import track_failure
-from redash.utils import json_dumps, sentry
+from redash.tasks.worker import Queue
+from redash.utils import json_dumps, sentry, utcnow
 from redash.worker import get_job_logger, job
 
-from .execution import enqueue_query
+from .execution import enqueue_queries
 
 logger = get_job_logger(__name__)
 
@@ -81,10 +91,99 @@ def _apply_auto_limit(query_text, query):
     return query.data_source.query_runner.apply_auto_limit(query_text, should_apply_auto_limit)
 
 
+def _staleness(query, now):
+    """How overdue a scheduled query is, in schedule intervals (never refreshed queries come first)."""
+    retrieved_at = models.scheduled_queries_executions.get(query.id) or (
+        query.latest_query_data and query.latest_query_data.retrieved_at
+    )
+    try:
+        interval = int(query.schedule["interval"])
+    except (TypeError, ValueError):
+        interval = None
+
+    if retrieved_at is None or not interval:
+        return float("inf")
+
+    return (now - retrieved_at).total_seconds() / interval
+
+
+def _admit(executions):
+    """
+    Admission control for scheduled refreshes: when a scheduled queue already holds REFRESH_QUERIES_MAX_QUEUED
+    jobs, or a data source has REFRESH_QUERIES_MAX_PENDING_PER_DATA_SOURCE jobs queued or running, enqueueing
+    more of them only grows a backlog its workers can't keep up with (and their locks expire before they run).
+    Instead, the most overdue queries are enqueued while there's room and the rest are deferred, for about as
+    long as their data source needs to work through its pending jobs (judging by the recent runtimes of its
+    queries), with some jitter so they don't all come back at once.
+
+    Returns the admitted executions and the time each deferred query should be considered again.
+    """
+    if not executions:
+        return executions, {}
+
+    now = utcnow()
+    by_data_source = defaultdict(list)
+    for execution in executions:
+        by_data_source[execution[1]].append(execution[3])
+
+    queued_per_queue = {}
+    pending = defaultdict(int)
+    for queue_name in {data_source.scheduled_queue_name for data_source in by_data_source}:
+        queue = Queue(queue_name, connection=rq_redis_connection)
+        queued_per_queue[queue_name] = queue.count
+        for data_source_id, queued in queue.queued_per_data_source().items():
+            pending[data_source_id] += queued
+        if not queue.is_fair:
+            for data_source_id, started in queue.started_per_data_source().items():
+                pending[data_source_id] += started
+
+    running = Queue.running_per_data_source([data_source.id for data_source in by_data_source], rq_redis_connection)
+    for data_source_id, count in running.items():
+        pending[data_source_id] += count
+
+    runtimes = {}
+    for data_source, queries in by_data_source.items():
+        results = [query.latest_query_data for query in queries if query.latest_query_data is not None]
+        runtimes[data_source] = sum(result.runtime or 0 for result in results) / len(results) if results else 0
+
+    max_queued = settings.REFRESH_QUERIES_MAX_QUEUED or float("inf")
+    max_pending = settings.REFRESH_QUERIES_MAX_PENDING_PER_DATA_SOURCE or float("inf")
+    concurrency = settings.DATA_SOURCE_MAX_CONCURRENCY or 1
+
+    admitted = []
+    deferred = {}
+    for execution in sorted(executions, key=lambda execution: _staleness(execution[3], now), reverse=True):
+        data_source, query = execution[1], execution[3]
+        queue_name = data_source.scheduled_queue_name
+
+        if queued_per_queue[queue_name] < max_queued and pending[data_source.id] < max_pending:
+            admitted.append(execution)
+            queued_per_queue[queue_name] += 1
+            pending[data_source.id] += 1
+            continue
+
+        backlog = runtimes[data_source] * pending[data_source.id] / concurrency
+        delay = max(settings.REFRESH_QUERIES_MIN_DEFER, backlog)
+        try:
+            delay = min(delay, int(query.schedule["interval"]))
+        except (TypeError, ValueError):
+            pass
+        deferred[query.id] = now.timestamp() + delay * random.uniform(1, 1.5)
+
+    return admitted, deferred
+
+
+def _report_enqueue_error(query, e):
+    message = "Could not enqueue query %d due to %s" % (query.id, repr(e))
+    logging.info(message)
+    error = RefreshQueriesError(message).with_traceback(e.__traceback__)
+    sentry.capture_exception(error)
+
+
 def refresh_queries():
     started_at = time.time()
     logger.info("Refreshing queries...")
-    enqueued = []
+    executions = []
     for query in models.Query.outdated_queries():
         if not _should_refresh_query(query):
             continue
@@ -92,23 +191,39 @@ def refresh_queries():
         try:
             query_text = _apply_default_parameters(query)
             query_text = _apply_auto_limit(query_text, query)
-            enqueue_query(
-                query_text,
-                query.data_source,
-                query.user_id,
-                scheduled_query=query,
-                metadata={"query_id": query.id, "Username": query.user.get_actual_user()},
+            executions.append(
+                (
+                    query_text,
+                    query.data_source,
+                    query.user_id,
+                    query,
+                    {"query_id": query.id, "Username": query.user.get_actual_user()},
+                )
             )
-            enqueued.append(query)
         except Exception as e:
-            message = "Could not enqueue query %d due to %s" % (query.id, repr(e))
-            logging.info(message)
-            error = RefreshQueriesError(message).with_traceback(e.__traceback__)
-            sentry.capture_exception(error)
+            _report_enqueue_error(query, e)
+
+    executions, deferred = _admit(executions)
+    if deferred:
+        logger.info("Deferring the refresh of %d queries.", len(deferred))
+        models.scheduled_queries_index.update(deferred, [])
+        statsd_client.incr("refresh_queries.deferred", len(deferred))
+
+    failed = set()
+
+    def on_error(execution, e):
+        query = execution[3]
+        failed.add(query.id)
+        _report_enqueue_error(query, e)
+
+    if executions:
+        enqueue_queries(executions, on_error=on_error)
+    enqueued = [scheduled_query for _, _, _, scheduled_query, _ in executions if scheduled_query.id not in failed]
 
     status = {
         "started_at": started_at,
         "outdated_queries_count": len(enqueued),
+        "deferred_queries_count": len(deferred),
         "last_refresh_at": time.time(),
         "query_ids": json_dumps([q.id for q in enqueued]),
     }
@@ -133,10 +248,12 @@ def cleanup_query_results():
     )
 
     unused_query_results = models.QueryResult.unused(settings.QUERY_RESULTS_CLEANUP_MAX_AGE)
-    deleted_count = models.QueryResult.query.filter(
-        models.QueryResult.id.in_(unused_query_results.limit(settings.QUERY_RESULTS_CLEANUP_COUNT).subquery())
-    ).delete(synchronize_session=False)
+    unused_ids = [r.id for r in unused_query_results.limit(settings.QUERY_RESULTS_CLEANUP_COUNT)]
+    query_results = models.QueryResult.query.filter(models.QueryResult.id.in_(unused_ids))
+    blobs = models.QueryResult.blob_references(query_results)
+    deleted_count = query_results.delete(synchronize_session=False)
     models.db.session.commit()
+    delete_blobs(blobs)
     logger.info("Deleted %d unused query results.", deleted_count)
 
 
@@ -158,6 +275,10 @@ def remove_ghost_locks():
     logger.info("Locks found: {}, Locks removed: {}".format(len(locks), count))
 
 
+def _schema_refresh_lock_id(data_source_id):
+    return "data_source:schema:{}:refreshing".format(data_source_id)
+
+
 @job("schemas", timeout=settings.SCHEMAS_REFRESH_TIMEOUT)
 def refresh_schema(data_source_id):
     ds = models.DataSource.get_by_id(data_source_id)
@@ -188,6 +309,8 @@ def refresh_schema(data_source_id):
             ds.id,
             time.time() - start_time,
         )
+    finally:
+        redis_connection.delete(_schema_refresh_lock_id(data_source_id))
 
 
 def refresh_schemas():
@@ -210,6 +333,10 @@ def refresh_schemas():
             logger.info("task=refresh_schema state=skip ds_id=%s reason=blacklist", ds.id)
         elif ds.org.is_disabled:
             logger.info("task=refresh_schema state=skip ds_id=%s reason=org_disabled", ds.id)
+        elif not redis_connection.set(
+            _schema_refresh_lock_id(ds.id), global_start_time, nx=True, ex=settings.SCHEMAS_REFRESH_TIMEOUT
+        ):
+            logger.info("task=refresh_schema state=skip ds_id=%s reason=in_progress", ds.id)
         else:
             refresh_schema.delay(ds.id)
 
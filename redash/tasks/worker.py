@@ -1,19 +1,25 @@
 import errno
+import logging
+import multiprocessing
 import os
+import random
 import signal
 import sys
+import threading
+import time
 
 from rq import Queue as BaseQueue
+from rq.exceptions import DequeueTimeout, NoSuchJobError
 from rq.job import Job as BaseJob
 from rq.job import JobStatus
 from rq.timeouts import HorseMonitorTimeoutException
-from rq.utils import utcnow
+from rq.utils import as_text, utcnow
 from rq.worker import (
     HerokuWorker,  # HerokuWorker implements graceful shutdown on SIGTERM
     Worker,
 )
 
-from redash import statsd_client
+from redash import settings, statsd_client
 
 # HerokuWorker does not work in OSX https://github.com/getredash/redash/issues/5413
 if sys.platform == "darwin":
@@ -44,12 +50,367 @@ class StatsdRecordingQueue(BaseQueue):
         statsd_client.incr("rq.jobs.created.{}".format(self.name))
         return job
 
+    def enqueue_many(self, *args, **kwargs):
+        jobs = super().enqueue_many(*args, **kwargs)
+        statsd_client.incr("rq.jobs.created.{}".format(self.name), len(jobs))
+        return jobs
+
 
 class CancellableQueue(BaseQueue):
     job_class = CancellableJob
 
 
-class RedashQueue(StatsdRecordingQueue, CancellableQueue):
+# Picks the next job of a fair queue with start-time fair queuing. Besides the queue itself, the jobs of each flow
+# (organization and data source) are kept in a list of their own, and the first job of each flow is a candidate:
+# organizations take turns first and the data sources of an organization take turns within it, in proportion to their
+# weights, with ties going to the job that was enqueued first. Data sources that have as many running jobs as ARGV[3]
+# (when not 0) are skipped. The job is removed from the queue and holds a lease on a slot of its data source until it's
+# released (or the lease expires), which is also how the running jobs of data sources are counted.
+#
+# KEYS[1]: the queue, KEYS[2]: the fairness state of the queue, KEYS[3]: the flows of the queue that have jobs
+# ARGV[1]: job key prefix, ARGV[2]: running jobs key prefix, ARGV[3]: max concurrency, ARGV[4]: current time,
+# ARGV[5]: flow key prefix
+#
+# Returns false when the queue is empty, 0 when all of its data sources are busy, 1 when the job it took isn't in the
+# queue anymore (e.g. it was cancelled, and another one should be taken) and {job id, org id, data source id, queued
+# jobs of the data source} otherwise.
+FAIR_DEQUEUE_SCRIPT = """
+local max_running = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local candidates, orgs, available = {}, {}, {}
+
+for _, name in ipairs(redis.call('SMEMBERS', KEYS[3])) do
+    local head = redis.call('LINDEX', ARGV[5] .. name, 0)
+    if head then
+        table.insert(candidates, {name, redis.call('HGET', ARGV[1] .. head, 'enqueued_at') or ''})
+    else
+        redis.call('SREM', KEYS[3], name)
+    end
+end
+
+if #candidates == 0 then
+    -- Jobs that were queued before the queue was fair aren't in any flow.
+    local job_id = redis.call('LPOP', KEYS[1])
+    if not job_id then
+        return false
+    end
+    return {job_id, '', '', 0}
+end
+
+table.sort(candidates, function(a, b)
+    return a[2] < b[2] or (a[2] == b[2] and a[1] < b[1])
+end)
+
+for _, candidate in ipairs(candidates) do
+    local name = candidate[1]
+    local org, ds = string.match(name, '^([^:]*):([^:]*)$')
+
+    if available[ds] == nil then
+        available[ds] = true
+        if max_running > 0 and ds ~= '' then
+            redis.call('ZREMRANGEBYSCORE', ARGV[2] .. ds, '-inf', now)
+            available[ds] = redis.call('ZCARD', ARGV[2] .. ds) < max_running
+        end
+    end
+
+    if available[ds] then
+        if orgs[org] == nil then
+            orgs[org] = {}
+            table.insert(orgs, org)
+        end
+        table.insert(orgs[org], name)
+    end
+end
+
+local function tag(name, virtual_time)
+    return math.max(tonumber(redis.call('HGET', KEYS[2], name) or '0'), virtual_time)
+end
+
+local function pick(names, prefix, virtual_time)
+    local best, best_tag
+    for _, name in ipairs(names) do
+        local t = tag(prefix .. name, virtual_time)
+        if best_tag == nil or t < best_tag then
+            best, best_tag = name, t
+        end
+    end
+    return best, best_tag
+end
+
+local org, org_tag = pick(orgs, 'o:', tonumber(redis.call('HGET', KEYS[2], 'v') or '0'))
+if org == nil then
+    return 0
+end
+local name, flow_tag = pick(orgs[org], 'f:', tonumber(redis.call('HGET', KEYS[2], 'v:' .. org) or '0'))
+
+local job_id = redis.call('LPOP', ARGV[5] .. name)
+local queued = redis.call('LLEN', ARGV[5] .. name)
+if queued == 0 then
+    redis.call('SREM', KEYS[3], name)
+end
+if redis.call('LREM', KEYS[1], 1, job_id) == 0 then
+    return 1
+end
+
+local flow = redis.call('HGET', ARGV[1] .. job_id, 'fair_flow') or ''
+local ds, lease, weight = string.match(flow, '^[^:]*:([^:]*):([^:]*):([^:]*)$')
+lease, weight = tonumber(lease) or 0, tonumber(weight) or 1
+
+redis.call('HSET', KEYS[2], 'v', tostring(org_tag), 'o:' .. org, tostring(org_tag + 1))
+redis.call('HSET', KEYS[2], 'v:' .. org, tostring(flow_tag), 'f:' .. name, tostring(flow_tag + 1 / weight))
+if ds ~= nil and ds ~= '' then
+    redis.call('ZREMRANGEBYSCORE', ARGV[2] .. ds, '-inf', now)
+    redis.call('ZADD', ARGV[2] .. ds, now + lease, job_id)
+end
+
+return {job_id, org, ds or '', queued + 1}
+"""
+
+
+# Puts back a job of a fair queue that was popped off it while waiting for jobs, and into its flow too if a worker
+# dropped it from there in the meantime (because it wasn't in the queue).
+#
+# KEYS[1]: the queue, KEYS[2]: the flows of the queue that have jobs
+# ARGV[1]: job key prefix, ARGV[2]: flow key prefix, ARGV[3]: job id
+RESTORE_FAIR_JOB_SCRIPT = """
+redis.call('LPUSH', KEYS[1], ARGV[3])
+local flow = redis.call('HGET', ARGV[1] .. ARGV[3], 'fair_flow')
+local name = flow and string.match(flow, '^([^:]*:[^:]*):')
+if name and not redis.call('LPOS', ARGV[2] .. name, ARGV[3]) then
+    redis.call('LPUSH', ARGV[2] .. name, ARGV[3])
+    redis.call('SADD', KEYS[2], name)
+end
+"""
+
+
+class FairQueue(BaseQueue):
+    """
+    RQ workers take the jobs of a queue in the order they were enqueued, so a data source with many (slow) queries
+    holds back the queries of every other data source sharing its queue.
+
+    For the queues in FAIR_QUEUES, workers take the query jobs of the queue's organizations and data sources in
+    turns instead (see FAIR_DEQUEUE_SCRIPT), and don't start more than DATA_SOURCE_MAX_CONCURRENCY jobs of a data
+    source at once across all workers. Each organization and data source (flow) has a list of its own jobs, but they
+    are still kept in the queue's list too, so everything else RQ does with the queue works the same.
+    """
+
+    fair_flow_field = "fair_flow"
+    running_key_prefix = "rq:data_source:running:"
+    # Time a job of a data source holds its concurrency slot for, on top of its timeout, in case its worker
+    # never releases it.
+    lease_grace_period = 300
+    blocked_poll_interval = 1
+
+    @property
+    def is_fair(self):
+        return self.name in settings.FAIR_QUEUES
+
+    @property
+    def fairness_key(self):
+        return "{}:fairness".format(self.key)
+
+    @property
+    def flows_key(self):
+        return "{}:flows".format(self.key)
+
+    @property
+    def flow_key_prefix(self):
+        return "{}:flow:".format(self.key)
+
+    def _enqueue_job(self, job, pipeline=None, at_front=False):
+        if not self.is_fair or not self._is_async:
+            return super()._enqueue_job(job, pipeline=pipeline, at_front=at_front)
+
+        data_source_id = job.meta.get("data_source_id")
+        timeout = job.timeout if job.timeout and job.timeout > 0 else settings.JOB_EXPIRY_TIME
+        flow_name = "{}:{}".format(job.meta.get("org_id", ""), data_source_id if data_source_id is not None else "")
+        flow = "{}:{}:{}".format(
+            flow_name,
+            timeout + self.lease_grace_period,
+            settings.DATA_SOURCE_QUEUE_WEIGHTS.get(data_source_id, 1),
+        )
+
+        pipe = pipeline if pipeline is not None else self.connection.pipeline()
+        pipe.hset(job.key, self.fair_flow_field, flow)
+        job = super()._enqueue_job(job, pipeline=pipe, at_front=at_front)
+        if at_front:
+            pipe.lpush(self.flow_key_prefix + flow_name, job.id)
+        else:
+            pipe.rpush(self.flow_key_prefix + flow_name, job.id)
+        pipe.sadd(self.flows_key, flow_name)
+        if pipeline is None:
+            pipe.execute()
+
+        return job
+
+    def empty(self):
+        flow_names = self.connection.smembers(self.flows_key)
+        self.connection.delete(self.flows_key, *[self.flow_key_prefix + as_text(name) for name in flow_names])
+        return super().empty()
+
+    def fair_dequeue(self):
+        """Removes the next job from the queue and returns its id and data source (with `None` as the id if all
+        of its data sources are busy), or `None` if the queue is empty."""
+        dequeue = self.connection.register_script(FAIR_DEQUEUE_SCRIPT)
+        result = 1
+        while result == 1:
+            result = dequeue(
+                keys=[self.key, self.fairness_key, self.flows_key],
+                args=[
+                    self.job_class.redis_job_namespace_prefix,
+                    self.running_key_prefix,
+                    settings.DATA_SOURCE_MAX_CONCURRENCY,
+                    time.time(),
+                    self.flow_key_prefix,
+                ],
+            )
+
+        if result is None:
+            return None
+        if result == 0:
+            return None, None
+
+        job_id, org_id, data_source_id, queued = as_text(result[0]), as_text(result[1]), as_text(result[2]), result[3]
+        statsd_client.gauge("rq.jobs.queued.{}.{}".format(self.name, self._flow_name(org_id, data_source_id)), queued)
+        return job_id, data_source_id
+
+    def queued_per_data_source(self):
+        """Returns the number of jobs of each data source waiting in the queue."""
+        if not self.is_fair:
+            return self._count_per_data_source(self.get_job_ids())
+
+        flow_names = [as_text(name) for name in self.connection.smembers(self.flows_key)]
+        pipe = self.connection.pipeline()
+        for name in flow_names:
+            pipe.llen(self.flow_key_prefix + name)
+
+        queued = {}
+        for name, count in zip(flow_names, pipe.execute()):
+            data_source_id = name.split(":")[1]
+            if data_source_id and count:
+                queued[int(data_source_id)] = queued.get(int(data_source_id), 0) + count
+        return queued
+
+    def started_per_data_source(self):
+        """Returns the number of running jobs of each data source for queues that aren't fair (which don't lease
+        concurrency slots, see running_per_data_source)."""
+        return self._count_per_data_source(self.started_job_registry.get_job_ids())
+
+    def _count_per_data_source(self, job_ids):
+        counts = {}
+        for job in self.job_class.fetch_many(job_ids, connection=self.connection, serializer=self.serializer):
+            data_source_id = job.meta.get("data_source_id") if job is not None else None
+            if data_source_id:
+                counts[int(data_source_id)] = counts.get(int(data_source_id), 0) + 1
+        return counts
+
+    def restore_job(self, job_id):
+        """Puts back a job that was popped off the queue while waiting for jobs."""
+        if not self.is_fair:
+            self.connection.lpush(self.key, job_id)
+            return
+
+        restore = self.connection.register_script(RESTORE_FAIR_JOB_SCRIPT)
+        restore(
+            keys=[self.key, self.flows_key],
+            args=[self.job_class.redis_job_namespace_prefix, self.flow_key_prefix, job_id],
+        )
+
+    @classmethod
+    def running_per_data_source(cls, data_source_ids, connection):
+        """Returns the number of running jobs (of fair queues) of each of the given data sources."""
+        now = time.time()
+        pipe = connection.pipeline()
+        for data_source_id in data_source_ids:
+            pipe.zcount(cls.running_key_prefix + str(data_source_id), now, "+inf")
+        return dict(zip(data_source_ids, pipe.execute()))
+
+    def release(self, job_id, data_source_id):
+        """Frees the concurrency slot a job of a fair queue holds on its data source."""
+        if data_source_id:
+            self.connection.zrem(self.running_key_prefix + str(data_source_id), job_id)
+
+    @staticmethod
+    def _flow_name(org_id, data_source_id):
+        if not data_source_id:
+            return "other"
+        return "org_{}.data_source_{}".format(org_id, data_source_id)
+
+    @classmethod
+    def dequeue_any(cls, queues, timeout, connection=None, job_class=None, serializer=None, death_penalty_class=None):
+        if not any(queue.is_fair for queue in queues):
+            return super().dequeue_any(
+                queues,
+                timeout,
+                connection=connection,
+                job_class=job_class,
+                serializer=serializer,
+                death_penalty_class=death_penalty_class,
+            )
+
+        connection = connection or queues[0].connection
+        job_class = job_class or cls.job_class
+        queue_keys = [queue.key for queue in queues]
+        deadline = None if timeout is None else time.time() + timeout
+
+        while True:
+            blocked = False
+            popped = None
+            for queue in queues:
+                if queue.is_fair:
+                    result = queue.fair_dequeue()
+                    if result is not None and result[0] is None:
+                        blocked = True
+                        continue
+                else:
+                    job_id = connection.lpop(queue.key)
+                    result = None if job_id is None else (as_text(job_id), None)
+
+                if result is not None:
+                    popped = queue, result
+                    break
+
+            if popped is not None:
+                queue, (job_id, data_source_id) = popped
+                try:
+                    job = job_class.fetch(job_id, connection=connection, serializer=serializer)
+                except NoSuchJobError:
+                    # Skip jobs that don't exist (anymore), like RQ does.
+                    if queue.is_fair:
+                        queue.release(job_id, data_source_id)
+                    continue
+
+                if queue.is_fair and job.enqueued_at:
+                    statsd_client.timing(
+                        "rq.jobs.wait.{}.{}".format(
+                            queue.name, cls._flow_name(job.meta.get("org_id"), data_source_id)
+                        ),
+                        (utcnow() - job.enqueued_at).total_seconds() * 1000,
+                    )
+                return job, queue
+
+            if timeout is None:
+                return None
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise DequeueTimeout(timeout, queue_keys)
+
+            if blocked:
+                time.sleep(min(cls.blocked_poll_interval, remaining))
+                continue
+
+            result = connection.blpop(queue_keys, max(1, int(remaining)))
+            if result is None:
+                raise DequeueTimeout(timeout, queue_keys)
+
+            # Put the job back, and take the next one fairly.
+            queue_key, job_id = result
+            queue = next(queue for queue in queues if queue.key == as_text(queue_key))
+            queue.restore_job(as_text(job_id))
+
+
+class RedashQueue(StatsdRecordingQueue, CancellableQueue, FairQueue):
     pass
 
 
@@ -191,10 +552,159 @@ class HardLimitingWorker(BaseWorker):
             self.handle_job_failure(job, queue=queue, exc_string=exc_string)
 
 
-class RedashWorker(StatsdRecordingWorker, HardLimitingWorker):
+class FairQueueWorker(BaseWorker):
+    """
+    RQ Worker Mixin that releases the concurrency slot the jobs of fair queues hold on their data sources once
+    they're done.
+    """
+
+    def execute_job(self, job, queue):
+        try:
+            super().execute_job(job, queue)
+        finally:
+            if getattr(queue, "is_fair", False):
+                queue.release(job.id, job.meta.get("data_source_id"))
+
+
+class RedashWorker(StatsdRecordingWorker, HardLimitingWorker, FairQueueWorker):
     queue_class = RedashQueue
 
 
+def _left_threads_running(threads, timeout):
+    """Whether (non-daemon) threads that aren't in `threads` are still running after waiting up to `timeout`
+    seconds for them to finish."""
+    deadline = time.time() + timeout
+    for thread in threading.enumerate():
+        if thread in threads or thread.daemon:
+            continue
+        thread.join(max(deadline - time.time(), 0))
+        if thread.is_alive():
+            return True
+
+    return False
+
+
+class WarmWorker(RedashWorker):
+    """
+    RQ forks a new work horse for every job, so every job pays for the fork and for setting up
+    whatever it needs again (loading the data source, creating its query runner, connecting to it).
+
+    The WarmWorker keeps its work horse between jobs instead: the horse waits for the ids of the
+    jobs to perform on a pipe and reports back how each one went, so the worker monitors it exactly
+    like a forked horse (time limits, cancellation, killing it when it's stuck). A horse that's killed
+    or dies is replaced by a new one on the next job, and horses exit after performing
+    WORKER_WARM_HORSE_MAX_JOBS jobs, to bound the memory they may leak, or after a job that left threads
+    running (e.g. queries that outlived it), which would keep running alongside the next jobs.
+    """
+
+    # How long a horse waits for the threads a job started to finish before it exits instead.
+    stray_threads_timeout = 1
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._warm_horse = None
+        self._horse_reply = None
+
+    def fork_work_horse(self, job, queue):
+        if self._warm_horse is None:
+            worker_end, horse_end = multiprocessing.Pipe()
+            child_pid = os.fork()
+            if child_pid == 0:
+                # Whatever goes wrong in the horse, it must never return into the worker's code, or it
+                # would go on as a second copy of the worker.
+                exit_code = 1
+                try:
+                    worker_end.close()
+                    os.setsid()
+                    self.warm_work_horse(horse_end)
+                    exit_code = 0
+                finally:
+                    os._exit(exit_code)
+
+            horse_end.close()
+            self._warm_horse = (child_pid, worker_end)
+
+        child_pid, worker_end = self._warm_horse
+        os.environ["RQ_WORKER_ID"] = self.name
+        os.environ["RQ_JOB_ID"] = job.id
+        worker_end.send((job.id, queue.name))
+        self._horse_pid = child_pid
+        self.procline("Sent {0} to {1} at {2}".format(job.id, child_pid, time.time()))
+
+    def wait_for_horse(self):
+        child_pid, worker_end = self._warm_horse
+        if self._horse_reply is None:
+            try:
+                # The monitor interrupts this with SIGALRM every job_monitoring_interval: it may do so
+                # while waiting for the reply, but not halfway through reading it, which would leave the
+                # rest of the message in the pipe. A reply that's read when the alarm goes off is kept
+                # for the monitor's next call.
+                worker_end.poll(None)
+                signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGALRM})
+                try:
+                    self._horse_reply = worker_end.recv()
+                finally:
+                    signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGALRM})
+            except (EOFError, ConnectionResetError):
+                # The horse died (or was killed) while performing the job.
+                self._discard_warm_horse()
+                return super().wait_for_horse()
+
+        status, exiting = self._horse_reply
+        self._horse_reply = None
+        if exiting:
+            self._discard_warm_horse()
+            os.waitpid(child_pid, 0)
+
+        return child_pid, status, None
+
+    def _discard_warm_horse(self):
+        self._warm_horse[1].close()
+        self._warm_horse = None
+        self._horse_reply = None
+
+    def warm_work_horse(self, horse_end):
+        """The entry point of a warm work horse, which performs the jobs it receives until it's done
+        WORKER_WARM_HORSE_MAX_JOBS of them or the worker goes away."""
+        random.seed()
+        self._is_horse = True
+        self.log = logging.getLogger("rq.worker")
+
+        for jobs_left in range(settings.WORKER_WARM_HORSE_MAX_JOBS - 1, -1, -1):
+            # Jobs may leave their own signal handlers behind (e.g. for SIGINT), which mustn't fire
+            # while the horse is waiting for the next job.
+            self.setup_work_horse_signals()
+            try:
+                job_id, queue_name = horse_end.recv()
+            except EOFError:
+                break
+
+            os.environ["RQ_JOB_ID"] = job_id
+            threads = set(threading.enumerate())
+            try:
+                job = self.job_class.fetch(job_id, connection=self.connection, serializer=self.serializer)
+                queue = self.queue_class(queue_name, connection=self.connection, serializer=self.serializer)
+                self.perform_job(job, queue)
+                status = os.EX_OK
+            except:  # noqa
+                status = 1
+            retiring = _left_threads_running(threads, self.stray_threads_timeout)
+            horse_end.send((status, jobs_left == 0 or retiring))
+            if retiring:
+                break
+
+    def teardown(self):
+        if self._warm_horse is not None:
+            child_pid, _ = self._warm_horse
+            # The horse exits once the pipe is closed.
+            self._discard_warm_horse()
+            try:
+                os.waitpid(child_pid, 0)
+            except ChildProcessError:
+                pass
+        super().teardown()
+
+
 Job = CancellableJob
 Queue = RedashQueue
 Worker = RedashWorker
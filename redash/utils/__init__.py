@@ -3,6 +3,7 @@ import codecs
 import csv
 import datetime
 import decimal
+import functools
 import hashlib
 import io
 import json
@@ -71,13 +72,72 @@ def generate_token(length):
     return "".join(rand.choice(chars) for x in range(length))
 
 
+# See "Date Time String Format" in the ECMA-262 specification.
+def _format_datetime(o):
+    result = o.isoformat()
+    if o.microsecond:
+        result = result[:23] + result[26:]
+    if result.endswith("+00:00"):
+        result = result[:-6] + "Z"
+    return result
+
+
+def _format_time(o):
+    if o.utcoffset() is not None:
+        raise ValueError("JSON can't represent timezone-aware times.")
+    result = o.isoformat()
+    if o.microsecond:
+        result = result[:12]
+    return result
+
+
+def _hexlify(o):
+    return binascii.hexlify(o).decode()
+
+
+# Encoders of the types JSON can't represent natively, by exact type.
+_type_encoders = {
+    decimal.Decimal: float,
+    datetime.timedelta: str,
+    uuid.UUID: str,
+    datetime.datetime: _format_datetime,
+    datetime.date: datetime.date.isoformat,
+    datetime.time: _format_time,
+    memoryview: _hexlify,
+    bytes: _hexlify,
+}
+
+
+def _encode_object(o):
+    if isinstance(o, Query):
+        return list(o)
+    elif isinstance(o, decimal.Decimal):
+        return float(o)
+    elif isinstance(o, (datetime.timedelta, uuid.UUID)):
+        return str(o)
+    elif isinstance(o, datetime.datetime):
+        return _format_datetime(o)
+    elif isinstance(o, datetime.date):
+        return o.isoformat()
+    elif isinstance(o, datetime.time):
+        return _format_time(o)
+    elif isinstance(o, (memoryview, bytes)):
+        return _hexlify(o)
+
+    raise TypeError(f"Object of type {o.__class__.__name__} is not JSON serializable")
+
+
+def _query_runner_encoders():
+    from redash.query_runner import query_runners
+
+    return [r.custom_json_encoder for r in query_runners.values() if hasattr(r, "custom_json_encoder")]
+
+
 class JSONEncoder(json.JSONEncoder):
     """Adapter for `json.dumps`."""
 
     def __init__(self, **kwargs):
-        from redash.query_runner import query_runners
-
-        self.encoders = [r.custom_json_encoder for r in query_runners.values() if hasattr(r, "custom_json_encoder")]
+        self.encoders = _query_runner_encoders()
         super().__init__(**kwargs)
 
     def default(self, o):
@@ -85,39 +145,81 @@ class JSONEncoder(json.JSONEncoder):
             result = encoder(self, o)
             if result:
                 return result
-        if isinstance(o, Query):
-            result = list(o)
-        elif isinstance(o, decimal.Decimal):
-            result = float(o)
-        elif isinstance(o, (datetime.timedelta, uuid.UUID)):
-            result = str(o)
-        # See "Date Time String Format" in the ECMA-262 specification.
-        elif isinstance(o, datetime.datetime):
-            result = o.isoformat()
-            if o.microsecond:
-                result = result[:23] + result[26:]
-            if result.endswith("+00:00"):
-                result = result[:-6] + "Z"
-        elif isinstance(o, datetime.date):
-            result = o.isoformat()
-        elif isinstance(o, datetime.time):
-            if o.utcoffset() is not None:
-                raise ValueError("JSON can't represent timezone-aware times.")
-            result = o.isoformat()
-            if o.microsecond:
-                result = result[:12]
-        elif isinstance(o, memoryview):
-            result = binascii.hexlify(o).decode()
-        elif isinstance(o, bytes):
-            result = binascii.hexlify(o).decode()
-        else:
-            result = super().default(o)
-        return result
+        return _encode_object(o)
+
+
+class FastJSONEncoder:
+    """The `default` hook for orjson.
+
+    Unlike `JSONEncoder`, which tries every query runner encoder before the built-in conversions for
+    every object, this resolves the encoder of a type once and dispatches on the exact type afterwards.
+    """
+
+    def __init__(self):
+        self.encoders = _query_runner_encoders()
+        self.type_encoders = dict(_type_encoders)
+
+    def default(self, o):
+        encoder = self.type_encoders.get(type(o))
+        if encoder is not None:
+            return encoder(o)
+
+        for encoder in self.encoders:
+            result = encoder(self, o)
+            if result:
+                self.type_encoders[type(o)] = functools.partial(self._runner_encode, encoder)
+                return result
+        return _encode_object(o)
+
+    def _runner_encode(self, encoder, o):
+        result = encoder(self, o)
+        if result:
+            return result
+        return _encode_object(o)
+
+
+try:
+    import orjson
+
+    orjson_enabled = True
+    _orjson_options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS | orjson.OPT_NON_STR_KEYS
+except ImportError:
+    orjson_enabled = False
+
+_fast_json_encoder = None
+
+
+def _use_orjson(args, kwargs):
+    if not orjson_enabled or settings.JSON_SERIALIZER != "orjson" or args:
+        return False
+
+    return set(kwargs) <= {"sort_keys", "indent"} and kwargs.get("indent") in (None, 2)
+
+
+def _orjson_dumps(data, sort_keys=False, indent=None):
+    global _fast_json_encoder
+    if _fast_json_encoder is None:
+        _fast_json_encoder = FastJSONEncoder()
+
+    option = _orjson_options
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+    if indent:
+        option |= orjson.OPT_INDENT_2
+
+    # orjson serializes NaN and Infinity as null, like _sanitize_data does.
+    return orjson.dumps(data, default=_fast_json_encoder.default, option=option).decode("utf-8")
 
 
 def json_loads(data, *args, **kwargs):
     """A custom JSON loading function which passes all parameters to the
     json.loads function."""
+    if orjson_enabled and settings.JSON_SERIALIZER == "orjson" and not args and not kwargs:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # e.g. integers orjson can't represent, let json.loads parse (or reject) them.
+            pass
     return json.loads(data, *args, **kwargs)
 
 
@@ -135,6 +237,13 @@ def _sanitize_data(data):
 def json_dumps(data, *args, **kwargs):
     """A custom JSON dumping function which passes all parameters to the
     json.dumps function."""
+    if _use_orjson(args, kwargs):
+        try:
+            return _orjson_dumps(data, **kwargs)
+        except orjson.JSONEncodeError:
+            # e.g. integers over 64 bits or invalid unicode, let json.dumps handle (or reject) them.
+            pass
+
     kwargs.setdefault("cls", JSONEncoder)
     kwargs.setdefault("ensure_ascii", False)
     # Float value nan or inf in Python should be render to None or null in json.
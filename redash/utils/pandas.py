@@ -14,6 +14,98 @@ logger = logging.getLogger(__name__)
 
 pandas_installed = find_spec("pandas") and find_spec("numpy")
 
+# Aggregation functions of an aggregation spec, mapped to their pandas names.
+AGGREGATION_FUNCTIONS = {
+    "count": "count",
+    "count_distinct": "nunique",
+    "sum": "sum",
+    "avg": "mean",
+    "min": "min",
+    "max": "max",
+}
+NUMERIC_AGGREGATIONS = ("sum", "avg")
+
+
+class InvalidAggregationError(Exception):
+    pass
+
+
+def parse_aggregation_spec(spec, columns):
+    """Validate an aggregation spec against the columns of a query result and fill in its defaults:
+
+    {
+        "group_by": ["country"],
+        "aggregations": [{"column": "amount", "function": "sum", "name": "total"}],
+        "sort": [{"column": "total", "direction": "desc"}],
+        "limit": 10
+    }
+
+    `column` may be omitted for `count`, to count rows. `name` defaults to e.g. `sum(amount)`.
+    """
+    if not isinstance(spec, dict):
+        raise InvalidAggregationError("Aggregation spec must be an object.")
+
+    types = {column["name"]: column.get("type") for column in columns}
+
+    group_by = spec.get("group_by") or []
+    if not isinstance(group_by, list) or any(column not in types for column in group_by):
+        raise InvalidAggregationError("group_by must be a list of the result's columns.")
+
+    aggregations = []
+    for aggregation in spec.get("aggregations") or []:
+        if not isinstance(aggregation, dict) or aggregation.get("function") not in AGGREGATION_FUNCTIONS:
+            raise InvalidAggregationError(
+                "Aggregation functions must be one of: {}.".format(", ".join(AGGREGATION_FUNCTIONS))
+            )
+
+        function = aggregation["function"]
+        column = aggregation.get("column")
+        if column is None and function != "count" or column is not None and column not in types:
+            raise InvalidAggregationError("Unknown aggregation column: {}.".format(column))
+
+        name = aggregation.get("name") or ("{}({})".format(function, column) if column else function)
+        aggregations.append({"column": column, "function": function, "name": str(name)})
+
+    if not aggregations:
+        raise InvalidAggregationError("Aggregation spec must have at least one aggregation.")
+
+    output_columns = group_by + [aggregation["name"] for aggregation in aggregations]
+    if len(set(output_columns)) != len(output_columns):
+        raise InvalidAggregationError("Aggregation names must be unique.")
+
+    sort = []
+    for order in spec.get("sort") or []:
+        if not isinstance(order, dict) or order.get("column") not in output_columns:
+            raise InvalidAggregationError("Results can only be sorted by group_by columns or aggregations.")
+        if order.get("direction", "asc") not in ("asc", "desc"):
+            raise InvalidAggregationError("Sort direction must be asc or desc.")
+        sort.append({"column": order["column"], "direction": order.get("direction", "asc")})
+
+    limit = spec.get("limit")
+    if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or limit < 0):
+        raise InvalidAggregationError("limit must be a positive integer.")
+
+    return {"group_by": group_by, "aggregations": aggregations, "sort": sort, "limit": limit}
+
+
+def aggregation_columns(spec, columns):
+    """Return the columns of the result of an aggregation spec (see `parse_aggregation_spec`)."""
+    types = {column["name"]: column.get("type") for column in columns}
+    result = [{"name": name, "friendly_name": name, "type": types[name]} for name in spec["group_by"]]
+
+    for aggregation in spec["aggregations"]:
+        if aggregation["function"] in ("count", "count_distinct"):
+            column_type = TYPE_INTEGER
+        elif aggregation["function"] in NUMERIC_AGGREGATIONS:
+            column_type = TYPE_FLOAT
+        else:
+            column_type = types[aggregation["column"]]
+
+        result.append({"name": aggregation["name"], "friendly_name": aggregation["name"], "type": column_type})
+
+    return result
+
+
 if pandas_installed:
     import numpy as np
     import pandas as pd
@@ -45,3 +137,47 @@ if pandas_installed:
         columns = get_column_types_from_dataframe(df)
         rows = df.to_dict("records")
         return {"columns": columns, "rows": rows}
+
+    def aggregate_result(data: dict, spec: dict) -> dict:
+        """Group, aggregate, sort and limit the rows of a query result by a spec returned from
+        `parse_aggregation_spec`, returning the reduced result."""
+        df = pd.DataFrame.from_records(data["rows"], columns=[column["name"] for column in data["columns"]])
+
+        # Aggregations read from helper columns (values coerced to numbers, a column to count rows), so the
+        # result's own columns stay as they are for the other aggregations and the group keys.
+        df["\0rows"] = 1
+        named_aggregations = {}
+        for aggregation in spec["aggregations"]:
+            column, function = aggregation["column"], AGGREGATION_FUNCTIONS[aggregation["function"]]
+            if column is None:
+                column, function = "\0rows", "size"
+            elif aggregation["function"] in NUMERIC_AGGREGATIONS:
+                df[column + "\0numeric"] = pd.to_numeric(df[column], errors="coerce")
+                column += "\0numeric"
+
+            named_aggregations[aggregation["name"]] = (column, function)
+
+        try:
+            if spec["group_by"]:
+                grouped = df.groupby(spec["group_by"], sort=False, dropna=False)
+                df = grouped.agg(**named_aggregations).reset_index()
+            else:
+                df = pd.DataFrame(
+                    {name: [df[column].agg(function)] for name, (column, function) in named_aggregations.items()}
+                )
+
+            if spec["sort"]:
+                df = df.sort_values(
+                    by=[order["column"] for order in spec["sort"]],
+                    ascending=[order["direction"] == "asc" for order in spec["sort"]],
+                    na_position="last",
+                    kind="stable",
+                )
+        except TypeError as e:
+            raise InvalidAggregationError("Can't aggregate these columns: {}".format(e))
+
+        if spec["limit"] is not None:
+            df = df.head(spec["limit"])
+
+        df = df.astype(object).where(df.notna(), None)
+        return {"columns": aggregation_columns(spec, data["columns"]), "rows": df.to_dict("records")}
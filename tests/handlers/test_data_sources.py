@@ -22,6 +22,38 @@ class TestDataSourceGetSchema(BaseTestCase):
         )
         self.assertEqual(response.status_code, 404)
 
+    def test_returns_page_of_tables(self):
+        self.factory.data_source._store_schema(
+            [{"name": "a.one", "columns": ["id"]}, {"name": "a.two", "columns": ["id"]}, {"name": "b", "columns": []}]
+        )
+
+        response = self.make_request(
+            "get", "/api/data_sources/{}/schema?search=a.&limit=1&offset=1".format(self.factory.data_source.id)
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json, {"schema": [{"name": "a.two"}], "offset": 1, "limit": 1, "total": 2})
+
+    def test_returns_requested_tables(self):
+        self.factory.data_source._store_schema(
+            [{"name": "a.one", "columns": ["id"]}, {"name": "a.two", "columns": ["id"]}, {"name": "b", "columns": []}]
+        )
+
+        response = self.make_request(
+            "get", "/api/data_sources/{}/schema?table=a.one&table=b".format(self.factory.data_source.id)
+        )
+
+        self.assertEqual(
+            response.json, {"schema": [{"name": "a.one", "columns": ["id"]}, {"name": "b", "columns": []}]}
+        )
+
+    def test_rejects_invalid_page(self):
+        self.factory.data_source._store_schema([])
+
+        response = self.make_request("get", "/api/data_sources/{}/schema?limit=x".format(self.factory.data_source.id))
+
+        self.assertEqual(response.status_code, 400)
+
 
 class TestDataSourceListGet(BaseTestCase):
     def test_returns_each_data_source_once(self):
@@ -1,4 +1,3 @@
-import json
 import textwrap
 from unittest import mock
 
@@ -8,6 +7,7 @@ from redash.destinations.discord import Discord
 from redash.destinations.slack import Slack
 from redash.destinations.webex import Webex
 from redash.models import Alert, NotificationDestination
+from redash.utils import json_dumps
 from tests import BaseTestCase
 
 
@@ -141,7 +141,7 @@ def test_discord_notify_calls_requests_post():
 
         mock_post.assert_called_once_with(
             "https://discordapp.com/api/webhooks/test",
-            data=json.dumps(expected_payload),
+            data=json_dumps(expected_payload),
             headers={"Content-Type": "application/json"},
             timeout=5.0,
         )
@@ -248,7 +248,7 @@ def test_slack_notify_calls_requests_post():
 
         mock_post.assert_called_once_with(
             "https://slack.com/api/api.test",
-            data=json.dumps(expected_payload).encode(),
+            data=json_dumps(expected_payload).encode(),
             timeout=5.0,
         )
 
@@ -508,7 +508,7 @@ def test_datadog_notify_calls_requests_post():
 
         mock_post.assert_called_once_with(
             "https://api.datadoghq.com/api/v1/events",
-            data=json.dumps(expected_payload),
+            data=json_dumps(expected_payload),
             headers={
                 "Accept": "application/json",
                 "Content-Type": "application/json",
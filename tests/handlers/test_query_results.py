@@ -1,5 +1,12 @@
+import threading
+
+from mock import call, patch
+
+from redash import rq_redis_connection
 from redash.handlers.query_results import error_messages, run_query
-from redash.models import db
+from redash.models import QueryResult, db
+from redash.tasks.queries import publish_job_status
+from redash.utils import json_loads
 from tests import BaseTestCase
 
 
@@ -79,6 +86,31 @@ class TestQueryResultListAPI(BaseTestCase):
         self.assertNotIn("query_result", rv.json)
         self.assertIn("job", rv.json)
 
+    def test_waits_for_result(self):
+        query_result = self.factory.create_query_result()
+
+        with patch("redash.handlers.query_results.wait_for_query_result", return_value=query_result.id) as wait:
+            rv = self.make_request(
+                "post",
+                "/api/query_results",
+                data={"data_source_id": self.factory.data_source.id, "query": "SELECT 1", "max_age": 0, "wait": 60},
+            )
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.json["query_result"]["id"], query_result.id)
+        self.assertEqual(wait.call_args[0][3], 10)
+
+    def test_returns_job_when_result_isnt_ready(self):
+        with patch("redash.handlers.query_results.wait_for_query_result", return_value=None):
+            rv = self.make_request(
+                "post",
+                "/api/query_results",
+                data={"data_source_id": self.factory.data_source.id, "query": "SELECT 1", "max_age": 0, "wait": 1},
+            )
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn("job", rv.json)
+
     def test_add_limit_change_query_sql(self):
         ds = self.factory.create_data_source(group=self.factory.org.default_group, type="pg")
         query = self.factory.create_query(query_text="SELECT 2", data_source=ds)
@@ -404,6 +436,43 @@ class TestQueryDropdownsResource(BaseTestCase):
         self.assertEqual(rv.status_code, 403)
 
 
+class TestQueryResultWindow(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        data = {
+            "columns": [{"name": "id", "type": "integer"}, {"name": "name", "type": "string"}],
+            "rows": [{"id": i, "name": str(i)} for i in range(10)],
+        }
+        self.query_result = self.factory.create_query_result(data=data)
+        self.query = self.factory.create_query(latest_query_data=self.query_result)
+
+    def test_returns_page_of_rows(self):
+        rv = self.make_request("get", "/api/queries/{}/results.json?offset=2&limit=3".format(self.query.id))
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.json["row_count"], 10)
+        self.assertEqual(rv.json["query_result"]["data"]["rows"], [{"id": i, "name": str(i)} for i in range(2, 5)])
+
+    def test_returns_selected_columns(self):
+        rv = self.make_request("get", "/api/queries/{}/results.json?columns=name&limit=1".format(self.query.id))
+
+        self.assertEqual(rv.json["query_result"]["data"]["columns"], [{"name": "name", "type": "string"}])
+        self.assertEqual(rv.json["query_result"]["data"]["rows"], [{"name": "0"}])
+
+    def test_returns_all_rows_without_window_args(self):
+        rv = self.make_request("get", "/api/queries/{}/results.json".format(self.query.id))
+
+        self.assertNotIn("row_count", rv.json)
+        self.assertEqual(len(rv.json["query_result"]["data"]["rows"]), 10)
+
+    def test_rejects_invalid_window_args(self):
+        rv = self.make_request("get", "/api/queries/{}/results.json?offset=-1".format(self.query.id))
+        self.assertEqual(rv.status_code, 400)
+
+        rv = self.make_request("get", "/api/queries/{}/results.json?limit=a".format(self.query.id))
+        self.assertEqual(rv.status_code, 400)
+
+
 class TestQueryResultExcelResponse(BaseTestCase):
     def test_renders_excel_file(self):
         query = self.factory.create_query()
@@ -454,3 +523,148 @@ class TestJobResource(BaseTestCase):
         job = self.make_request("get", f"/api/jobs/{job_id}").json["job"]
         self.assertEqual(job["status"], FAILED)
         self.assertTrue("cancelled" in job["error"])
+
+
+class TestJobEventsResource(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(rq_redis_connection.flushdb)
+
+    def enqueue(self, query_text):
+        return self.make_request(
+            "post",
+            "/api/query_results",
+            data={"data_source_id": self.factory.data_source.id, "query": query_text, "max_age": 0},
+        ).json["job"]["id"]
+
+    def events(self, response):
+        return [
+            json_loads(line[len("data: ") :])
+            for line in response.data.decode().split("\n")
+            if line.startswith("data: ")
+        ]
+
+    def test_streams_job_updates(self):
+        job_id = self.enqueue("SELECT 1")
+        other_job_id = self.enqueue("SELECT 2")
+        timers = [
+            threading.Timer(0.2, publish_job_status, (job_id,), {"query_result_id": 7, "error": None}),
+            threading.Timer(0.3, publish_job_status, (other_job_id,), {"error": "boom"}),
+        ]
+        for timer in timers:
+            timer.start()
+
+        response = self.make_request("get", f"/api/jobs/events?job_id={job_id}&job_id={other_job_id}")
+        for timer in timers:
+            timer.join()
+
+        self.assertEqual(response.headers["Content-Type"], "text/event-stream")
+        events = [event["job"] for event in self.events(response)]
+        self.assertEqual([(event["id"], event["status"]) for event in events[:2]], [(job_id, 1), (other_job_id, 1)])
+        self.assertEqual((events[2]["id"], events[2]["status"], events[2]["query_result_id"]), (job_id, 3, 7))
+        self.assertEqual((events[3]["id"], events[3]["status"], events[3]["error"]), (other_job_id, 4, "boom"))
+
+    def test_stops_after_timeout(self):
+        job_id = self.enqueue("SELECT 1")
+
+        with patch("redash.settings.JOB_EVENTS_TIMEOUT", 0.1):
+            response = self.make_request("get", f"/api/jobs/events?job_id={job_id}")
+
+        self.assertEqual([event["job"]["status"] for event in self.events(response)], [1])
+
+    def test_reports_missing_jobs(self):
+        response = self.make_request("get", "/api/jobs/events?job_id=missing")
+
+        self.assertEqual(self.events(response)[0]["job"]["status"], 4)
+
+    def test_requires_job_ids(self):
+        response = self.make_request("get", "/api/jobs/events")
+
+        self.assertEqual(response.status_code, 400)
+
+
+class TestQueryResultAggregateResource(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        data = {
+            "columns": [{"name": "country", "type": "string"}, {"name": "amount", "type": "integer"}],
+            "rows": [
+                {"country": "IL", "amount": 1},
+                {"country": "US", "amount": 5},
+                {"country": "IL", "amount": 2},
+                {"country": "FR", "amount": None},
+            ],
+        }
+        self.query_result = self.factory.create_query_result(data=data)
+        self.path = "/api/query_results/{}/aggregate".format(self.query_result.id)
+
+    def test_returns_aggregated_rows(self):
+        spec = {
+            "group_by": ["country"],
+            "aggregations": [{"column": "amount", "function": "sum", "name": "total"}, {"function": "count"}],
+            "sort": [{"column": "total", "direction": "desc"}],
+            "limit": 2,
+        }
+        rv = self.make_request("post", self.path, data=spec)
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(
+            [c["name"] for c in rv.json["query_result"]["data"]["columns"]], ["country", "total", "count"]
+        )
+        self.assertEqual(
+            rv.json["query_result"]["data"]["rows"],
+            [{"country": "US", "total": 5, "count": 1}, {"country": "IL", "total": 3, "count": 2}],
+        )
+
+    def test_caches_aggregations(self):
+        spec = {"aggregations": [{"column": "amount", "function": "max"}]}
+        self.make_request("post", self.path, data=spec)
+
+        with patch("redash.handlers.query_results.aggregate_result") as aggregate_result:
+            rv = self.make_request("post", self.path, data=spec)
+
+        aggregate_result.assert_not_called()
+        self.assertEqual(rv.json["query_result"]["data"]["rows"], [{"max(amount)": 5}])
+
+    def test_decodes_result_once(self):
+        spec = {"group_by": ["country"], "aggregations": [{"function": "count"}]}
+        with patch.object(
+            QueryResult, "get_data_window", autospec=True, side_effect=QueryResult.get_data_window
+        ) as get_data_window:
+            rv = self.make_request("post", self.path, data=spec)
+
+        self.assertEqual(rv.status_code, 200)
+        get_data_window.assert_called_once()
+
+    def test_decodes_only_the_aggregated_columns(self):
+        with patch("redash.settings.QUERY_RESULTS_STORAGE_CODEC", "columnar"):
+            query_result = self.factory.create_query_result(data=self.query_result.data)
+        path = "/api/query_results/{}/aggregate".format(query_result.id)
+        spec = {"group_by": ["country"], "aggregations": [{"function": "count"}]}
+
+        with patch.object(
+            QueryResult, "get_data_window", autospec=True, side_effect=QueryResult.get_data_window
+        ) as get_data_window:
+            rv = self.make_request("post", path, data=spec)
+
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(
+            get_data_window.call_args_list, [call(query_result, limit=0), call(query_result, columns={"country"})]
+        )
+        self.assertEqual(
+            rv.json["query_result"]["data"]["rows"],
+            [{"country": "IL", "count": 2}, {"country": "US", "count": 1}, {"country": "FR", "count": 1}],
+        )
+
+    def test_rejects_unknown_columns(self):
+        rv = self.make_request("post", self.path, data={"group_by": ["city"], "aggregations": [{"function": "count"}]})
+        self.assertEqual(rv.status_code, 400)
+
+    def test_requires_access_to_data_source(self):
+        ds = self.factory.create_data_source(group=self.factory.create_group())
+        query_result = self.factory.create_query_result(data_source=ds)
+
+        rv = self.make_request(
+            "post", "/api/query_results/{}/aggregate".format(query_result.id), data={"aggregations": []}
+        )
+        self.assertEqual(rv.status_code, 403)
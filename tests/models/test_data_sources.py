@@ -1,6 +1,7 @@
 import mock
 from mock import patch
 
+from redash import redis_connection
 from redash.models import DataSource, Query, QueryResult
 from redash.utils.configuration import ConfigurationContainer
 from tests import BaseTestCase
@@ -86,16 +87,80 @@ class DataSourceTest(BaseTestCase):
 
             self.assertEqual(out_schema, sorted_schema)
 
-    @patch("redash.redis_connection.set")
-    def test_expires_schema(self, mock_redis):
+    def test_expires_schema(self):
         # default of 30min + 7 days
         expected_ttl = 606600
 
         with mock.patch("redash.query_runner.pg.PostgreSQL.get_schema") as patched_get_schema:
-            patched_get_schema.return_value = None
+            patched_get_schema.return_value = [{"name": "table", "columns": []}]
             self.factory.data_source.get_schema(refresh=True)
 
-        mock_redis.assert_called_with("data_source:schema:1", "null", ex=expected_ttl)
+        for key in self.factory.data_source._schema_keys.values():
+            self.assertAlmostEqual(redis_connection.ttl(key), expected_ttl, delta=5)
+
+
+class TestDataSourceSchemaCache(BaseTestCase):
+    schema = [
+        {"name": "a.one", "columns": ["id"]},
+        {"name": "a.two", "columns": ["id"]},
+        {"name": "b.one", "columns": ["id"]},
+    ]
+
+    def test_returns_none_when_not_cached(self):
+        self.assertIsNone(self.factory.data_source.get_cached_schema())
+
+    def test_stores_tables_separately(self):
+        data_source = self.factory.data_source
+        self.assertTrue(data_source._store_schema(self.schema))
+
+        self.assertEqual(data_source.get_cached_schema(), self.schema)
+        self.assertEqual(redis_connection.hlen(data_source._schema_keys["tables"]), 3)
+
+    def test_skips_unchanged_schema(self):
+        data_source = self.factory.data_source
+        data_source._store_schema(self.schema)
+
+        with patch.object(redis_connection, "hgetall") as hgetall:
+            self.assertFalse(data_source._store_schema(self.schema))
+            hgetall.assert_not_called()
+
+    def test_writes_only_changed_tables(self):
+        data_source = self.factory.data_source
+        data_source._store_schema(self.schema)
+        schema = [{"name": "a.one", "columns": ["id", "name"]}, self.schema[1], {"name": "c.one", "columns": []}]
+
+        pipe = redis_connection.pipeline()
+        with patch.object(redis_connection, "pipeline", return_value=pipe), patch.object(
+            pipe, "hset", wraps=pipe.hset
+        ) as hset:
+            self.assertTrue(data_source._store_schema(schema))
+
+        self.assertEqual(data_source.get_cached_schema(), schema)
+        self.assertEqual(set(hset.call_args_list[0][1]["mapping"]), {"a.one", "c.one"})
+
+    def test_returns_tables_by_prefix(self):
+        data_source = self.factory.data_source
+        data_source._store_schema(self.schema)
+
+        self.assertEqual(data_source.get_cached_schema(prefix="a."), self.schema[:2])
+        self.assertEqual(data_source.get_cached_schema(prefix="c"), [])
+
+    def test_searches_table_names(self):
+        data_source = self.factory.data_source
+        data_source._store_schema(self.schema + [{"name": "B.Two", "columns": []}])
+
+        self.assertEqual(data_source.search_cached_schema("ONE"), (["a.one", "b.one"], 2))
+        self.assertEqual(data_source.search_cached_schema("b.", prefix=True), (["b.one", "B.Two"], 2))
+        self.assertEqual(data_source.search_cached_schema("", offset=1, limit=2), (["a.two", "b.one"], 4))
+        self.assertEqual(data_source.search_cached_schema("o", offset=2, limit=2), (["b.one", "B.Two"], 4))
+        self.assertEqual(data_source.search_cached_schema("*"), ([], 0))
+
+    def test_search_forgets_removed_tables(self):
+        data_source = self.factory.data_source
+        data_source._store_schema(self.schema)
+        data_source._store_schema(self.schema[1:])
+
+        self.assertEqual(data_source.search_cached_schema("one"), (["b.one"], 1))
 
 
 class TestDataSourceCreate(BaseTestCase):
@@ -167,4 +232,4 @@ class TestDataSourceDelete(BaseTestCase):
         data_source = self.factory.create_data_source()
         data_source.delete()
 
-        mock_redis.assert_called_with(data_source._schema_key)
+        mock_redis.assert_called_with(data_source._schema_key, *data_source._schema_keys.values())
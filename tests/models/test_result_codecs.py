@@ -0,0 +1,232 @@
+from unittest import TestCase
+
+from mock import patch
+
+from redash.models.result_codecs import (
+    CODEC_PREFIX,
+    ColumnarCodec,
+    _storage_codec,
+    decode_result,
+    decode_result_rows,
+    decode_result_window,
+    encode_result,
+    to_columnar,
+)
+from tests import BaseTestCase
+
+data = {
+    "columns": [
+        {"name": "id", "friendly_name": "id", "type": "integer"},
+        {"name": "name", "friendly_name": "name", "type": "string"},
+    ],
+    "rows": [{"id": 1, "name": "a"}, {"id": 2, "name": None}],
+    "metadata": {"data_scanned": 10},
+}
+
+
+class TestToColumnar(TestCase):
+    def test_stores_values_per_column(self):
+        layout = to_columnar(data)
+
+        self.assertEqual(layout["row_count"], 2)
+        self.assertEqual(layout["values"], [[1, 2], ["a", None]])
+        self.assertEqual(layout["extra"], {"metadata": {"data_scanned": 10}})
+
+    def test_returns_none_for_rows_with_missing_keys(self):
+        self.assertIsNone(to_columnar({"columns": data["columns"], "rows": [{"id": 1}]}))
+
+    def test_returns_none_for_rows_with_unknown_keys(self):
+        self.assertIsNone(to_columnar({"columns": data["columns"], "rows": [{"id": 1, "other": 2}]}))
+
+    def test_returns_none_for_data_without_rows(self):
+        self.assertIsNone(to_columnar({}))
+
+
+class TestResultCodecs(TestCase):
+    def test_json_codec_stores_plain_json(self):
+        with patch("redash.settings.QUERY_RESULTS_STORAGE_CODEC", "json"):
+            encoded = encode_result(data)
+
+        self.assertFalse(encoded.startswith(CODEC_PREFIX))
+        self.assertEqual(decode_result(encoded), data)
+
+    def test_columnar_codec_roundtrip(self):
+        with patch("redash.settings.QUERY_RESULTS_STORAGE_CODEC", "columnar"):
+            encoded = encode_result(data)
+
+        self.assertTrue(encoded.startswith(CODEC_PREFIX + "columnar:"))
+        self.assertEqual(decode_result(encoded), data)
+
+    def test_columnar_codec_falls_back_to_json(self):
+        irregular = {"columns": data["columns"], "rows": [{"id": 1}]}
+        with patch("redash.settings.QUERY_RESULTS_STORAGE_CODEC", "columnar"):
+            encoded = encode_result(irregular)
+
+        self.assertFalse(encoded.startswith(CODEC_PREFIX))
+        self.assertEqual(decode_result(encoded), irregular)
+
+    def test_compressed_columnar_codecs_roundtrip(self):
+        for codec in ("columnar+zstd", "columnar+lz4"):
+            with patch("redash.settings.QUERY_RESULTS_STORAGE_CODEC", codec):
+                encoded = encode_result(data)
+
+            self.assertTrue(encoded.startswith(CODEC_PREFIX + codec + ":"))
+            self.assertEqual(decode_result(encoded), data)
+            self.assertEqual(decode_result_window(encoded, 1, 1)[0]["rows"], data["rows"][1:])
+
+    def test_unavailable_codec_falls_back_to_json(self):
+        with patch("redash.settings.QUERY_RESULTS_STORAGE_CODEC", "unknown"):
+            encoded = encode_result(data)
+
+        self.assertEqual(decode_result(encoded), data)
+
+    def test_warns_about_unavailable_codec_once(self):
+        with patch("redash.settings.QUERY_RESULTS_STORAGE_CODEC", "columnar+zstd"), patch(
+            "redash.models.result_codecs.zstd_enabled", False
+        ), patch("redash.models.result_codecs.logger") as logger:
+            _storage_codec.cache_clear()
+            self.addCleanup(_storage_codec.cache_clear)
+            encoded = [encode_result(data) for _ in range(3)]
+
+        self.assertFalse(encoded[0].startswith(CODEC_PREFIX))
+        logger.warning.assert_called_once()
+
+
+class TestDecodeResultWindow(TestCase):
+    data = {
+        "columns": data["columns"],
+        "rows": [{"id": i, "name": str(i)} for i in range(25)],
+        "metadata": {"data_scanned": 10},
+    }
+
+    def assertWindow(self, encoded, offset, limit, columns=None):
+        expected_rows = self.data["rows"][offset : None if limit is None else offset + limit]
+        names = columns or ["id", "name"]
+
+        window, row_count = decode_result_window(encoded, offset, limit, columns)
+
+        self.assertEqual(row_count, 25)
+        self.assertEqual([column["name"] for column in window["columns"]], names)
+        self.assertEqual(window["rows"], [{name: row[name] for name in names} for row in expected_rows])
+        self.assertEqual(window["metadata"], {"data_scanned": 10})
+
+    def test_json_codec(self):
+        with patch("redash.settings.QUERY_RESULTS_STORAGE_CODEC", "json"):
+            encoded = encode_result(self.data)
+
+        self.assertWindow(encoded, 5, 10)
+        self.assertWindow(encoded, 20, None, ["name"])
+
+    def test_columnar_codec_across_blocks(self):
+        with patch("redash.settings.QUERY_RESULTS_STORAGE_CODEC", "columnar"), patch(
+            "redash.settings.QUERY_RESULTS_COLUMNAR_BLOCK_SIZE", 4
+        ):
+            encoded = encode_result(self.data)
+
+        self.assertWindow(encoded, 0, None)
+        self.assertWindow(encoded, 3, 10)
+        self.assertWindow(encoded, 8, 4, ["name"])
+        self.assertWindow(encoded, 22, 100, ["id"])
+        self.assertWindow(encoded, 30, 10)
+        self.assertWindow(encoded, 0, 0)
+
+    def test_columnar_codec_empty_result(self):
+        empty = {"columns": data["columns"], "rows": []}
+        with patch("redash.settings.QUERY_RESULTS_STORAGE_CODEC", "columnar"):
+            encoded = encode_result(empty)
+
+        self.assertEqual(decode_result(encoded), empty)
+        self.assertEqual(decode_result_window(encoded, 0, 10), (empty, 0))
+
+
+class TestDecodeResultRows(TestCase):
+    data = TestDecodeResultWindow.data
+
+    def assertRows(self, encoded):
+        columns, rows = decode_result_rows(encoded)
+
+        self.assertEqual(columns, self.data["columns"])
+        self.assertEqual(list(rows), self.data["rows"])
+
+    def test_json_codec(self):
+        with patch("redash.settings.QUERY_RESULTS_STORAGE_CODEC", "json"):
+            encoded = encode_result(self.data)
+
+        with patch("redash.models.result_codecs.ijson_enabled", False):
+            self.assertRows(encoded)
+
+    def test_json_codec_with_ijson(self):
+        with patch("redash.settings.QUERY_RESULTS_STORAGE_CODEC", "json"):
+            encoded = encode_result(self.data)
+
+        self.assertRows(encoded)
+
+    def test_columnar_codec_across_blocks(self):
+        with patch("redash.settings.QUERY_RESULTS_STORAGE_CODEC", "columnar"), patch(
+            "redash.settings.QUERY_RESULTS_COLUMNAR_BLOCK_SIZE", 4
+        ):
+            encoded = encode_result(self.data)
+
+        self.assertRows(encoded)
+
+    def test_columnar_codec_decodes_blocks_as_it_goes(self):
+        with patch("redash.settings.QUERY_RESULTS_STORAGE_CODEC", "columnar"), patch(
+            "redash.settings.QUERY_RESULTS_COLUMNAR_BLOCK_SIZE", 4
+        ):
+            encoded = encode_result(self.data)
+
+        with patch.object(
+            ColumnarCodec, "_decode_segment", autospec=True, side_effect=ColumnarCodec._decode_segment
+        ) as decode_segment:
+            columns, rows = decode_result_rows(encoded)
+            self.assertEqual(next(rows), self.data["rows"][0])
+            # The header and the first block of each column.
+            self.assertEqual(decode_segment.call_count, 3)
+            self.assertEqual(list(rows), self.data["rows"][1:])
+
+    def test_columnar_codec_empty_result(self):
+        with patch("redash.settings.QUERY_RESULTS_STORAGE_CODEC", "columnar"):
+            encoded = encode_result({"columns": data["columns"], "rows": []})
+
+        columns, rows = decode_result_rows(encoded)
+        self.assertEqual(columns, data["columns"])
+        self.assertEqual(list(rows), [])
+
+
+class TestQueryResultStorageCodec(BaseTestCase):
+    def test_reads_results_stored_with_columnar_codec(self):
+        with patch("redash.settings.QUERY_RESULTS_STORAGE_CODEC", "columnar"):
+            query_result = self.factory.create_query_result(data=data)
+            self.db.session.commit()
+
+        self.db.session.expire(query_result)
+        self.assertEqual(query_result.data, data)
+        self.assertEqual(query_result.to_dict()["data"], data)
+
+    def test_decodes_windows(self):
+        json_result = self.factory.create_query_result(data=data)
+        with patch("redash.settings.QUERY_RESULTS_STORAGE_CODEC", "columnar"):
+            columnar_result = self.factory.create_query_result(data=data)
+
+        self.assertFalse(json_result.decodes_windows())
+        self.assertTrue(columnar_result.decodes_windows())
+
+    def test_get_data_window(self):
+        with patch("redash.settings.QUERY_RESULTS_STORAGE_CODEC", "columnar"):
+            query_result = self.factory.create_query_result(data=data)
+            self.db.session.commit()
+
+        window, row_count = query_result.get_data_window(1, 1, ["name"])
+
+        self.assertEqual(row_count, 2)
+        self.assertEqual(window["rows"], [{"name": None}])
+
+    def test_iter_rows(self):
+        with patch("redash.settings.QUERY_RESULTS_STORAGE_CODEC", "columnar"):
+            query_result = self.factory.create_query_result(data=data)
+            self.db.session.commit()
+
+        columns, rows = query_result.iter_rows()
+
+        self.assertEqual(columns, data["columns"])
+        self.assertEqual(list(rows), data["rows"])
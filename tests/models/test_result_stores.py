@@ -0,0 +1,144 @@
+import os
+import tempfile
+
+from mock import patch
+
+from redash import models
+from redash.models.result_codecs import (
+    BLOB_REFERENCE_PREFIX,
+    EncodedResult,
+    blob_reference,
+    decode_result,
+    decode_result_rows,
+    decode_result_window,
+    encode_result,
+)
+from redash.tasks import cleanup_query_results
+from redash.utils import json_dumps, utcnow
+from tests import BaseTestCase
+
+data = {
+    "columns": [{"name": "id", "friendly_name": "id", "type": "integer"}],
+    "rows": [{"id": i} for i in range(100)],
+}
+
+
+class BlobStoreTestCase(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = tempfile.mkdtemp()
+        self.patches = [
+            patch("redash.settings.QUERY_RESULTS_BLOB_STORE", "filesystem"),
+            patch("redash.settings.QUERY_RESULTS_BLOB_STORE_PATH", self.path),
+            patch("redash.settings.QUERY_RESULTS_BLOB_STORE_THRESHOLD", 100),
+            patch("redash.models.result_stores._instances", {}),
+        ]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+        super().tearDown()
+
+
+class TestBlobOffloading(BlobStoreTestCase):
+    def test_offloads_results_above_threshold(self):
+        encoded = EncodedResult(data).encoded
+
+        self.assertTrue(encoded.startswith(BLOB_REFERENCE_PREFIX))
+        self.assertTrue(os.path.exists(os.path.join(self.path, blob_reference(encoded)["key"])))
+        self.assertEqual(blob_reference(encoded)["row_count"], 100)
+        self.assertEqual(blob_reference(encoded)["columns"], data["columns"])
+        self.assertEqual(decode_result(encoded), data)
+
+    def test_encoded_result_has_size_of_offloaded_payload(self):
+        encoded = EncodedResult(data)
+
+        self.assertTrue(encoded.encoded.startswith(BLOB_REFERENCE_PREFIX))
+        self.assertEqual(encoded.size, len(json_dumps(data)))
+        self.assertEqual(encoded.row_count, 100)
+
+    def test_encoded_result_has_size_in_bytes(self):
+        unicode_data = {"columns": data["columns"], "rows": [{"id": "é"} for _ in range(100)]}
+        encoded = EncodedResult(unicode_data)
+
+        self.assertEqual(encoded.size, len(json_dumps(unicode_data).encode("utf-8")))
+
+    def test_keeps_small_results_inline(self):
+        small = {"columns": data["columns"], "rows": [{"id": 1}]}
+        encoded = EncodedResult(small).encoded
+
+        self.assertIsNone(blob_reference(encoded))
+        self.assertEqual(decode_result(encoded), small)
+
+    def test_keeps_results_bound_outside_of_store_result_inline(self):
+        encoded = encode_result(data)
+
+        self.assertIsNone(blob_reference(encoded))
+        self.assertEqual(os.listdir(self.path), [])
+        self.assertEqual(decode_result(encoded), data)
+
+    def test_decodes_window_of_offloaded_result(self):
+        encoded = EncodedResult(data).encoded
+
+        self.assertEqual(decode_result_window(encoded, 10, 2), ({**data, "rows": [{"id": 10}, {"id": 11}]}, 100))
+
+    def test_iterates_rows_of_offloaded_result(self):
+        columns, rows = decode_result_rows(EncodedResult(data).encoded)
+
+        self.assertEqual(columns, data["columns"])
+        self.assertEqual(list(rows), data["rows"])
+
+    def test_reads_columns_from_reference(self):
+        encoded = EncodedResult(data).encoded
+
+        with patch("redash.models.result_codecs.get_result_store") as get_result_store:
+            self.assertEqual(decode_result_window(encoded, 0, 0), ({**data, "rows": []}, 100))
+            get_result_store.assert_not_called()
+
+    def test_loads_offloaded_query_result(self):
+        query_result = self.factory.create_query_result(data=EncodedResult(data))
+        models.db.session.commit()
+        models.db.session.expire(query_result)
+
+        self.assertEqual(query_result.data, data)
+
+    def store_result(self):
+        query_result = models.QueryResult.store_result(
+            self.factory.org.id, self.factory.data_source, "hash", "SELECT 1", data, 1, utcnow()
+        )
+        return os.path.join(self.path, blob_reference(query_result.data.encoded)["key"])
+
+    def test_keeps_blobs_of_committed_results(self):
+        path = self.store_result()
+        models.db.session.commit()
+
+        self.assertTrue(os.path.exists(path))
+
+    def test_deletes_blobs_of_results_that_are_rolled_back(self):
+        path = self.store_result()
+        self.assertTrue(os.path.exists(path))
+
+        models.db.session.rollback()
+
+        self.assertFalse(os.path.exists(path))
+
+    def test_deletes_blobs_of_results_that_are_never_committed(self):
+        path = self.store_result()
+        models.db.session.close()
+
+        self.assertFalse(os.path.exists(path))
+
+    def test_cleanup_deletes_blobs(self):
+        query_result = self.factory.create_query_result(data=EncodedResult(data))
+        query_result.retrieved_at = query_result.retrieved_at.replace(year=2000)
+        models.db.session.commit()
+        (blob,) = models.QueryResult.blob_references(models.QueryResult.query)
+        path = os.path.join(self.path, blob[1])
+        self.assertTrue(os.path.exists(path))
+
+        cleanup_query_results()
+
+        self.assertIsNone(models.QueryResult.query.filter(models.QueryResult.id == query_result.id).first())
+        self.assertFalse(os.path.exists(path))
@@ -1,6 +1,16 @@
 import unittest
+from decimal import Decimal
 
-from redash.query_runner import BaseQueryRunner
+from mock import Mock, patch
+
+from redash.query_runner import (
+    BaseQueryRunner,
+    ConnectionPool,
+    ResultBuilder,
+    _value_size,
+    connection_pools,
+    with_ssh_tunnel,
+)
 
 
 class TestBaseQueryRunner(unittest.TestCase):
@@ -30,5 +40,227 @@ class TestBaseQueryRunner(unittest.TestCase):
         self.assertEqual(new_columns, expected)
 
 
+class TestResultBuilder(unittest.TestCase):
+    columns = [{"name": "id", "friendly_name": "id", "type": "integer"}, {"name": "value", "type": "float"}]
+
+    def test_builds_result_from_batches(self):
+        builder = ResultBuilder(max_rows=0, max_bytes=0)
+        builder.set_columns(self.columns)
+
+        self.assertTrue(builder.add_rows([(1, 1.5), (2, None)]))
+        self.assertTrue(builder.add_rows([(3, 3.5)]))
+
+        self.assertEqual(
+            {
+                "columns": self.columns,
+                "rows": [{"id": 1, "value": 1.5}, {"id": 2, "value": None}, {"id": 3, "value": 3.5}],
+            },
+            builder.build(),
+        )
+        self.assertEqual(3, builder.row_count)
+
+    def test_returns_none_without_columns(self):
+        self.assertIsNone(ResultBuilder().build())
+
+    def test_converts_values(self):
+        builder = ResultBuilder(max_rows=0, max_bytes=0)
+        builder.set_columns(self.columns)
+        builder.add_rows([(1, None)])
+        builder.add_rows([(2, Decimal("2.5"))])
+
+        self.assertEqual([{"id": 1, "value": None}, {"id": 2, "value": 2.5}], builder.build()["rows"])
+
+    def test_truncates_at_max_rows(self):
+        builder = ResultBuilder(max_rows=3, max_bytes=0)
+        builder.set_columns(self.columns)
+
+        self.assertTrue(builder.add_rows([(1, 1.0), (2, 2.0)]))
+        self.assertFalse(builder.add_rows([(3, 3.0), (4, 4.0)]))
+        self.assertFalse(builder.add_rows([(5, 5.0)]))
+
+        data = builder.build()
+        self.assertEqual([1, 2, 3], [row["id"] for row in data["rows"]])
+        self.assertTrue(data["truncated"])
+
+    def test_truncates_at_max_bytes(self):
+        builder = ResultBuilder(max_rows=0, max_bytes=20)
+        builder.set_columns(self.columns)
+
+        self.assertFalse(builder.add_rows([(i, float(i)) for i in range(10)]))
+
+        data = builder.build()
+        self.assertLess(len(data["rows"]), 10)
+        self.assertTrue(data["truncated"])
+
+    def test_estimates_size_from_a_sample_of_rows(self):
+        builder = ResultBuilder(max_rows=0, max_bytes=20000)
+        builder.set_columns(self.columns)
+
+        with patch("redash.query_runner._value_size", wraps=_value_size) as value_size:
+            self.assertTrue(builder.add_rows([(i, float(i)) for i in range(1000)]))
+
+        self.assertEqual(200, value_size.call_count)
+        self.assertEqual(16000, builder.size)
+
+    def test_doesnt_measure_rows_without_max_bytes(self):
+        builder = ResultBuilder(max_rows=0, max_bytes=0)
+        builder.set_columns(self.columns)
+
+        with patch("redash.query_runner._value_size") as value_size:
+            builder.add_rows([(1, 1.0)])
+
+        value_size.assert_not_called()
+
+    def test_adds_result_of_other_query_runners(self):
+        builder = ResultBuilder(max_rows=1, max_bytes=0)
+        builder.add_result({"columns": self.columns, "rows": [{"id": 1}, {"id": 2}], "metadata": {"x": 1}})
+
+        self.assertEqual(
+            {"columns": self.columns, "rows": [{"id": 1}], "metadata": {"x": 1}, "truncated": True},
+            builder.build(),
+        )
+
+    def test_adds_dict_rows(self):
+        builder = ResultBuilder(max_rows=2, max_bytes=0)
+
+        self.assertTrue(builder.add_records([{"id": 1}]))
+        self.assertFalse(builder.add_records([{"id": 2}, {"id": 3}]))
+        builder.columns = self.columns[:1]
+
+        self.assertEqual(
+            {"columns": self.columns[:1], "rows": [{"id": 1}, {"id": 2}], "truncated": True}, builder.build()
+        )
+
+    def test_discard(self):
+        builder = ResultBuilder()
+        builder.set_columns(self.columns)
+        builder.add_rows([(1, 1.0)])
+        builder.discard()
+
+        self.assertIsNone(builder.build())
+
+
+class TunnelledQueryRunner(BaseQueryRunner):
+    host = "db.internal"
+    port = 5432
+
+    def run_query_into(self, query, user, builder):
+        builder.add_result({"columns": [{"name": "address"}], "rows": [{"address": (self.host, self.port)}]})
+
+    def run_query(self, query, user):
+        return self.run_query_buffered(query, user)
+
+
+class TestWithSSHTunnel(unittest.TestCase):
+    def setUp(self):
+        patcher = patch("redash.query_runner.open_tunnel")
+        self.open_tunnel = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.open_tunnel.return_value.__enter__.return_value.local_bind_address = ("localhost", 10022)
+        self.query_runner = with_ssh_tunnel(TunnelledQueryRunner({}), {"ssh_host": "bastion", "ssh_username": "u"})
+
+    def test_run_query_into_goes_through_tunnel(self):
+        builder = ResultBuilder()
+        self.query_runner.run_query_into("SELECT 1", None, builder)
+
+        self.assertEqual([{"address": ("localhost", 10022)}], builder.build()["rows"])
+        self.open_tunnel.assert_called_once_with(
+            ("bastion", 22), remote_bind_address=("db.internal", 5432), ssh_username="u"
+        )
+        self.assertEqual(("db.internal", 5432), (self.query_runner.host, self.query_runner.port))
+
+    def test_run_query_opens_one_tunnel(self):
+        data, _ = self.query_runner.run_query("SELECT 1", None)
+
+        self.assertEqual([{"address": ("localhost", 10022)}], data["rows"])
+        self.open_tunnel.assert_called_once()
+
+
+class PoolingQueryRunner(BaseQueryRunner):
+    pool_connections = True
+
+    def __init__(self, configuration):
+        super().__init__(configuration)
+        self.healthy = True
+
+    def _connect(self):
+        return Mock(closed=False)
+
+    def _is_connection_healthy(self, connection):
+        return self.healthy
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        self.query_runner = PoolingQueryRunner({"host": "example.com"})
+        self.addCleanup(connection_pools.clear)
+
+    def test_reuses_released_connections(self):
+        with self.query_runner.pooled_connection() as first:
+            pass
+        with self.query_runner.pooled_connection() as second:
+            pass
+
+        self.assertIs(first, second)
+        first.close.assert_not_called()
+
+    def test_closes_connections_that_raised(self):
+        with self.assertRaises(ValueError):
+            with self.query_runner.pooled_connection() as first:
+                raise ValueError()
+        with self.query_runner.pooled_connection() as second:
+            pass
+
+        self.assertIsNot(first, second)
+        first.close.assert_called_once()
+
+    def test_replaces_unhealthy_connections(self):
+        with self.query_runner.pooled_connection() as first:
+            pass
+        self.query_runner.healthy = False
+        with self.query_runner.pooled_connection() as second:
+            pass
+
+        self.assertIsNot(first, second)
+        first.close.assert_called_once()
+
+    def test_uses_new_pool_when_configuration_changes(self):
+        with self.query_runner.pooled_connection() as first:
+            pass
+        with PoolingQueryRunner({"host": "example.org"}).pooled_connection() as second:
+            pass
+
+        self.assertIsNot(first, second)
+
+    def test_does_not_pool_when_disabled(self):
+        with patch("redash.settings.QUERY_RUNNER_CONNECTION_POOL_SIZE", 0):
+            with self.query_runner.pooled_connection() as connection:
+                pass
+
+        connection.close.assert_called_once()
+        self.assertEqual({}, connection_pools)
+
+    def test_keeps_at_most_max_size_connections(self):
+        pool = ConnectionPool("test", max_size=1, max_idle=60)
+        connections = [pool.acquire(self.query_runner) for _ in range(2)]
+        for connection in connections:
+            pool.release(self.query_runner, connection)
+
+        self.assertEqual(1, len(pool))
+        connections[1].close.assert_called_once()
+
+    def test_evicts_idle_connections(self):
+        pool = ConnectionPool("test", max_size=2, max_idle=60)
+        connection = pool.acquire(self.query_runner)
+        with patch("time.time", return_value=1000):
+            pool.release(self.query_runner, connection)
+
+        pool.evict(now=1030)
+        self.assertEqual(1, len(pool))
+        pool.evict(now=1061)
+        self.assertEqual(0, len(pool))
+        connection.close.assert_called_once()
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,6 +1,64 @@
+import datetime
+import threading
 import unittest
 
-from redash.query_runner.big_query import BigQuery
+from mock import patch
+
+from redash.query_runner.big_query import BigQuery, transform_rows
+
+
+class Request:
+    def __init__(self, reply):
+        self.reply = reply
+
+    def execute(self):
+        return self.reply
+
+
+class FakeJobs:
+    """A stub of the BigQuery `jobs` service, with a finished job whose results have `total_rows` rows. It returns
+    at most `page_size` rows per reply (and only `short_page_size` for some start indexes)."""
+
+    fields = [
+        {"name": "id", "type": "INTEGER"},
+        {"name": "score", "type": "FLOAT"},
+        {"name": "tags", "type": "STRING", "mode": "REPEATED"},
+    ]
+
+    def __init__(self, total_rows, page_size, short_pages=()):
+        self.total_rows = total_rows
+        self.page_size = page_size
+        self.short_pages = short_pages
+        self.requests = []
+        self.threads = set()
+
+    def insert(self, projectId, body):
+        return Request({"jobReference": {"jobId": "job", "location": "US"}})
+
+    def getQueryResults(self, projectId, location, jobId, startIndex, maxResults=None):
+        self.requests.append((startIndex, maxResults))
+        self.threads.add(threading.get_ident())
+        count = min(self.page_size, maxResults or self.page_size)
+        if startIndex in self.short_pages:
+            count = min(count, 2)
+
+        rows = [
+            {"f": [{"v": str(i)}, {"v": None if i % 2 else "{}.5".format(i)}, {"v": [{"v": "t{}".format(i)}]}]}
+            for i in range(startIndex, min(startIndex + count, self.total_rows))
+        ]
+        reply = {
+            "jobComplete": True,
+            "totalRows": str(self.total_rows),
+            "schema": {"fields": self.fields},
+            "totalBytesProcessed": "100",
+        }
+        if rows:
+            reply["rows"] = rows
+        return Request(reply)
+
+
+def expected_rows(count):
+    return [{"id": i, "score": None if i % 2 else i + 0.5, "tags": ["t{}".format(i)]} for i in range(count)]
 
 
 class TestBigQueryQueryRunner(unittest.TestCase):
@@ -43,3 +101,67 @@ class TestBigQueryQueryRunner(unittest.TestCase):
         expect = query
 
         self.assertEqual(query_runner.annotate_query(query, metadata), expect)
+
+
+class TestGetQueryResult(unittest.TestCase):
+    def setUp(self):
+        self.query_runner = BigQuery({"projectId": "project"})
+
+    def test_fetches_pages_concurrently_in_order(self):
+        jobs = FakeJobs(total_rows=95, page_size=10)
+        factory_jobs = []
+
+        def jobs_factory():
+            factory_jobs.append(jobs)
+            return jobs
+
+        with patch("redash.settings.BIGQUERY_PAGE_FETCH_WORKERS", 3):
+            data = self.query_runner._get_query_result(jobs, "SELECT 1", jobs_factory=jobs_factory)
+
+        self.assertEqual(expected_rows(95), data["rows"])
+        self.assertEqual(["id", "score", "tags"], [column["name"] for column in data["columns"]])
+        self.assertEqual({"data_scanned": 100}, data["metadata"])
+        self.assertEqual([(0, None)] + [(i, 10) for i in range(10, 90, 10)] + [(90, 5)], sorted(jobs.requests))
+        self.assertLessEqual(len(factory_jobs), 3)
+
+    def test_fills_short_pages(self):
+        jobs = FakeJobs(total_rows=40, page_size=10, short_pages=(20,))
+
+        with patch("redash.settings.BIGQUERY_PAGE_FETCH_WORKERS", 2):
+            data = self.query_runner._get_query_result(jobs, "SELECT 1", jobs_factory=lambda: jobs)
+
+        self.assertEqual(expected_rows(40), data["rows"])
+        self.assertIn((22, 8), jobs.requests)
+
+    def test_fetches_pages_one_after_another_without_jobs_factory(self):
+        jobs = FakeJobs(total_rows=25, page_size=10)
+
+        data = self.query_runner._get_query_result(jobs, "SELECT 1")
+
+        self.assertEqual(expected_rows(25), data["rows"])
+        self.assertEqual([(0, None), (10, 10), (20, 5)], jobs.requests)
+        self.assertEqual({threading.get_ident()}, jobs.threads)
+
+    def test_empty_result(self):
+        jobs = FakeJobs(total_rows=0, page_size=10)
+
+        data = self.query_runner._get_query_result(jobs, "SELECT 1", jobs_factory=lambda: jobs)
+
+        self.assertEqual([], data["rows"])
+        self.assertEqual([(0, None)], jobs.requests)
+
+
+class TestTransformRows(unittest.TestCase):
+    def test_transforms_cells_by_type(self):
+        fields = [
+            {"name": "flag", "type": "BOOLEAN"},
+            {"name": "at", "type": "TIMESTAMP"},
+            {"name": "name", "type": "STRING"},
+            {"name": "count", "type": "INTEGER"},
+        ]
+        rows = [{"f": [{"v": "true"}, {"v": "0"}, {"v": "a"}, {"v": None}]}]
+
+        self.assertEqual(
+            [{"flag": True, "at": datetime.datetime.fromtimestamp(0), "name": "a", "count": None}],
+            transform_rows(rows, fields),
+        )
@@ -2,10 +2,15 @@
 Some test cases for JSON api runner
 """
 
+import threading
+import time
+from io import BytesIO
 from unittest import TestCase
 from urllib.parse import urlencode, urljoin
 
-from redash.query_runner.json_ds import JSON
+from mock import Mock, patch
+
+from redash.query_runner.json_ds import JSON, JSONRowParser, parse_json
 
 
 def mock_api(url, method, **request_options):
@@ -55,6 +60,10 @@ class TestJSON(TestCase):
     def setUp(self):
         self.runner = JSON({"base_url": "http://localhost/"})
         self.runner._get_json_response = mock_api
+        # Single page responses are streamed when ijson is installed, which doesn't go through mock_api.
+        patcher = patch("redash.query_runner.json_ds.ijson_enabled", False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test_basics(self):
         q = {"url": "basics"}
@@ -87,3 +96,166 @@ class TestJSON(TestCase):
 
         expected = [{"id": 10}, {"id": 11}, {"id": 12}]
         self.assertEqual(results["rows"], expected)
+
+    def test_stops_at_max_rows(self):
+        q = {
+            "url": "token-test",
+            "pagination": {"type": "token", "fields": ["next_page_token", "page_token"]},
+            "path": "records",
+        }
+        with patch("redash.settings.QUERY_RESULTS_MAX_ROWS", 3):
+            results, error = self.runner._run_json_query(q)
+
+        self.assertIsNone(error)
+        self.assertEqual(results["rows"], [{"id": 1}, {"id": 2}, {"id": 3}])
+        self.assertTrue(results["truncated"])
+
+    def test_run_query_returns_error(self):
+        results, error = self.runner.run_query("url: missing", None)
+
+        self.assertIsNone(results)
+        self.assertEqual(error, "404: http://localhost/missing not found")
+
+    def test_run_query_into_discards_result_on_error(self):
+        builder = self.runner.result_builder()
+        error = self.runner.run_query_into("url: missing", None, builder)
+
+        self.assertEqual(error, "404: http://localhost/missing not found")
+        self.assertIsNone(builder.build())
+
+    def test_discards_earlier_pages_on_error(self):
+        def api(url, method, **request_options):
+            if "page_token" in request_options.get("params", {}):
+                return {}, "500: failed"
+            return {"next_page_token": "2", "records": [{"id": 1}]}, None
+
+        self.runner._get_json_response = api
+        builder = self.runner.result_builder()
+        error = self.runner.run_query_into("{url: paged, path: records, pagination: {type: token}}", None, builder)
+
+        self.assertEqual(error, "500: failed")
+        self.assertIsNone(builder.build())
+
+    def test_stops_reading_pages_that_arent_needed(self):
+        def endless_page(chunk_size):
+            yield b'{"records": ['
+            while True:
+                time.sleep(0.01)
+                yield b" "
+
+        first_page = Mock()
+        first_page.iter_content.return_value = [b'{"next_page_token": "2", "records": [{"id": 1}, {"id": 2}]}']
+        next_page = Mock()
+        next_page.iter_content.side_effect = endless_page
+        next_page_closed = threading.Event()
+        next_page.close.side_effect = next_page_closed.set
+
+        next_page_requested = threading.Event()
+
+        def get_response(url, http_method, stream, **request_options):
+            if "params" not in request_options:
+                return first_page, None
+            next_page_requested.set()
+            return next_page, None
+
+        def parse_row(parser, row):
+            # The rows of the first page are parsed while the next one is being read.
+            next_page_requested.wait(5)
+            return parse_row.original(parser, row)
+
+        parse_row.original = JSONRowParser.parse_row
+        runner = JSON({"base_url": "http://localhost/"})
+        query = {"url": "paged", "path": "records", "pagination": {"type": "token"}}
+        with patch("redash.settings.QUERY_RESULTS_MAX_ROWS", 1), patch.object(
+            runner, "get_response", side_effect=get_response
+        ), patch.object(JSONRowParser, "parse_row", parse_row):
+            results, error = runner._run_json_query(query)
+
+        self.assertEqual(results["rows"], [{"id": 1}])
+        self.assertTrue(next_page_closed.wait(5))
+
+
+class TestParseJSON(TestCase):
+    def test_flattens_nested_objects(self):
+        data = [{"id": 1, "user": {"name": "a", "age": 3}}, {"id": 2, "extra": True}]
+
+        self.assertEqual(
+            parse_json(data, None),
+            {
+                "rows": [{"id": 1, "user.name": "a", "user.age": 3}, {"id": 2, "extra": True}],
+                "columns": [
+                    {"name": "id", "friendly_name": "id", "type": "integer"},
+                    {"name": "user.name", "friendly_name": "user.name", "type": "string"},
+                    {"name": "user.age", "friendly_name": "user.age", "type": "integer"},
+                    {"name": "extra", "friendly_name": "extra", "type": "boolean"},
+                ],
+            },
+        )
+
+    def test_keeps_fields_in_order(self):
+        data = [{"id": 1, "user": {"name": "a", "age": 3}}]
+
+        result = parse_json(data, ["user.name", "id"])
+
+        self.assertEqual(result["rows"], [{"id": 1, "user.name": "a"}])
+        self.assertEqual([column["name"] for column in result["columns"]], ["user.name", "id"])
+
+
+class TestStreamedJSON(TestCase):
+    def setUp(self):
+        self.runner = JSON({"base_url": "http://localhost/"})
+
+    def run_json_query(self, query, body):
+        response = Mock(raw=BytesIO(body))
+        with patch.object(self.runner, "get_response", return_value=(response, None)) as get_response:
+            results, error = self.runner._run_json_query(query)
+
+        get_response.assert_called_once_with("http://localhost/api", http_method="get", stream=True)
+        response.close.assert_called_once_with()
+        return results, error
+
+    def test_streams_items_at_path(self):
+        body = b'{"meta": {"count": 2}, "data": {"records": [{"id": 1, "x": {"y": 1.5}}, {"id": 2, "x": {"y": 2}}]}}'
+
+        results, error = self.run_json_query({"url": "api", "path": "data.records"}, body)
+
+        self.assertIsNone(error)
+        self.assertEqual(results["rows"], [{"id": 1, "x.y": 1.5}, {"id": 2, "x.y": 2}])
+
+    def test_streams_top_level_array(self):
+        results, error = self.run_json_query({"url": "api"}, b'[{"id": 1}, {"id": 2}]')
+
+        self.assertEqual(results["rows"], [{"id": 1}, {"id": 2}])
+
+    def test_object_at_path_is_a_row(self):
+        results, error = self.run_json_query({"url": "api", "path": "data"}, b'{"data": {"id": 1}}')
+
+        self.assertEqual(results["rows"], [{"id": 1}])
+
+    def test_stops_reading_at_max_rows(self):
+        body = b"[" + b",".join(b'{"id": %d}' % i for i in range(5000)) + b"]"
+        with patch("redash.settings.QUERY_RESULTS_MAX_ROWS", 10):
+            results, error = self.run_json_query({"url": "api"}, body)
+
+        self.assertEqual(len(results["rows"]), 10)
+        self.assertTrue(results["truncated"])
+
+    def test_missing_path(self):
+        response = Mock(raw=BytesIO(b'{"meta": {"count": 0}}'))
+        with patch.object(self.runner, "get_response", return_value=(response, None)):
+            with self.assertRaisesRegex(Exception, "Couldn't find path data.records in response."):
+                self.runner._run_json_query({"url": "api", "path": "data.records"})
+
+        response.close.assert_called_once_with()
+
+    def test_empty_response_with_path(self):
+        results, error = self.run_json_query({"url": "api", "path": "data.records"}, b"{}")
+
+        self.assertIsNone(error)
+        self.assertEqual(results["rows"], [])
+
+    def test_invalid_json(self):
+        results, error = self.run_json_query({"url": "api"}, b'[{"id": 1}, {"id"')
+
+        self.assertIn("Failed parsing the response", error)
+        self.assertIsNone(results)
@@ -1,6 +1,11 @@
+import os
 from unittest import TestCase
+from urllib.parse import urlparse
 
-from redash.query_runner.pg import _parse_dsn, build_schema
+from mock import patch
+
+from redash.query_runner import connection_pools
+from redash.query_runner.pg import PostgreSQL, Redshift, _parse_dsn, build_schema
 
 
 class TestParameters(TestCase):
@@ -51,3 +56,123 @@ class TestBuildSchema(TestCase):
         self.assertListEqual(
             schema["main.users"]["columns"], [{"name": "id", "type": "integer"}, {"name": "name", "type": "varchar"}]
         )
+
+
+class LivePostgreSQLTestCase(TestCase):
+    def setUp(self):
+        url = urlparse(os.environ.get("REDASH_DATABASE_URL", "postgresql://postgres@localhost/tests"))
+        self.query_runner = PostgreSQL(
+            {"host": url.hostname, "port": url.port or 5432, "user": url.username, "dbname": url.path[1:]}
+        )
+        try:
+            self.query_runner.test_connection()
+        except Exception:
+            self.skipTest("PostgreSQL isn't available")
+
+        self.addCleanup(connection_pools.clear)
+
+
+class TestConnectionPooling(LivePostgreSQLTestCase):
+    def backend_pid(self):
+        data, error = self.query_runner.run_query("SELECT pg_backend_pid() AS pid", None)
+        return data["rows"][0]["pid"]
+
+    def test_reuses_connections(self):
+        self.assertEqual(self.backend_pid(), self.backend_pid())
+
+    def test_resets_session_of_reused_connections(self):
+        self.query_runner.run_query("SET application_name TO 'pooled'; SELECT 1", None)
+        data, _ = self.query_runner.run_query("SELECT current_setting('application_name') AS name", None)
+        self.assertNotEqual("pooled", data["rows"][0]["name"])
+
+    def test_replaces_connections_that_were_closed(self):
+        pid = self.backend_pid()
+        self.query_runner.run_query("SELECT pg_terminate_backend(%d)" % pid, None)
+        self.assertNotEqual(pid, self.backend_pid())
+
+    def test_does_not_pool_when_disabled(self):
+        with patch("redash.settings.QUERY_RUNNER_CONNECTION_POOL_SIZE", 0):
+            self.assertNotEqual(self.backend_pid(), self.backend_pid())
+
+    def test_does_not_pool_redshift_connections(self):
+        self.query_runner = Redshift(dict(self.query_runner.configuration))
+        self.assertNotEqual(self.backend_pid(), self.backend_pid())
+
+
+class TestRunQuery(LivePostgreSQLTestCase):
+    def run_query(self, query):
+        data, error = self.query_runner.run_query(query, None)
+        self.assertIsNone(error)
+        return data
+
+    def test_streams_select_results(self):
+        with patch.object(PostgreSQL, "fetch_batch_size", 3):
+            data = self.run_query("SELECT i, 'row' || i AS name FROM generate_series(1, 10) i")
+
+        self.assertEqual(["i", "name"], [column["name"] for column in data["columns"]])
+        self.assertEqual([{"i": i, "name": "row%d" % i} for i in range(1, 11)], data["rows"])
+        self.assertNotIn("truncated", data)
+
+    def test_runs_preceding_statements(self):
+        data = self.run_query(
+            "SET application_name TO 'streaming'; SELECT current_setting('application_name') AS name"
+        )
+        self.assertEqual([{"name": "streaming"}], data["rows"])
+
+    def test_runs_statements_that_cant_run_in_a_transaction(self):
+        data, error = self.query_runner.run_query("VACUUM pg_class", None)
+        self.assertEqual("Query completed but it returned no data.", error)
+
+    def test_runs_select_into(self):
+        self.addCleanup(self.query_runner.run_query, "DROP TABLE IF EXISTS redash_select_into", None)
+
+        data, error = self.query_runner.run_query("SELECT 1 AS value INTO redash_select_into", None)
+        self.assertEqual("Query completed but it returned no data.", error)
+        self.assertEqual([{"value": 1}], self.run_query("SELECT value FROM redash_select_into")["rows"])
+
+    def test_runs_data_modifying_with(self):
+        self.run_query("CREATE TABLE IF NOT EXISTS redash_modified (id int); SELECT 1")
+        self.addCleanup(self.query_runner.run_query, "DROP TABLE IF EXISTS redash_modified", None)
+
+        data = self.run_query("WITH i AS (INSERT INTO redash_modified VALUES (1), (2) RETURNING id) SELECT id FROM i")
+        self.assertEqual([{"id": 1}, {"id": 2}], data["rows"])
+
+    def test_falls_back_when_cursor_is_not_supported(self):
+        with patch("redash.query_runner.pg._is_select", return_value=True):
+            self.run_query("CREATE TABLE IF NOT EXISTS redash_modified (id int); SELECT 1")
+            self.addCleanup(self.query_runner.run_query, "DROP TABLE IF EXISTS redash_modified", None)
+
+            data = self.run_query("WITH d AS (DELETE FROM redash_modified RETURNING id) SELECT count(*) AS n FROM d")
+
+        self.assertEqual([{"n": 0}], data["rows"])
+
+    def test_runs_statements_that_arent_selects(self):
+        data = self.run_query("SHOW server_version")
+        self.assertEqual(1, len(data["rows"]))
+
+    def test_truncates_results_over_max_rows(self):
+        with patch("redash.settings.QUERY_RESULTS_MAX_ROWS", 5), patch.object(PostgreSQL, "fetch_batch_size", 3):
+            data = self.run_query("SELECT i FROM generate_series(1, 10) i")
+
+        self.assertEqual([{"i": i} for i in range(1, 6)], data["rows"])
+        self.assertTrue(data["truncated"])
+
+    def test_truncates_results_over_max_bytes(self):
+        with patch("redash.settings.QUERY_RESULTS_MAX_BYTES", 25):
+            data = self.run_query("SELECT repeat('x', 10) AS value FROM generate_series(1, 10)")
+
+        self.assertEqual(2, len(data["rows"]))
+        self.assertTrue(data["truncated"])
+
+    def test_truncates_results_without_server_side_cursor(self):
+        self.query_runner.configuration["server_side_cursor"] = False
+        with patch("redash.settings.QUERY_RESULTS_MAX_ROWS", 5):
+            data = self.run_query("SELECT i FROM generate_series(1, 10) i")
+
+        self.assertEqual(5, len(data["rows"]))
+        self.assertTrue(data["truncated"])
+
+    def test_keeps_connection_usable_after_errors(self):
+        data, error = self.query_runner.run_query("SELECT 1 / 0", None)
+        self.assertIn("division by zero", error)
+        self.assertEqual([{"value": 1}], self.run_query("SELECT 1 AS value")["rows"])
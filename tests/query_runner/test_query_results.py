@@ -1,19 +1,30 @@
 import datetime
 import decimal
+import os
 import sqlite3
+import tempfile
+import threading
+import time
 from unittest import TestCase
 
 import mock
 import pytest
+from flask import has_app_context
+from rq import Connection
 
+from redash import models, redis_connection, rq_redis_connection, settings
+from redash.query_runner import JobTimeoutException
 from redash.query_runner.query_results import (
     CreateTableError,
     PermissionError,
+    Results,
     _load_query,
     create_table,
     extract_cached_query_ids,
+    extract_join_columns,
     extract_query_ids,
     extract_query_params,
+    fetch_query_results,
     fix_column_name,
     get_query_results,
     prepare_parameterized_query,
@@ -40,7 +51,38 @@ class TestExtractQueryIds(TestCase):
         self.assertEqual([123, 4566, 78], extract_query_ids(query))
 
 
+class TestExtractJoinColumns(TestCase):
+    def test_finds_columns_in_on_clauses(self):
+        query = (
+            'SELECT * FROM query_1 a JOIN query_2 b ON a.id = b."parent_id" LEFT JOIN query_3 c ON c.Key=b.id WHERE 1'
+        )
+        self.assertEqual({"a", "b", "c", "id", "parent_id", "key"}, extract_join_columns(query))
+
+    def test_finds_columns_in_using_clauses(self):
+        query = "SELECT * FROM query_1 JOIN query_2 USING (id, name)"
+        self.assertEqual({"id", "name"}, extract_join_columns(query))
+
+
 class TestCreateTable(TestCase):
+    def test_uses_column_affinities_of_column_types(self):
+        connection = sqlite3.connect(":memory:")
+        results = {
+            "columns": [{"name": "id", "type": "integer"}, {"name": "value", "type": "float"}, {"name": "name"}],
+            "rows": [{"id": "1", "value": 2, "name": "3"}],
+        }
+        create_table(connection, "query_123", results)
+
+        row = connection.execute("SELECT typeof(id), typeof(value), typeof(name) FROM query_123").fetchone()
+        self.assertEqual(("integer", "real", "text"), row)
+
+    def test_indexes_join_columns(self):
+        connection = sqlite3.connect(":memory:")
+        results = {"columns": [{"name": "id"}, {"name": "name"}], "rows": [{"id": 1, "name": "a"}]}
+        create_table(connection, "query_123", results, {"id"})
+
+        indexes = connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'").fetchall()
+        self.assertEqual([("query_123_0",)], indexes)
+
     def test_creates_table_with_colons_in_column_name(self):
         connection = sqlite3.connect(":memory:")
         results = {
@@ -143,6 +185,16 @@ class TestCreateTable(TestCase):
         self.assertEqual(len(list(connection.execute("SELECT * FROM query_123"))), 2)
 
 
+class TestRunQuery(TestCase):
+    def test_guesses_column_types(self):
+        query = "SELECT 1 AS a, 'x' AS b, NULL AS c UNION ALL SELECT NULL, 2, NULL"
+        data, error = Results({}).run_query(query, None)
+
+        self.assertIsNone(error)
+        self.assertEqual([c["type"] for c in data["columns"]], ["integer", "string", "string"])
+        self.assertEqual(data["rows"], [{"a": 1, "b": "x", "c": None}, {"a": None, "b": 2, "c": None}])
+
+
 class TestGetQuery(BaseTestCase):
     # test query from different account
     def test_raises_exception_for_query_from_different_account(self):
@@ -248,3 +300,266 @@ class TestGetQueryResult(BaseTestCase):
             query_result_data = {"columns": [], "rows": []}
             qr.return_value = (query_result_data, None)
             self.assertEqual(query_result_data, get_query_results(self.factory.user, query.id, False))
+
+
+class TestCachedTables(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.patch = mock.patch("redash.settings.QUERY_RESULTS_CACHED_TABLES_PATH", tempfile.mkdtemp())
+        self.patch.start()
+
+        data = {"columns": [{"name": "id", "type": "integer"}], "rows": [{"id": 1}, {"id": 2}]}
+        query_result = self.factory.create_query_result(data=data)
+        self.query = self.factory.create_query(latest_query_data=query_result)
+
+    def tearDown(self):
+        self.patch.stop()
+        super().tearDown()
+
+    def run_query(self, query):
+        return Results({}).run_query(query.format(id=self.query.id), self.factory.user)
+
+    def test_reuses_loaded_tables(self):
+        data, _ = self.run_query("SELECT SUM(id) AS total FROM cached_query_{id}")
+        self.assertEqual([{"total": 3}], data["rows"])
+
+        with mock.patch("redash.query_runner.query_results.create_table") as create_table:
+            data, _ = self.run_query("SELECT COUNT(*) AS count FROM cached_query_{id}")
+
+        create_table.assert_not_called()
+        self.assertEqual([{"count": 2}], data["rows"])
+
+    def test_evicts_least_recently_used_tables(self):
+        query_result = self.factory.create_query_result(data=self.query.latest_query_data.data)
+        other_query = self.factory.create_query(latest_query_data=query_result)
+
+        with mock.patch("redash.settings.QUERY_RESULTS_CACHED_TABLES", 1):
+            self.run_query("SELECT * FROM cached_query_{id}")
+            Results({}).run_query("SELECT * FROM cached_query_{}".format(other_query.id), self.factory.user)
+
+            with mock.patch("redash.query_runner.query_results.create_table", wraps=create_table) as create:
+                self.run_query("SELECT * FROM cached_query_{id}")
+
+        create.assert_called_once()
+
+    def test_queries_cant_change_cached_tables(self):
+        self.run_query("SELECT * FROM cached_query_{id}")
+        self.run_query("DELETE FROM cached_query_{id}")
+
+        data, _ = self.run_query("SELECT COUNT(*) AS count FROM cached_query_{id}")
+        self.assertEqual([{"count": 2}], data["rows"])
+
+    def test_queries_cant_read_other_cached_results(self):
+        other_org = self.factory.create_org()
+        other_data_source = self.factory.create_data_source(group=other_org.default_group)
+        other_query = self.factory.create_query(
+            org=other_org,
+            data_source=other_data_source,
+            user=self.factory.create_user(org=other_org),
+            latest_query_data=self.factory.create_query_result(
+                data_source=other_data_source, data=self.query.latest_query_data.data
+            ),
+        )
+        Results({}).run_query("SELECT * FROM cached_query_{}".format(other_query.id), other_query.user)
+        path = os.path.join(
+            settings.QUERY_RESULTS_CACHED_TABLES_PATH, "result_{}.sqlite".format(other_query.latest_query_data_id)
+        )
+        self.assertTrue(os.path.exists(path))
+
+        with self.assertRaises(sqlite3.OperationalError):
+            self.run_query("SELECT * FROM cached_tables.result_{}".format(other_query.latest_query_data_id))
+        with self.assertRaises(sqlite3.DatabaseError):
+            self.run_query("ATTACH DATABASE '{}' AS other".format(path))
+        with self.assertRaises(PermissionError):
+            self.run_query("SELECT * FROM cached_query_{}".format(other_query.id))
+
+    def test_removes_leftover_worker_databases(self):
+        path = os.path.join(settings.QUERY_RESULTS_CACHED_TABLES_PATH, "worker-1.sqlite")
+        open(path, "w").close()
+
+        self.run_query("SELECT * FROM cached_query_{id}")
+
+        self.assertFalse(os.path.exists(path))
+
+
+class TestDuckDBEngine(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        data = {
+            "columns": [
+                {"name": "id", "type": "integer"},
+                {"name": "day", "type": "date"},
+                {"name": "ga:name"},
+            ],
+            "rows": [
+                {"id": 1, "day": "2024-01-01", "ga:name": "a"},
+                {"id": 2, "day": "2024-01-02", "ga:name": "b"},
+                {"id": None, "day": None, "ga:name": None},
+            ],
+        }
+        query_result = self.factory.create_query_result(data=data)
+        self.query = self.factory.create_query(latest_query_data=query_result)
+        self.runner = Results({"engine": "duckdb"})
+
+    def test_loads_cached_query_results(self):
+        data, error = self.runner.run_query(
+            "SELECT ga_name, day, id * 2 AS double FROM cached_query_{} WHERE id > 1".format(self.query.id),
+            self.factory.user,
+        )
+
+        self.assertIsNone(error)
+        self.assertEqual(["string", "date", "integer"], [c["type"] for c in data["columns"]])
+        self.assertEqual([{"ga_name": "b", "day": datetime.date(2024, 1, 2), "double": 4}], data["rows"])
+
+    def test_joins_query_results(self):
+        from redash.query_runner.pg import PostgreSQL
+
+        with mock.patch.object(PostgreSQL, "run_query") as run_query:
+            run_query.return_value = ({"columns": [{"name": "id"}], "rows": [{"id": 2}, {"id": 3}]}, None)
+            data, error = self.runner.run_query(
+                "SELECT c.id FROM cached_query_{id} c JOIN query_{id} q ON c.id = q.id".format(id=self.query.id),
+                self.factory.user,
+            )
+
+        self.assertIsNone(error)
+        self.assertEqual([{"id": 2}], data["rows"])
+
+    def test_returns_error_for_statements_without_results(self):
+        data, error = self.runner.run_query("CREATE TABLE test AS SELECT 1", self.factory.user)
+
+        self.assertIsNone(data)
+        self.assertEqual("Query completed but it returned no data.", error)
+
+    def test_cant_access_local_files(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".csv") as f:
+            f.write("secret\n1\n")
+            f.flush()
+
+            for query in (
+                "SELECT * FROM read_csv('{}')".format(f.name),
+                "SET enable_external_access = true",
+                "COPY (SELECT 1) TO '{}'".format(f.name),
+                "ATTACH '{}.db'".format(f.name),
+            ):
+                with self.assertRaises(Exception):
+                    self.runner.run_query(query, self.factory.user)
+
+
+class TestFetchQueryResults(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.queries = [self.factory.create_query(query_text="SELECT {}".format(i)) for i in range(2)]
+        self.data = {"columns": [{"name": "a"}], "rows": [{"a": 1}]}
+
+    def fetch(self):
+        references = [("query_{}".format(q.id), q.id, None) for q in self.queries]
+        return fetch_query_results(self.factory.user, references)
+
+    def test_runs_queries_concurrently(self):
+        from redash.query_runner.pg import PostgreSQL
+
+        barrier = threading.Barrier(2, timeout=5)
+
+        def run_query(query, user):
+            barrier.wait()
+            return self.data, None
+
+        with mock.patch.object(PostgreSQL, "run_query", side_effect=run_query):
+            tables = self.fetch()
+
+        self.assertEqual(sorted(["query_{}".format(q.id) for q in self.queries]), sorted(t for t, _ in tables))
+        self.assertEqual([self.data, self.data], [results for _, results in tables])
+
+    def test_limits_concurrency_per_data_source(self):
+        from redash.query_runner.pg import PostgreSQL
+
+        running = []
+        lock = threading.Lock()
+        peak = []
+
+        def run_query(query, user):
+            with lock:
+                running.append(query)
+                peak.append(len(running))
+            threading.Event().wait(0.05)
+            with lock:
+                running.remove(query)
+            return self.data, None
+
+        with mock.patch("redash.settings.QUERY_RESULTS_FETCH_WORKERS_PER_DATA_SOURCE", 1), mock.patch.object(
+            PostgreSQL, "run_query", side_effect=run_query
+        ):
+            self.fetch()
+
+        self.assertEqual(1, max(peak))
+
+    def test_uses_results_of_executions_in_progress(self):
+        from redash.query_runner.pg import PostgreSQL
+        from redash.tasks.queries.execution import job_lock_id
+        from redash.utils import gen_query_hash
+
+        query_result = self.factory.create_query_result(data={"columns": [{"name": "b"}], "rows": [{"b": 2}]})
+        for query in self.queries:
+            lock = job_lock_id(gen_query_hash(query.query_text), query.data_source_id)
+            redis_connection.set(lock, "job-{}".format(query.id))
+
+        with mock.patch(
+            "redash.query_runner.query_results._wait_for_job", return_value=query_result.id
+        ) as wait_for_job, mock.patch.object(PostgreSQL, "run_query") as run_query:
+            tables = self.fetch()
+
+        run_query.assert_not_called()
+        self.assertEqual(2, wait_for_job.call_count)
+        self.assertEqual([query_result.data, query_result.data], [results for _, results in tables])
+
+    def test_doesnt_wait_for_queued_executions(self):
+        from redash.query_runner.query_results import _wait_for_job
+        from redash.tasks import Queue
+
+        rq_redis_connection.flushdb()
+        self.addCleanup(rq_redis_connection.flushdb)
+        job = Queue("queries", connection=rq_redis_connection).enqueue("os.getpid")
+
+        started = time.time()
+        with Connection(rq_redis_connection):
+            self.assertIsNone(_wait_for_job(job.id, time.time() + 5))
+        self.assertLess(time.time() - started, 1)
+
+    def test_times_out_when_queries_outlive_the_job(self):
+        from redash.query_runner.pg import PostgreSQL
+
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        def run_query(query, user):
+            release.wait(5)
+            return self.data, None
+
+        started = time.time()
+        with mock.patch.object(PostgreSQL, "run_query", side_effect=run_query), mock.patch(
+            "redash.query_runner.query_results.get_current_job", return_value=mock.Mock(timeout=0.1)
+        ):
+            with self.assertRaises(JobTimeoutException):
+                self.fetch()
+
+        self.assertLess(time.time() - started, 1)
+
+    def test_runs_queries_with_an_app_context(self):
+        from redash.query_runner.pg import PostgreSQL
+
+        def run_query(query, user):
+            self.assertTrue(has_app_context())
+            self.assertIsNotNone(models.Query.query.get(self.queries[0].id))
+            return self.data, None
+
+        with mock.patch.object(PostgreSQL, "run_query", side_effect=run_query) as run:
+            self.fetch()
+
+        self.assertTrue(run.called)
+
+    def test_raises_for_failed_queries(self):
+        from redash.query_runner.pg import PostgreSQL
+
+        with mock.patch.object(PostgreSQL, "run_query", return_value=(None, "error")):
+            with self.assertRaises(Exception):
+                self.fetch()
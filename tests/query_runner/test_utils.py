@@ -1,11 +1,14 @@
 from unittest import TestCase
 
+from mock import patch
+
 from redash.query_runner import (
     TYPE_BOOLEAN,
     TYPE_DATETIME,
     TYPE_FLOAT,
     TYPE_INTEGER,
     TYPE_STRING,
+    guess_column_type,
     guess_type,
 )
 
@@ -38,3 +41,45 @@ class TestGuessType(TestCase):
 
     def test_detects_date(self):
         self.assertEqual(guess_type("2018-10-31"), TYPE_DATETIME)
+
+
+class TestGuessColumnType(TestCase):
+    def test_detects_native_types(self):
+        self.assertEqual(guess_column_type([1, 2, None]), TYPE_INTEGER)
+        self.assertEqual(guess_column_type([1.5, None, 2.5]), TYPE_FLOAT)
+        self.assertEqual(guess_column_type([True, False]), TYPE_BOOLEAN)
+
+    def test_detects_types_of_strings(self):
+        self.assertEqual(guess_column_type(["1", "2", ""]), TYPE_INTEGER)
+        self.assertEqual(guess_column_type(["2018-10-31", "2018-11-01"]), TYPE_DATETIME)
+        self.assertEqual(guess_column_type(["true", "FALSE", None]), TYPE_BOOLEAN)
+
+    def test_falls_back_to_string_when_values_disagree(self):
+        self.assertEqual(guess_column_type([1, 2.5]), TYPE_STRING)
+        self.assertEqual(guess_column_type([1, True]), TYPE_STRING)
+        self.assertEqual(guess_column_type(["1", "a"]), TYPE_STRING)
+
+    def test_defaults_to_string_without_values(self):
+        self.assertEqual(guess_column_type([]), TYPE_STRING)
+        self.assertEqual(guess_column_type([None, ""]), TYPE_STRING)
+
+    def test_guesses_each_distinct_value_once(self):
+        with patch("redash.query_runner.guess_type", return_value=TYPE_INTEGER) as guess:
+            guess_column_type(["1", "1", "2", "1"])
+
+        self.assertEqual(guess.call_count, 2)
+
+    def test_stops_at_the_first_string(self):
+        with patch("redash.query_runner.guess_type", wraps=guess_type) as guess:
+            self.assertEqual(guess_column_type(["a", "b", "c"]), TYPE_STRING)
+
+        self.assertEqual(guess.call_count, 1)
+
+    def test_guesses_a_sample_of_the_values(self):
+        values = [None] * 10 + [str(i) for i in range(10)] + ["a"]
+        with patch("redash.query_runner.GUESS_COLUMN_TYPE_SAMPLE_SIZE", 10), patch(
+            "redash.query_runner.guess_type", wraps=guess_type
+        ) as guess:
+            self.assertEqual(guess_column_type(values), TYPE_INTEGER)
+
+        self.assertEqual(guess.call_count, 10)
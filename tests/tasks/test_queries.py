@@ -1,15 +1,27 @@
+import threading
+
 from mock import Mock, patch
 from rq import Connection
 from rq.exceptions import NoSuchJobError
+from rq.job import JobStatus
 
-from redash import models, rq_redis_connection
+from redash import models, redis_connection, rq_redis_connection
+from redash.query_runner import BaseQueryRunner
 from redash.query_runner.pg import PostgreSQL
-from redash.tasks import Job
+from redash.tasks import Job, Queue
 from redash.tasks.queries.execution import (
     QueryExecutionError,
+    _enqueue_many,
+    _enqueue_options,
+    _get_query_runner,
+    _publish_result,
+    enqueue_queries,
     enqueue_query,
     execute_query,
+    job_lock_id,
+    wait_for_query_result,
 )
+from redash.utils import gen_query_hash, json_dumps, json_loads
 from tests import BaseTestCase
 
 
@@ -172,8 +184,180 @@ class TestEnqueueTask(BaseTestCase):
         self.assertEqual(3, enqueue.call_count)
 
 
+class TestEnqueueQueries(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        rq_redis_connection.flushdb()
+        self.addCleanup(rq_redis_connection.flushdb)
+
+    def execution(self, query, query_text=None):
+        return (query_text or query.query_text, query.data_source, query.user_id, query, {"query_id": query.id})
+
+    def test_enqueues_each_query_once(self):
+        query = self.factory.create_query()
+        other = self.factory.create_query(query_text="SELECT 2")
+
+        jobs = enqueue_queries([self.execution(query), self.execution(other), self.execution(query)])
+
+        self.assertEqual(jobs[0].id, jobs[2].id)
+        self.assertNotEqual(jobs[0].id, jobs[1].id)
+        self.assertEqual(len(Queue(query.data_source.scheduled_queue_name, connection=rq_redis_connection)), 2)
+        self.assertEqual(jobs[0].kwargs["scheduled_query_id"], query.id)
+        self.assertEqual(jobs[0].meta["query_id"], query.id)
+        self.assertEqual(
+            redis_connection.get(job_lock_id(gen_query_hash(query.query_text), query.data_source.id)), jobs[0].id
+        )
+
+    def test_reuses_running_jobs(self):
+        query = self.factory.create_query()
+        (job,) = enqueue_queries([self.execution(query)])
+
+        (same_job,) = enqueue_queries([self.execution(query)])
+
+        self.assertEqual(job.id, same_job.id)
+        self.assertEqual(len(Queue(query.data_source.scheduled_queue_name, connection=rq_redis_connection)), 1)
+
+    def test_replaces_finished_jobs(self):
+        query = self.factory.create_query()
+        (job,) = enqueue_queries([self.execution(query)])
+        job.set_status(JobStatus.FINISHED)
+
+        (new_job,) = enqueue_queries([self.execution(query)])
+
+        self.assertNotEqual(job.id, new_job.id)
+
+    def test_reuses_job_enqueued_concurrently(self):
+        query = self.factory.create_query()
+        lock_id = job_lock_id(gen_query_hash(query.query_text), query.data_source.id)
+        with Connection(rq_redis_connection):
+            job = enqueue_query(query.query_text, query.data_source, query.user_id, False, query, {})
+
+        # The lock was free when it was read, but another job took it before it was set.
+        with patch.object(redis_connection, "mget", return_value=[None]):
+            (same_job,) = enqueue_queries([self.execution(query)])
+
+        self.assertEqual(job.id, same_job.id)
+        self.assertEqual(redis_connection.get(lock_id), job.id)
+        self.assertEqual(len(Queue(query.data_source.scheduled_queue_name, connection=rq_redis_connection)), 1)
+
+    def test_reports_queries_that_cant_be_prepared(self):
+        query = self.factory.create_query()
+        broken = self.factory.create_query(query_text="SELECT 2")
+        other = self.factory.create_query(query_text="SELECT 3")
+        error = ValueError("broken")
+
+        def failing_enqueue_options(data_source, user_id, is_api_key, scheduled_query, metadata):
+            if scheduled_query is broken:
+                raise error
+            return _enqueue_options(data_source, user_id, is_api_key, scheduled_query, metadata)
+
+        executions = [self.execution(query), self.execution(broken), self.execution(other)]
+        on_error = Mock()
+        with patch("redash.tasks.queries.execution._enqueue_options", failing_enqueue_options):
+            jobs = enqueue_queries(executions, on_error=on_error)
+
+        on_error.assert_called_once_with(executions[1], error)
+        self.assertIsNone(jobs[1])
+        self.assertEqual(jobs[0].kwargs["scheduled_query_id"], query.id)
+        self.assertEqual(jobs[2].kwargs["scheduled_query_id"], other.id)
+        self.assertIsNone(redis_connection.get(job_lock_id(gen_query_hash("SELECT 2"), broken.data_source.id)))
+        self.assertEqual(len(Queue(query.data_source.scheduled_queue_name, connection=rq_redis_connection)), 2)
+
+    def test_reports_queries_that_cant_be_enqueued(self):
+        query = self.factory.create_query()
+        broken = self.factory.create_query(query_text="SELECT 2")
+        error = ValueError("broken")
+
+        def failing_enqueue_many(queue, datas):
+            if any(data.args[0] == "SELECT 2" for data in datas):
+                raise error
+            return _enqueue_many(queue, datas)
+
+        executions = [self.execution(query), self.execution(broken), self.execution(broken)]
+        on_error = Mock()
+        with patch("redash.tasks.queries.execution._enqueue_many", failing_enqueue_many):
+            jobs = enqueue_queries(executions, on_error=on_error)
+
+        self.assertEqual(on_error.call_count, 2)
+        on_error.assert_called_with(executions[2], error)
+        self.assertEqual(jobs[0].kwargs["scheduled_query_id"], query.id)
+        self.assertEqual(jobs[1:], [None, None])
+        self.assertIsNone(redis_connection.get(job_lock_id(gen_query_hash("SELECT 2"), broken.data_source.id)))
+        self.assertEqual(len(Queue(query.data_source.scheduled_queue_name, connection=rq_redis_connection)), 1)
+
+    def test_raises_errors_without_on_error(self):
+        query = self.factory.create_query()
+
+        with patch("redash.tasks.queries.execution._enqueue_options", side_effect=ValueError("broken")):
+            self.assertRaises(ValueError, enqueue_queries, [self.execution(query)])
+
+
+class TestWaitForQueryResult(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        rq_redis_connection.flushdb()
+        self.addCleanup(rq_redis_connection.flushdb)
+        self.query = self.factory.create_query()
+        (self.job,) = enqueue_queries([(self.query.query_text, self.query.data_source, self.query.user_id, None, {})])
+        self.query_hash = gen_query_hash(self.query.query_text)
+
+    def publish_later(self, **kwargs):
+        timer = threading.Timer(
+            0.1, _publish_result, (self.query_hash, self.query.data_source.id, self.job.id), kwargs
+        )
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def wait(self, timeout=5):
+        return wait_for_query_result(self.job, self.query_hash, self.query.data_source.id, timeout)
+
+    def test_returns_published_result(self):
+        self.publish_later(query_result_id=42)
+        self.assertEqual(self.wait(), 42)
+
+    def test_returns_none_when_the_job_fails(self):
+        self.publish_later(error="boom")
+        self.assertIsNone(self.wait())
+
+    def test_returns_none_after_timeout(self):
+        self.assertIsNone(self.wait(timeout=0.2))
+
+    def test_returns_result_of_finished_job(self):
+        self.job._result = 42
+        self.job.set_status(JobStatus.FINISHED)
+
+        self.assertEqual(self.wait(timeout=0), 42)
+
+    def test_returns_none_when_finished_job_returned_an_error(self):
+        self.job._result = QueryExecutionError("boom")
+        self.job.set_status(JobStatus.FINISHED)
+
+        self.assertIsNone(self.wait(timeout=0))
+
+
+class TestGetQueryRunner(BaseTestCase):
+    def test_reuses_query_runner_of_data_source(self):
+        data_source = self.factory.create_data_source()
+        self.assertIs(_get_query_runner(data_source), _get_query_runner(data_source))
+
+    def test_replaces_query_runner_when_options_change(self):
+        data_source = self.factory.create_data_source()
+        query_runner = _get_query_runner(data_source)
+
+        data_source.options["dbname"] = "other"
+        self.assertIsNot(query_runner, _get_query_runner(data_source))
+        self.assertEqual("other", _get_query_runner(data_source).configuration["dbname"])
+
+
 @patch("redash.tasks.queries.execution.get_current_job", side_effect=fetch_job)
 class QueryExecutorTests(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        # Have the executor go through run_query, which the tests patch.
+        patcher = patch.object(PostgreSQL, "run_query_into", BaseQueryRunner.run_query_into)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_success(self, _):
         """
         ``execute_query`` invokes the query runner and stores a query result.
@@ -186,6 +370,32 @@ class QueryExecutorTests(BaseTestCase):
             result = models.QueryResult.query.get(result_id)
             self.assertEqual(result.data, query_result_data)
 
+    def test_reports_result_size(self, _):
+        with patch.object(PostgreSQL, "run_query") as qr, patch(
+            "redash.tasks.queries.execution.statsd_client"
+        ) as statsd_client:
+            query_result_data = {"columns": [{"name": "a"}], "rows": [{"a": 1}, {"a": 2}]}
+            qr.return_value = (query_result_data, None)
+            result_id = execute_query("SELECT 1, 2", self.factory.data_source.id, {})
+
+        result = models.QueryResult.query.get(result_id)
+        self.assertEqual(2, result.row_count)
+        self.assertEqual(len(json_dumps(query_result_data)), result.data_size)
+        statsd_client.timing.assert_any_call("query_results.size.pg", result.data_size)
+        statsd_client.timing.assert_any_call("query_results.row_count.pg", 2)
+
+    def test_publishes_result(self, _):
+        pubsub = redis_connection.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe("query_result:{}:{}".format(self.factory.data_source.id, gen_query_hash("SELECT 1, 2")))
+        self.addCleanup(pubsub.close)
+
+        with patch.object(PostgreSQL, "run_query") as qr:
+            qr.return_value = ({"columns": [], "rows": []}, None)
+            result_id = execute_query("SELECT 1, 2", self.factory.data_source.id, {})
+
+        message = pubsub.get_message(timeout=1) or pubsub.get_message(timeout=1)
+        self.assertEqual(json_loads(message["data"])["query_result_id"], result_id)
+
     def test_success_scheduled(self, _):
         """
         Scheduled queries remember their latest results.
@@ -241,6 +451,20 @@ class QueryExecutorTests(BaseTestCase):
             q = models.Query.get_by_id(q.id)
             self.assertEqual(q.schedule_failures, 2)
 
+    def test_stores_result_returned_with_an_error(self, _):
+        """
+        Results that query runners return together with an error are stored.
+        """
+
+        def run_query_into(query, user, builder):
+            builder.add_result({"columns": [{"name": "a"}], "rows": [{"a": 1}]})
+            return "some statements failed"
+
+        with patch.object(PostgreSQL, "run_query_into", side_effect=run_query_into):
+            result_id = execute_query("SELECT 1, 2", self.factory.data_source.id, {})
+
+        self.assertEqual([{"a": 1}], models.QueryResult.query.get(result_id).data["rows"])
+
     def test_success_after_failure(self, _):
         """
         Query execution success resets the failure counter.
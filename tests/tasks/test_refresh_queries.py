@@ -1,10 +1,16 @@
-from mock import ANY, call, patch
+import datetime
+import time
 
-from redash.models import Query
+from mock import ANY, patch
+
+from redash import redis_connection, rq_redis_connection, settings
+from redash.models import Query, scheduled_queries_index
+from redash.tasks import Queue
 from redash.tasks.queries.maintenance import refresh_queries
+from redash.utils import utcnow
 from tests import BaseTestCase
 
-ENQUEUE_QUERY = "redash.tasks.queries.maintenance.enqueue_query"
+ENQUEUE_QUERIES = "redash.tasks.queries.maintenance.enqueue_queries"
 
 
 class TestRefreshQuery(BaseTestCase):
@@ -20,27 +26,26 @@ class TestRefreshQuery(BaseTestCase):
             options={"apply_auto_limit": True},
         )
         oq = staticmethod(lambda: [query1, query2])
-        with patch(ENQUEUE_QUERY) as add_job_mock, patch.object(Query, "outdated_queries", oq):
+        with patch(ENQUEUE_QUERIES) as add_job_mock, patch.object(Query, "outdated_queries", oq):
             refresh_queries()
-            self.assertEqual(add_job_mock.call_count, 2)
-            add_job_mock.assert_has_calls(
+            add_job_mock.assert_called_once_with(
                 [
-                    call(
+                    (
                         query1.query_text + " LIMIT 1000",
                         query1.data_source,
                         query1.user_id,
-                        scheduled_query=query1,
-                        metadata={"query_id": query1.id, "Username": query1.user.get_actual_user()},
+                        query1,
+                        {"query_id": query1.id, "Username": query1.user.get_actual_user()},
                     ),
-                    call(
+                    (
                         "select 42 LIMIT 1000",
                         query2.data_source,
                         query2.user_id,
-                        scheduled_query=query2,
-                        metadata={"query_id": query2.id, "Username": query2.user.get_actual_user()},
+                        query2,
+                        {"query_id": query2.id, "Username": query2.user.get_actual_user()},
                     ),
                 ],
-                any_order=True,
+                on_error=ANY,
             )
 
     def test_enqueues_outdated_queries_for_non_sqlquery(self):
@@ -52,27 +57,26 @@ class TestRefreshQuery(BaseTestCase):
         query1 = self.factory.create_query(data_source=ds, options={"apply_auto_limit": True})
         query2 = self.factory.create_query(query_text="select 42;", data_source=ds, options={"apply_auto_limit": True})
         oq = staticmethod(lambda: [query1, query2])
-        with patch(ENQUEUE_QUERY) as add_job_mock, patch.object(Query, "outdated_queries", oq):
+        with patch(ENQUEUE_QUERIES) as add_job_mock, patch.object(Query, "outdated_queries", oq):
             refresh_queries()
-            self.assertEqual(add_job_mock.call_count, 2)
-            add_job_mock.assert_has_calls(
+            add_job_mock.assert_called_once_with(
                 [
-                    call(
+                    (
                         query1.query_text,
                         query1.data_source,
                         query1.user_id,
-                        scheduled_query=query1,
-                        metadata={"query_id": query1.id, "Username": query1.user.get_actual_user()},
+                        query1,
+                        {"query_id": query1.id, "Username": query1.user.get_actual_user()},
                     ),
-                    call(
+                    (
                         query2.query_text,
                         query2.data_source,
                         query2.user_id,
-                        scheduled_query=query2,
-                        metadata={"query_id": query2.id, "Username": query2.user.get_actual_user()},
+                        query2,
+                        {"query_id": query2.id, "Username": query2.user.get_actual_user()},
                     ),
                 ],
-                any_order=True,
+                on_error=ANY,
             )
 
     def test_doesnt_enqueue_outdated_queries_for_paused_data_source_for_sqlquery(self):
@@ -84,20 +88,16 @@ class TestRefreshQuery(BaseTestCase):
         oq = staticmethod(lambda: [query])
         query.data_source.pause()
         with patch.object(Query, "outdated_queries", oq):
-            with patch(ENQUEUE_QUERY) as add_job_mock:
+            with patch(ENQUEUE_QUERIES) as add_job_mock:
                 refresh_queries()
                 add_job_mock.assert_not_called()
 
             query.data_source.resume()
 
-            with patch(ENQUEUE_QUERY) as add_job_mock:
+            with patch(ENQUEUE_QUERIES) as add_job_mock:
                 refresh_queries()
-                add_job_mock.assert_called_with(
-                    query.query_text + " LIMIT 1000",
-                    query.data_source,
-                    query.user_id,
-                    scheduled_query=query,
-                    metadata=ANY,
+                add_job_mock.assert_called_once_with(
+                    [(query.query_text + " LIMIT 1000", query.data_source, query.user_id, query, ANY)], on_error=ANY
                 )
 
     def test_doesnt_enqueue_outdated_queries_for_paused_data_source_for_non_sqlquery(
@@ -112,20 +112,16 @@ class TestRefreshQuery(BaseTestCase):
         oq = staticmethod(lambda: [query])
         query.data_source.pause()
         with patch.object(Query, "outdated_queries", oq):
-            with patch(ENQUEUE_QUERY) as add_job_mock:
+            with patch(ENQUEUE_QUERIES) as add_job_mock:
                 refresh_queries()
                 add_job_mock.assert_not_called()
 
             query.data_source.resume()
 
-            with patch(ENQUEUE_QUERY) as add_job_mock:
+            with patch(ENQUEUE_QUERIES) as add_job_mock:
                 refresh_queries()
-                add_job_mock.assert_called_with(
-                    query.query_text,
-                    query.data_source,
-                    query.user_id,
-                    scheduled_query=query,
-                    metadata=ANY,
+                add_job_mock.assert_called_once_with(
+                    [(query.query_text, query.data_source, query.user_id, query, ANY)], on_error=ANY
                 )
 
     def test_enqueues_parameterized_queries_for_sqlquery(self):
@@ -148,14 +144,10 @@ class TestRefreshQuery(BaseTestCase):
             },
         )
         oq = staticmethod(lambda: [query])
-        with patch(ENQUEUE_QUERY) as add_job_mock, patch.object(Query, "outdated_queries", oq):
+        with patch(ENQUEUE_QUERIES) as add_job_mock, patch.object(Query, "outdated_queries", oq):
             refresh_queries()
-            add_job_mock.assert_called_with(
-                "select 42 LIMIT 1000",
-                query.data_source,
-                query.user_id,
-                scheduled_query=query,
-                metadata=ANY,
+            add_job_mock.assert_called_once_with(
+                [("select 42 LIMIT 1000", query.data_source, query.user_id, query, ANY)], on_error=ANY
             )
 
     def test_enqueues_parameterized_queries_for_non_sqlquery(self):
@@ -180,14 +172,10 @@ class TestRefreshQuery(BaseTestCase):
             data_source=ds,
         )
         oq = staticmethod(lambda: [query])
-        with patch(ENQUEUE_QUERY) as add_job_mock, patch.object(Query, "outdated_queries", oq):
+        with patch(ENQUEUE_QUERIES) as add_job_mock, patch.object(Query, "outdated_queries", oq):
             refresh_queries()
-            add_job_mock.assert_called_with(
-                "select 42",
-                query.data_source,
-                query.user_id,
-                scheduled_query=query,
-                metadata=ANY,
+            add_job_mock.assert_called_once_with(
+                [("select 42", query.data_source, query.user_id, query, ANY)], on_error=ANY
             )
 
     def test_doesnt_enqueue_parameterized_queries_with_invalid_parameters(self):
@@ -210,7 +198,7 @@ class TestRefreshQuery(BaseTestCase):
             },
         )
         oq = staticmethod(lambda: [query])
-        with patch(ENQUEUE_QUERY) as add_job_mock, patch.object(Query, "outdated_queries", oq):
+        with patch(ENQUEUE_QUERIES) as add_job_mock, patch.object(Query, "outdated_queries", oq):
             refresh_queries()
             add_job_mock.assert_not_called()
 
@@ -239,6 +227,96 @@ class TestRefreshQuery(BaseTestCase):
         self.factory.create_query(id=100, data_source=None)
 
         oq = staticmethod(lambda: [query])
-        with patch(ENQUEUE_QUERY) as add_job_mock, patch.object(Query, "outdated_queries", oq):
+        with patch(ENQUEUE_QUERIES) as add_job_mock, patch.object(Query, "outdated_queries", oq):
             refresh_queries()
             add_job_mock.assert_not_called()
+
+    def test_enqueues_other_queries_when_one_fails(self):
+        query = self.factory.create_query()
+        broken = self.factory.create_query(query_text="select 42")
+        error = ValueError("broken")
+
+        def enqueue_queries(executions, on_error):
+            on_error(executions[1], error)
+
+        oq = staticmethod(lambda: [query, broken])
+        with patch(ENQUEUE_QUERIES, side_effect=enqueue_queries), patch.object(Query, "outdated_queries", oq), patch(
+            "redash.tasks.queries.maintenance.sentry.capture_exception"
+        ) as capture_exception:
+            refresh_queries()
+
+        capture_exception.assert_called_once()
+        self.assertIn("Could not enqueue query %d" % broken.id, str(capture_exception.call_args[0][0]))
+        self.assertEqual(redis_connection.hget("redash:status", "outdated_queries_count"), "1")
+        self.assertEqual(redis_connection.hget("redash:status", "query_ids"), "[%d]" % query.id)
+
+
+class TestRefreshQueriesAdmission(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        rq_redis_connection.flushdb()
+        self.addCleanup(rq_redis_connection.flushdb)
+
+    def create_scheduled_query(self, retrieved_ago, **kwargs):
+        query = self.factory.create_query(schedule={"interval": "600", "until": None, "time": None}, **kwargs)
+        query.latest_query_data = self.factory.create_query_result(
+            query_text=query.query_text, retrieved_at=utcnow() - datetime.timedelta(seconds=retrieved_ago)
+        )
+        return query
+
+    def refresh(self, *queries):
+        with patch(ENQUEUE_QUERIES) as enqueue_queries, patch.object(Query, "outdated_queries", lambda: queries):
+            refresh_queries()
+
+        return [execution[3] for execution in enqueue_queries.call_args[0][0]] if enqueue_queries.called else []
+
+    def assert_deferred(self, query):
+        next_run_at = redis_connection.zscore(scheduled_queries_index.KEY_NAME, query.id)
+        self.assertGreaterEqual(next_run_at, time.time() + settings.REFRESH_QUERIES_MIN_DEFER - 1)
+        self.assertLessEqual(next_run_at, time.time() + 600 * 1.5)
+
+    def test_enqueues_most_overdue_queries_of_busy_data_sources(self):
+        query1 = self.create_scheduled_query(700)
+        query2 = self.create_scheduled_query(6000)
+
+        with patch("redash.settings.REFRESH_QUERIES_MAX_PENDING_PER_DATA_SOURCE", 1):
+            self.assertEqual([query2], self.refresh(query1, query2))
+
+        self.assert_deferred(query1)
+
+    def test_counts_pending_jobs_of_data_sources(self):
+        query = self.create_scheduled_query(700)
+        Queue("scheduled_queries", connection=rq_redis_connection).enqueue(
+            refresh_queries, meta={"data_source_id": query.data_source_id}
+        )
+
+        with patch("redash.settings.REFRESH_QUERIES_MAX_PENDING_PER_DATA_SOURCE", 1):
+            self.assertEqual([], self.refresh(query))
+
+        self.assert_deferred(query)
+
+    @patch("redash.settings.FAIR_QUEUES", set())
+    def test_counts_pending_jobs_of_data_sources_in_plain_queues(self):
+        query = self.create_scheduled_query(700)
+        queue = Queue("scheduled_queries", connection=rq_redis_connection)
+        queued = queue.enqueue(refresh_queries, meta={"data_source_id": query.data_source_id})
+        started = queue.enqueue(refresh_queries, meta={"data_source_id": query.data_source_id})
+        queue.started_job_registry.add(started, -1)
+        queue.remove(started)
+
+        with patch("redash.settings.REFRESH_QUERIES_MAX_PENDING_PER_DATA_SOURCE", 1):
+            self.assertEqual([], self.refresh(query))
+        queue.remove(queued)
+        with patch("redash.settings.REFRESH_QUERIES_MAX_PENDING_PER_DATA_SOURCE", 1):
+            self.assertEqual([], self.refresh(query))
+        with patch("redash.settings.REFRESH_QUERIES_MAX_PENDING_PER_DATA_SOURCE", 2):
+            self.assertEqual([query], self.refresh(query))
+
+    def test_stops_enqueueing_to_full_queues(self):
+        query1 = self.create_scheduled_query(700)
+        query2 = self.create_scheduled_query(700, data_source=self.factory.create_data_source())
+
+        with patch("redash.settings.REFRESH_QUERIES_MAX_QUEUED", 1):
+            self.assertEqual([query1], self.refresh(query1, query2))
+
+        self.assert_deferred(query2)
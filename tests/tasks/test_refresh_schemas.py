@@ -23,3 +23,10 @@ class TestRefreshSchemas(BaseTestCase):
         with patch("redash.tasks.queries.maintenance.refresh_schema.delay") as refresh_job:
             refresh_schemas()
             refresh_job.assert_called()
+
+    def test_skips_data_sources_being_refreshed(self):
+        self.factory.data_source  # trigger creation
+        with patch("redash.tasks.queries.maintenance.refresh_schema.delay") as refresh_job:
+            refresh_schemas()
+            refresh_schemas()
+            refresh_job.assert_called_once()
@@ -1,10 +1,16 @@
+import multiprocessing
+import os
+import signal
+import threading
+
 from mock import call, patch
 from rq import Connection
 from rq.job import JobStatus
 
 from redash import rq_redis_connection
-from redash.tasks import Queue, Worker
+from redash.tasks import Job, Queue, Worker
 from redash.tasks.queries.execution import enqueue_query
+from redash.tasks.worker import WarmWorker
 from redash.worker import default_queues, job
 from tests import BaseTestCase
 
@@ -68,6 +74,208 @@ class TestWorkerMetrics(BaseTestCase):
         incr.assert_has_calls(calls)
 
 
+@job("default")
+def current_pid():
+    return os.getpid()
+
+
+@job("default")
+def exit_horse():
+    os._exit(1)
+
+
+@job("default")
+def leave_thread_running():
+    threading.Thread(target=threading.Event().wait, args=(5,)).start()
+    return os.getpid()
+
+
+class TestWarmWorker(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        rq_redis_connection.flushdb()
+        self.addCleanup(rq_redis_connection.flushdb)
+
+    def test_performs_jobs_in_the_same_horse(self):
+        with Connection(rq_redis_connection):
+            jobs = [current_pid.delay() for _ in range(3)]
+            WarmWorker(["default"]).work(burst=True)
+
+        pids = {job.latest_result().return_value for job in jobs}
+        self.assertEqual(1, len(pids))
+        self.assertNotEqual(os.getpid(), pids.pop())
+
+    def test_replaces_horses_after_max_jobs(self):
+        with Connection(rq_redis_connection), patch("redash.settings.WORKER_WARM_HORSE_MAX_JOBS", 2):
+            jobs = [current_pid.delay() for _ in range(3)]
+            WarmWorker(["default"]).work(burst=True)
+
+        pids = [job.latest_result().return_value for job in jobs]
+        self.assertEqual(pids[0], pids[1])
+        self.assertNotEqual(pids[1], pids[2])
+
+    def test_replaces_horses_that_died(self):
+        with Connection(rq_redis_connection):
+            failed_job = exit_horse.delay()
+            job = current_pid.delay()
+            WarmWorker(["default"]).work(burst=True)
+
+        self.assertEqual(JobStatus.FAILED, failed_job.get_status())
+        self.assertEqual(JobStatus.FINISHED, job.get_status())
+
+    def test_replaces_horses_with_threads_left_running(self):
+        with Connection(rq_redis_connection), patch.object(WarmWorker, "stray_threads_timeout", 0.1):
+            retired = leave_thread_running.delay()
+            job = current_pid.delay()
+            WarmWorker(["default"]).work(burst=True)
+
+        self.assertEqual(JobStatus.FINISHED, job.get_status())
+        self.assertNotEqual(retired.latest_result().return_value, job.latest_result().return_value)
+
+    def test_horses_that_fail_outside_of_jobs_exit(self):
+        def broken_signals(worker):
+            if rq_redis_connection.set("broken_signals", 1, nx=True):
+                raise OSError("broken")
+
+        with Connection(rq_redis_connection), patch.object(WarmWorker, "setup_work_horse_signals", broken_signals):
+            failed_job = current_pid.delay()
+            job = current_pid.delay()
+            WarmWorker(["default"]).work(burst=True)
+
+        self.assertEqual(JobStatus.FAILED, failed_job.get_status())
+        self.assertEqual(JobStatus.FINISHED, job.get_status())
+
+    def test_keeps_replies_read_when_the_monitor_interrupts(self):
+        class Interrupted(Exception):
+            pass
+
+        def alarm(signum, frame):
+            raise Interrupted()
+
+        class AlarmingConnection:
+            def __init__(self, connection):
+                self.connection = connection
+
+            def poll(self, timeout):
+                return self.connection.poll(timeout)
+
+            def recv(self):
+                os.kill(os.getpid(), signal.SIGALRM)
+                return self.connection.recv()
+
+            def close(self):
+                self.connection.close()
+
+        worker_end, horse_end = multiprocessing.Pipe()
+        horse_end.send((0, False))
+        worker = WarmWorker(["default"], connection=rq_redis_connection)
+        worker._warm_horse = (123, AlarmingConnection(worker_end))
+
+        previous = signal.signal(signal.SIGALRM, alarm)
+        self.addCleanup(signal.signal, signal.SIGALRM, previous)
+        with self.assertRaises(Interrupted):
+            worker.wait_for_horse()
+        self.assertEqual((123, 0, None), worker.wait_for_horse())
+
+
+class TestFairQueue(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+        rq_redis_connection.flushdb()
+        self.addCleanup(rq_redis_connection.flushdb)
+        self.queue = Queue("queries", connection=rq_redis_connection)
+
+    def enqueue(self, data_source_id, org_id=1):
+        return self.queue.enqueue(current_pid, meta={"data_source_id": data_source_id, "org_id": org_id}).id
+
+    def dequeue(self):
+        result = Queue.dequeue_any([self.queue], None, connection=rq_redis_connection)
+        return result and result[0].id
+
+    def test_takes_data_sources_in_turns(self):
+        first = [self.enqueue(1) for _ in range(3)]
+        second = [self.enqueue(2) for _ in range(2)]
+
+        self.assertEqual(
+            [first[0], second[0], first[1], second[1], first[2]],
+            [self.dequeue() for _ in range(5)],
+        )
+        self.assertIsNone(self.dequeue())
+
+    def test_takes_organizations_in_turns(self):
+        first = [self.enqueue(1, org_id=1), self.enqueue(2, org_id=1), self.enqueue(1, org_id=1)]
+        second = [self.enqueue(3, org_id=2), self.enqueue(3, org_id=2)]
+
+        self.assertEqual(
+            [first[0], second[0], first[1], second[1], first[2]],
+            [self.dequeue() for _ in range(5)],
+        )
+
+    def test_weighs_data_sources(self):
+        with patch("redash.settings.DATA_SOURCE_QUEUE_WEIGHTS", {1: 2}):
+            first = [self.enqueue(1) for _ in range(4)]
+            second = [self.enqueue(2) for _ in range(2)]
+
+        self.assertEqual(
+            [first[0], second[0], first[1], first[2], second[1], first[3]],
+            [self.dequeue() for _ in range(6)],
+        )
+
+    def test_takes_data_sources_in_turns_behind_long_backlogs(self):
+        jobs = [Queue.prepare_data(current_pid, meta={"data_source_id": 1, "org_id": 1}) for _ in range(1500)]
+        backlog = [job.id for job in self.queue.enqueue_many(jobs)]
+        other = self.enqueue(2)
+
+        self.assertEqual([backlog[0], other, backlog[1]], [self.dequeue() for _ in range(3)])
+        self.assertEqual({1: 1498}, self.queue.queued_per_data_source())
+
+    def test_skips_cancelled_jobs(self):
+        jobs = [self.enqueue(1) for _ in range(2)]
+        Job.fetch(jobs[0], connection=rq_redis_connection).cancel()
+
+        self.assertEqual([jobs[1], None], [self.dequeue() for _ in range(2)])
+
+    def test_restores_jobs_popped_while_waiting(self):
+        job_id = self.enqueue(1)
+        rq_redis_connection.lpop(self.queue.key)
+        self.assertIsNone(self.dequeue())
+
+        self.queue.restore_job(job_id)
+        self.assertEqual([job_id, None], [self.dequeue() for _ in range(2)])
+
+    def test_forgets_jobs_of_emptied_queues(self):
+        self.enqueue(1)
+        self.queue.empty()
+
+        self.assertIsNone(self.dequeue())
+        self.assertEqual({}, self.queue.queued_per_data_source())
+
+    def test_limits_running_jobs_of_data_sources(self):
+        first = [self.enqueue(1) for _ in range(2)]
+        second = self.enqueue(2)
+
+        with patch("redash.settings.DATA_SOURCE_MAX_CONCURRENCY", 1):
+            self.assertEqual([first[0], second, None], [self.dequeue() for _ in range(3)])
+            self.queue.release(first[0], "1")
+            self.assertEqual(first[1], self.dequeue())
+
+    def test_keeps_order_of_queues_that_are_not_fair(self):
+        with patch("redash.settings.FAIR_QUEUES", set()):
+            jobs = [self.enqueue(1), self.enqueue(1), self.enqueue(2)]
+            self.assertEqual(jobs, [self.dequeue() for _ in range(3)])
+
+    def test_worker_releases_data_source_after_job(self):
+        with patch("redash.settings.DATA_SOURCE_MAX_CONCURRENCY", 1), Connection(rq_redis_connection):
+            jobs = [self.enqueue(1) for _ in range(2)]
+            Worker(["queries"]).work(burst=True)
+
+        self.assertEqual(
+            [JobStatus.FINISHED] * 2,
+            [Job.fetch(job_id, connection=rq_redis_connection).get_status() for job_id in jobs],
+        )
+        self.assertEqual(0, rq_redis_connection.zcard(self.queue.running_key_prefix + "1"))
+
+
 @patch("statsd.StatsClient.incr")
 class TestQueueMetrics(BaseTestCase):
     def tearDown(self):
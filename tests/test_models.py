@@ -4,9 +4,9 @@ from unittest import TestCase
 
 from dateutil.parser import parse as date_parse
 
-from redash import models
+from redash import models, redis_connection
 from redash.models import db
-from redash.utils import gen_query_hash, utcnow
+from redash.utils import gen_query_hash, json_dumps, utcnow
 from tests import BaseTestCase
 
 
@@ -326,6 +326,101 @@ class QueryOutdatedQueriesTest(BaseTestCase):
         self.assertNotIn(query, queries)
 
 
+class ScheduledQueriesIndexTest(BaseTestCase):
+    def schedule(self, **kwargs):
+        schedule = {"interval": None, "time": None, "until": None, "day_of_week": None}
+        schedule.update(**kwargs)
+        return schedule
+
+    def create_scheduled_query(self, **kwargs):
+        return self.factory.create_query(schedule=self.schedule(**kwargs))
+
+    def next_run(self, query):
+        return redis_connection.zscore(models.ScheduledQueriesIndex.KEY_NAME, query.id)
+
+    def test_rebuilds_index_with_next_runs(self):
+        query = self.create_scheduled_query(interval="3600")
+        query.latest_query_data = self.factory.create_query_result(retrieved_at=utcnow())
+        unscheduled = self.factory.create_query(schedule=None)
+
+        self.assertEqual(models.Query.outdated_queries(), [])
+
+        self.assertAlmostEqual(self.next_run(query), (utcnow() + datetime.timedelta(hours=1)).timestamp(), delta=5)
+        self.assertIsNone(self.next_run(unscheduled))
+
+    def test_checks_only_due_queries(self):
+        query = self.create_scheduled_query(interval="3600")
+        query.latest_query_data = self.factory.create_query_result(retrieved_at=utcnow())
+        models.Query.outdated_queries()
+        db.session.commit()
+
+        redis_connection.zadd(models.ScheduledQueriesIndex.KEY_NAME, {query.id: utcnow().timestamp() + 60})
+        query.latest_query_data.retrieved_at = utcnow() - datetime.timedelta(hours=2)
+        db.session.commit()
+
+        self.assertEqual(models.Query.outdated_queries(), [])
+
+    def test_changed_queries_are_checked_again(self):
+        query = self.create_scheduled_query(interval="3600")
+        query.latest_query_data = self.factory.create_query_result(retrieved_at=utcnow())
+        models.Query.outdated_queries()
+
+        query.schedule = self.schedule(interval="60")
+        query.latest_query_data = self.factory.create_query_result(
+            retrieved_at=utcnow() - datetime.timedelta(minutes=5)
+        )
+        db.session.flush()
+
+        self.assertEqual(models.Query.outdated_queries(), [query])
+
+    def test_removes_unscheduled_queries(self):
+        query = self.create_scheduled_query(interval="3600")
+        models.Query.outdated_queries()
+        self.assertEqual(self.next_run(query), 0)
+
+        query.archive()
+        db.session.flush()
+
+        self.assertEqual(models.Query.outdated_queries(), [])
+        self.assertIsNone(self.next_run(query))
+
+    def test_rebuild_keeps_queries_changed_while_it_ran(self):
+        changed, unchanged = self.create_scheduled_query(interval="60"), self.create_scheduled_query(interval="60")
+        version = models.scheduled_queries_index.version()
+        models.scheduled_queries_index.invalidate(changed.id)
+
+        models.scheduled_queries_index.rebuild({changed.id: 100, unchanged.id: 200}, version)
+
+        self.assertEqual(self.next_run(changed), 0)
+        self.assertEqual(self.next_run(unchanged), 200)
+        models.scheduled_queries_index.rebuild(
+            {changed.id: 100, unchanged.id: 200}, models.scheduled_queries_index.version()
+        )
+        self.assertEqual(self.next_run(changed), 100)
+
+    def test_update_keeps_queries_changed_while_it_ran(self):
+        changed, unchanged = self.create_scheduled_query(interval="60"), self.create_scheduled_query(interval="60")
+        version = models.scheduled_queries_index.version()
+        models.scheduled_queries_index.invalidate(changed.id)
+
+        models.scheduled_queries_index.update({changed.id: 100}, [changed.id, unchanged.id], version)
+
+        self.assertEqual(self.next_run(changed), 0)
+        self.assertIsNone(self.next_run(unchanged))
+
+    def test_checks_queries_again_when_changes_are_committed(self):
+        query = self.create_scheduled_query(interval="3600")
+        db.session.commit()
+        query.schedule = self.schedule(interval="60")
+        db.session.flush()
+        # A refresh that read the query before the change was committed.
+        redis_connection.zadd(models.ScheduledQueriesIndex.KEY_NAME, {query.id: utcnow().timestamp() + 3600})
+
+        db.session.commit()
+
+        self.assertEqual(self.next_run(query), 0)
+
+
 class QueryArchiveTest(BaseTestCase):
     def test_archive_query_sets_flag(self):
         query = self.factory.create_query()
@@ -538,6 +633,24 @@ class TestQueryResultStoreResult(BaseTestCase):
         self.assertEqual(query_result.query_hash, self.query_hash)
         self.assertEqual(query_result.data_source, self.data_source)
 
+    def test_stores_size_and_row_count(self):
+        data = {"columns": [{"name": "a", "type": "integer"}], "rows": [{"a": 1}, {"a": 2}]}
+        query_result = models.QueryResult.store_result(
+            self.data_source.org_id,
+            self.data_source,
+            self.query_hash,
+            self.query,
+            data,
+            self.runtime,
+            self.utcnow,
+        )
+        db.session.commit()
+
+        query_result = models.QueryResult.query.get(query_result.id)
+        self.assertEqual(query_result.row_count, 2)
+        self.assertEqual(query_result.data_size, len(json_dumps(data)))
+        self.assertEqual(query_result.data, data)
+
 
 class TestEvents(BaseTestCase):
     def raw_event(self):
@@ -20,7 +20,11 @@ from redash.utils import (
     json_dumps,
     render_template,
 )
-from redash.utils.pandas import pandas_installed
+from redash.utils.pandas import (
+    InvalidAggregationError,
+    pandas_installed,
+    parse_aggregation_spec,
+)
 
 DummyRequest = namedtuple("DummyRequest", ["host", "scheme"])
 
@@ -30,7 +34,11 @@ if pandas_installed:
     import numpy as np
     import pandas as pd
 
-    from redash.utils.pandas import get_column_types_from_dataframe, pandas_to_result
+    from redash.utils.pandas import (
+        aggregate_result,
+        get_column_types_from_dataframe,
+        pandas_to_result,
+    )
 
 
 class TestBuildUrl(TestCase):
@@ -160,3 +168,75 @@ def test_pandas_to_result(mock_dataframe):
     assert "rows" in result
 
     assert mock_dataframe.equals(pd.DataFrame(result["rows"]))
+
+
+aggregation_data = {
+    "columns": [{"name": "day", "type": TYPE_DATE}, {"name": "value", "type": TYPE_INTEGER}],
+    "rows": [
+        {"day": "2024-01-01", "value": 1},
+        {"day": "2024-01-02", "value": "n/a"},
+        {"day": "2024-01-01", "value": 3},
+        {"day": None, "value": None},
+    ],
+}
+
+
+def test_parse_aggregation_spec_defaults():
+    spec = parse_aggregation_spec(
+        {"aggregations": [{"column": "value", "function": "avg"}]}, aggregation_data["columns"]
+    )
+
+    assert spec == {
+        "group_by": [],
+        "aggregations": [{"column": "value", "function": "avg", "name": "avg(value)"}],
+        "sort": [],
+        "limit": None,
+    }
+
+
+@pytest.mark.parametrize(
+    "spec",
+    [
+        None,
+        {"aggregations": []},
+        {"aggregations": [{"column": "value", "function": "median"}]},
+        {"aggregations": [{"function": "sum"}]},
+        {"group_by": ["value"], "aggregations": [{"function": "count", "name": "value"}]},
+        {"aggregations": [{"function": "count"}], "sort": [{"column": "day"}]},
+        {"aggregations": [{"function": "count"}], "limit": -1},
+    ],
+)
+def test_parse_aggregation_spec_rejects_invalid_specs(spec):
+    with pytest.raises(InvalidAggregationError):
+        parse_aggregation_spec(spec, aggregation_data["columns"])
+
+
+@skip_condition
+def test_aggregate_result_groups_rows():
+    spec = parse_aggregation_spec(
+        {
+            "group_by": ["day"],
+            "aggregations": [{"column": "value", "function": "sum"}, {"function": "count"}],
+            "sort": [{"column": "day"}],
+        },
+        aggregation_data["columns"],
+    )
+    result = aggregate_result(aggregation_data, spec)
+
+    assert [c["type"] for c in result["columns"]] == [TYPE_DATE, TYPE_FLOAT, TYPE_INTEGER]
+    assert result["rows"] == [
+        {"day": "2024-01-01", "sum(value)": 4, "count": 2},
+        {"day": "2024-01-02", "sum(value)": 0, "count": 1},
+        {"day": None, "sum(value)": 0, "count": 1},
+    ]
+
+
+@skip_condition
+def test_aggregate_result_without_group_by():
+    spec = parse_aggregation_spec(
+        {"aggregations": [{"column": "value", "function": "max"}, {"column": "day", "function": "count_distinct"}]},
+        aggregation_data["columns"],
+    )
+    data = {"columns": aggregation_data["columns"], "rows": aggregation_data["rows"][:1]}
+
+    assert aggregate_result(data, spec)["rows"] == [{"max(value)": 1, "count_distinct(day)": 1}]
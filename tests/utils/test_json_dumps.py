@@ -1,4 +1,11 @@
-from redash.utils import json_dumps, json_loads
+import datetime
+import decimal
+import uuid
+
+import pytz
+from mock import patch
+
+from redash.utils import json_dumps, json_loads, orjson_enabled
 from tests import BaseTestCase
 
 
@@ -29,3 +36,48 @@ class TestJsonDumps(BaseTestCase):
         json_data = json_dumps(input_data)
         actual_output_data = json_loads(json_data)
         self.assertEqual(actual_output_data, expected_output_data)
+
+
+class TestJsonSerializers(BaseTestCase):
+    """
+    The orjson and the standard library serializers produce the same values.
+    """
+
+    data = {
+        "datetime": datetime.datetime(2020, 1, 2, 3, 4, 5, 678901, tzinfo=pytz.utc),
+        "naive_datetime": datetime.datetime(2020, 1, 2, 3, 4, 5),
+        "date": datetime.date(2020, 1, 2),
+        "time": datetime.time(3, 4, 5, 678901),
+        "timedelta": datetime.timedelta(seconds=90),
+        "decimal": decimal.Decimal("1.5"),
+        "uuid": uuid.UUID("12345678123456781234567812345678"),
+        "bytes": b"test",
+        "nan": float("nan"),
+        "big_int": 2**70,
+        "int_keys": {1: "a"},
+        "text": "עברית",
+    }
+
+    def dumps(self, serializer, data):
+        with patch("redash.settings.JSON_SERIALIZER", serializer):
+            return json_dumps(data)
+
+    def test_serializers_produce_the_same_values(self):
+        self.assertEqual(json_loads(self.dumps("orjson", self.data)), json_loads(self.dumps("json", self.data)))
+
+    def test_formats_dates_like_ecma_262(self):
+        serialized = json_loads(self.dumps("orjson", self.data))
+
+        self.assertEqual(serialized["datetime"], "2020-01-02T03:04:05.678Z")
+        self.assertEqual(serialized["naive_datetime"], "2020-01-02T03:04:05")
+        self.assertEqual(serialized["time"], "03:04:05.678")
+
+    def test_uses_orjson_when_installed(self):
+        serialized = self.dumps("orjson", {"a": 1})
+        self.assertEqual(serialized, '{"a":1}' if orjson_enabled else '{"a": 1}')
+
+    def test_supports_sort_keys(self):
+        self.assertEqual(json_loads(self.dumps("orjson", {"b": 1, "a": 2})), {"a": 2, "b": 1})
+        self.assertTrue(self.dumps("orjson", {"b": 1, "a": 2}).startswith('{"b"'))
+        with patch("redash.settings.JSON_SERIALIZER", "orjson"):
+            self.assertTrue(json_dumps({"b": 1, "a": 2}, sort_keys=True).startswith('{"a"'))